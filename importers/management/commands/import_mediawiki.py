@@ -1,3 +1,5 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand
 from django.core.management import call_command
 
@@ -6,6 +8,168 @@ class Command(BaseCommand):
     help = ('Imports pages from an existing MediaWiki site.  '
             'Clears out any existing data.')
 
+    option_list = BaseCommand.option_list + (
+        make_option('--cache',
+            dest='cache',
+            help='Cache API responses in this file so that re-runs of the '
+                 'import don\'t fetch them again.'),
+        make_option('--cache-ttl',
+            dest='cache_ttl',
+            type='int',
+            help='Ignore cached API responses older than this many seconds.'),
+        make_option('--cache-max-size',
+            dest='cache_max_size',
+            type='int',
+            help='Evict least recently used API responses once the cache '
+                 'holds more than this many bytes.'),
+        make_option('--mirror',
+            action='store_true',
+            dest='mirror',
+            default=False,
+            help='Copy the wiki into the cache file before importing, so '
+                 'the import itself doesn\'t wait on the network.'),
+        make_option('--mirror-requests',
+            dest='mirror_requests',
+            type='int',
+            default=100,
+            help='Number of requests to keep in flight while mirroring.  '
+                 'These are all sent from one thread.'),
+        make_option('--dump',
+            dest='dump',
+            help='Read pages, revisions and redirects from this XML dump '
+                 '(Special:Export or dumpBackup.php, may be .gz or .bz2) '
+                 'instead of the API.'),
+        make_option('--timeout',
+            dest='timeout',
+            type='int',
+            default=60,
+            help='Seconds to wait on the wiki before giving up on a '
+                 'request.'),
+        make_option('--workers',
+            dest='workers',
+            type='int',
+            default=4,
+            help='Number of pages to import at once to begin with.  This is '
+                 'adjusted as the import runs, depending on how well the '
+                 'wiki is keeping up.'),
+        make_option('--processes',
+            dest='processes',
+            type='int',
+            default=0,
+            help='Number of processes to convert old revisions\' HTML in, '
+                 'e.g. the number of CPU cores.  By default it\'s done in '
+                 'the importing threads, which only use one core.'),
+        make_option('--min-workers',
+            dest='min_workers',
+            type='int',
+            default=1,
+            help='Never import fewer than this many pages at once.'),
+        make_option('--max-workers',
+            dest='max_workers',
+            type='int',
+            default=16,
+            help='Never import more than this many pages at once.'),
+        make_option('--target-latency',
+            dest='target_latency',
+            type='float',
+            default=2.0,
+            help='API response time, in seconds, to aim for when adjusting '
+                 'the number of workers.'),
+        make_option('--maxlag',
+            dest='maxlag',
+            type='int',
+            default=5,
+            help='Back off while the wiki\'s database lag is over this many '
+                 'seconds.'),
+        make_option('--record',
+            dest='record',
+            help='Save every API response and file fetched during the import '
+                 'in this file, for replaying with replay_mediawiki.'),
+        make_option('--retries',
+            dest='retries',
+            type='int',
+            default=3,
+            help='Times to retry a page that fails because the wiki, the '
+                 'network or the database had a problem.'),
+        make_option('--failed',
+            dest='failed',
+            help='List the pages that couldn\'t be imported, and why, in '
+                 'this file.'),
+        make_option('--retry-failed',
+            action='store_true',
+            dest='retry_failed',
+            default=False,
+            help='Import just the pages listed in the --failed file again, '
+                 'keeping existing data.'),
+        make_option('--deadlines',
+            dest='deadlines',
+            help='Give up on a page, and retry it, when it has been stuck '
+                 'this long in one stage of its import.  A comma-separated '
+                 'list of stage:SECONDS, where the stages are api, download, '
+                 'transform and db.  Defaults to api:900,download:900,'
+                 'transform:600,db:300.'),
+        make_option('--url',
+            dest='url',
+            help='Address of the MediaWiki site to import.'),
+        make_option('--history',
+            dest='history_policy',
+            help='Import only some of each page\'s old revisions.  A comma-'
+                 'separated list of: last:N (the newest N), since:DATE, '
+                 'per-author:SECONDS (one per author in any SECONDS), '
+                 'size-delta:BYTES (those that changed the size by more than '
+                 'BYTES).'),
+        make_option('--state',
+            dest='state',
+            help='Remember how far the import got in this file.  If the file '
+                 'already exists, only import what has changed on the wiki '
+                 'since then, keeping existing data.'),
+        make_option('--journal',
+            dest='journal',
+            help='Record which pages and revisions have been imported in this '
+                 'file.  If an import with the same journal was interrupted, '
+                 'pick it up where it left off.  See import_mediawiki_status.'),
+        make_option('--shard',
+            dest='shard',
+            type='int',
+            help='Import only this share of the pages, numbered from 0, in an '
+                 'import split between --shards processes that share the '
+                 'database.  Shard 0 must be among them; it clears out '
+                 'existing data first and finishes the import last.'),
+        make_option('--shards',
+            dest='num_shards',
+            type='int',
+            help='Number of processes the import is split between.'),
+        make_option('--noinput',
+            action='store_false',
+            dest='interactive',
+            default=True,
+            help='Don\'t ask before clearing out existing data.'),
+    )
+
     def handle(self, *args, **options):
         from importers import mediawiki
-        mediawiki.run()
+        mediawiki.run(cache=options['cache'],
+                      cache_ttl=options['cache_ttl'],
+                      cache_max_size=options['cache_max_size'],
+                      mirror=options['mirror'],
+                      mirror_requests=options['mirror_requests'],
+                      dump=options['dump'],
+                      timeout=options['timeout'],
+                      workers=options['workers'],
+                      processes=options['processes'],
+                      min_workers=options['min_workers'],
+                      max_workers=options['max_workers'],
+                      target_latency=options['target_latency'],
+                      maxlag=options['maxlag'],
+                      record=options['record'],
+                      url=options['url'],
+                      interactive=options['interactive'],
+                      history_policy=options['history_policy'],
+                      state=options['state'],
+                      journal=options['journal'],
+                      shard=options['shard'],
+                      num_shards=options['num_shards'],
+                      retries=options['retries'],
+                      failed=options['failed'],
+                      retry_failed=options['retry_failed'],
+                      deadlines=options['deadlines'])
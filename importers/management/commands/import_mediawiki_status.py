@@ -0,0 +1,47 @@
+import datetime
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '<journal>'
+    help = ('Reports the progress of an import_mediawiki --journal import '
+            'from its journal.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--failures',
+            action='store_true',
+            dest='failures',
+            default=False,
+            help='List the pages that failed to import, and why.'),
+    )
+
+    def handle(self, *args, **options):
+        from importers.mediawiki.journal import ImportJournal, STARTED, \
+            DONE, FAILED
+        if len(args) != 1:
+            raise CommandError('Usage: import_mediawiki_status %s' % self.args)
+        if not os.path.exists(args[0]):
+            raise CommandError('No journal at %s' % args[0])
+        journal = ImportJournal(args[0])
+
+        print "Import of %s" % journal.origin()
+        for name, finished in journal.stages():
+            print "  %s finished at %s" % (
+                name, datetime.datetime.fromtimestamp(finished).strftime(
+                    '%Y-%m-%d %H:%M:%S'))
+        counts = journal.counts()
+        print "Pages: %d done, %d in progress, %d failed" % (
+            counts.get(DONE, 0), counts.get(STARTED, 0), counts.get(FAILED, 0))
+        print "Old revisions imported: %d" % journal.num_revisions()
+        print "Map data waiting to be added: %d" % len(journal.mapdata())
+
+        failures = journal.failures()
+        if options['failures']:
+            for title, attempts, error in failures:
+                print "%s (%d attempts): %s" % (title.encode('utf-8'),
+                                                attempts, error)
+        elif failures:
+            print "Use --failures to list the pages that failed."
@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '<archive>'
+    help = ('Serves an archive recorded with import_mediawiki --record as a '
+            'stand-in MediaWiki site, for benchmarking imports offline.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--host',
+            dest='host',
+            default='127.0.0.1',
+            help='Address to listen on.'),
+        make_option('--port',
+            dest='port',
+            type='int',
+            default=8000,
+            help='Port to listen on.'),
+        make_option('--latency',
+            dest='latency',
+            type='float',
+            default=0,
+            help='Seconds to wait before answering each request.'),
+        make_option('--error-rate',
+            dest='error_rate',
+            type='float',
+            default=0,
+            help='Fraction of requests to answer with a 503 error.'),
+        make_option('--seed',
+            dest='seed',
+            type='int',
+            help='Seed for choosing which requests fail, so runs can be '
+                 'repeated exactly.'),
+    )
+
+    def handle(self, *args, **options):
+        from importers.mediawiki.replay import RecordingArchive, ReplayServer
+        if len(args) != 1:
+            raise CommandError('Usage: replay_mediawiki %s' % self.args)
+        archive = RecordingArchive(args[0])
+        server = ReplayServer(archive,
+                              address=(options['host'], options['port']),
+                              latency=options['latency'],
+                              error_rate=options['error_rate'],
+                              seed=options['seed'],
+                              verbose=int(options['verbosity']) > 1)
+        print "Replaying %d recorded responses from %s" % (archive.count(),
+                                                           archive.origin())
+        print "Import with: import_mediawiki --url=%s" % server.api_url
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print
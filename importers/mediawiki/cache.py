@@ -0,0 +1,165 @@
+"""
+A persistent, on-disk cache for MediaWiki API responses.
+
+Responses are stored in a SQLite file as zlib-compressed JSON, keyed by a
+hash of the normalized request parameters.  SQLite does the locking for
+us, so a single cache file can be shared between worker threads and
+between importer processes.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+# Parameters that don't change the content of a response.
+IGNORED_PARAMS = ['format', 'maxlag']
+
+
+def _normalize_value(value):
+    if isinstance(value, (list, tuple)):
+        return u'|'.join([_normalize_value(v) for v in value])
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def request_key(params, prefix=''):
+    """
+    Returns a stable key for an API request.  Parameter order and value
+    types (e.g. 500 vs '500') don't matter.
+    """
+    items = sorted((_normalize_value(k), _normalize_value(v))
+                   for k, v in params.iteritems()
+                   if k not in IGNORED_PARAMS)
+    serialized = json.dumps([_normalize_value(prefix), items])
+    return hashlib.sha1(serialized).hexdigest()
+
+
+class APICache(object):
+    """
+    Attrs:
+        path: Path to the SQLite cache file.  Created if it doesn't exist.
+        prefix: Mixed into every key, e.g. the API endpoint, so one file
+            can hold responses from several wikis.
+        ttl: Optional maximum age of an entry, in seconds.
+        max_size: Optional cap on the total size of the stored (compressed)
+            responses, in bytes.  The least recently used entries are
+            evicted when the cap is exceeded.
+    """
+    # How many writes between checks of the total cache size.
+    EVICT_CHECK_INTERVAL = 100
+    # When evicting, shrink the cache to this fraction of max_size.
+    EVICT_TARGET = 0.9
+
+    def __init__(self, path, prefix='', ttl=None, max_size=None):
+        self.path = path
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._create_tables()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, so we keep
+        # one per thread.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS api_responses ('
+                         'key TEXT PRIMARY KEY, '
+                         'body BLOB NOT NULL, '
+                         'size INTEGER NOT NULL, '
+                         'created REAL NOT NULL, '
+                         'accessed REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS api_responses_accessed '
+                         'ON api_responses (accessed)')
+
+    def key(self, params):
+        return request_key(params, self.prefix)
+
+    def get(self, params):
+        """
+        Returns the cached response for the request, or None.
+        """
+        key = self.key(params)
+        conn = self._connection()
+        row = conn.execute('SELECT body, created FROM api_responses '
+                           'WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.ttl and row[1] + self.ttl < now):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.max_size:
+            # Only needed to pick eviction victims.
+            with conn:
+                conn.execute('UPDATE api_responses SET accessed = ? '
+                             'WHERE key = ?', (now, key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, params, response):
+        body = sqlite3.Binary(zlib.compress(json.dumps(response)))
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO api_responses '
+                         '(key, body, size, created, accessed) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (self.key(params), body, len(body), now, now))
+        with self._lock:
+            self._writes += 1
+            check_size = (self._writes % self.EVICT_CHECK_INTERVAL == 0)
+        if check_size:
+            self.evict()
+
+    def size(self):
+        row = self._connection().execute(
+            'SELECT SUM(size) FROM api_responses').fetchone()
+        return row[0] or 0
+
+    def evict(self):
+        """
+        Drops expired entries and, if the cache is over its size cap, the
+        least recently used entries.
+        """
+        conn = self._connection()
+        with conn:
+            if self.ttl:
+                conn.execute('DELETE FROM api_responses WHERE created < ?',
+                             (time.time() - self.ttl,))
+            if not self.max_size:
+                return
+            size = self.size()
+            if size <= self.max_size:
+                return
+            excess = size - int(self.max_size * self.EVICT_TARGET)
+            freed = 0
+            victims = []
+            for key, size in conn.execute('SELECT key, size FROM '
+                                          'api_responses ORDER BY accessed'):
+                victims.append((key,))
+                freed += size
+                if freed >= excess:
+                    break
+            conn.executemany('DELETE FROM api_responses WHERE key = ?',
+                             victims)
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM api_responses')
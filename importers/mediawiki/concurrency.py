@@ -0,0 +1,175 @@
+"""
+Helpers for coordinating the importer's worker threads.
+"""
+import sys
+import threading
+import time
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical calls that are in flight at the same time.
+
+    The first caller for a key runs the function; callers that arrive with
+    the same key while it's running wait for it and get its result (or
+    its exception) instead of running the function again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # Number of calls that were answered by another caller's call.
+        self.saved = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.saved += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args, **kwargs)
+            except:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def do_batch(self, keys, func):
+        """
+        Like do(), for a function that works on many keys at once and
+        stores its own results.
+
+        func is called with the keys that aren't already in flight.  Keys
+        that another caller is working on are waited for instead.
+        """
+        own = []
+        waiting = []
+        with self._lock:
+            for key in keys:
+                call = self._calls.get(key)
+                if call is not None:
+                    self.saved += 1
+                    waiting.append(call)
+                else:
+                    call = _Call()
+                    self._calls[key] = call
+                    own.append((key, call))
+
+        try:
+            if own:
+                func([key for key, call in own])
+        finally:
+            with self._lock:
+                for key, call in own:
+                    del self._calls[key]
+            for key, call in own:
+                call.done.set()
+
+        for call in waiting:
+            call.done.wait()
+
+
+class ConcurrencyController(object):
+    """
+    Decides how many workers may be working at once, based on how the
+    server is coping.
+
+    Workers call acquire() before each work item and release() after.
+    The transport calls record() after every API request and pause() when
+    the server asks us to wait.  Every `window` requests the limit is
+    adjusted: it's halved if too many requests failed or latency is well
+    above the target, and raised by one if latency is under the target
+    with no errors.
+
+    Attrs:
+        min_workers: The limit never drops below this.
+        max_workers: The limit never rises above this.
+        initial_workers: Starting limit.
+        target_latency: Request latency, in seconds, we're happy with.
+        max_error_rate: Fraction of failed requests we tolerate in a window.
+        window: Number of requests between adjustments.
+    """
+    def __init__(self, min_workers=1, max_workers=16, initial_workers=4,
+                 target_latency=2.0, max_error_rate=0.05, window=20):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.limit = max(min_workers, min(initial_workers, max_workers))
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.active = 0
+        self._paused_until = 0
+        self._samples = []
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._paused_until - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                elif self.active >= self.limit:
+                    self._cond.wait()
+                else:
+                    break
+            self.active += 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """
+        Holds back new work for the given number of seconds.
+        """
+        with self._cond:
+            self._paused_until = max(self._paused_until,
+                                     time.time() + seconds)
+
+    def record(self, latency, error=False):
+        with self._cond:
+            self._samples.append((latency, error))
+            if len(self._samples) < self.window:
+                return
+            samples, self._samples = self._samples, []
+            errors = len([s for s in samples if s[1]])
+            error_rate = float(errors) / len(samples)
+            ok_latencies = [s[0] for s in samples if not s[1]]
+            if ok_latencies:
+                latency = sum(ok_latencies) / len(ok_latencies)
+            else:
+                latency = None
+
+            old_limit = self.limit
+            if (error_rate > self.max_error_rate or latency is None or
+                    latency > self.target_latency * 1.5):
+                self.limit = max(self.min_workers, self.limit // 2)
+            elif errors == 0 and latency < self.target_latency:
+                self.limit = min(self.max_workers, self.limit + 1)
+            if self.limit != old_limit:
+                print "Adjusting workers from %d to %d (latency %s, %d%% errors)" % (
+                    old_limit, self.limit,
+                    '%.2fs' % latency if latency is not None else 'n/a',
+                    100 * error_rate)
+                self._cond.notify_all()
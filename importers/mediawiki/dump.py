@@ -0,0 +1,211 @@
+"""
+Reads pages and revision metadata from a MediaWiki XML dump, as made by
+Special:Export or maintenance/dumpBackup.php.
+
+The dump is streamed with iterparse and each page is thrown away once
+it's been handed out, so memory use doesn't grow with the size of the
+dump.
+"""
+import bz2
+import gzip
+import re
+
+from lxml import etree
+
+
+_redirect_re = re.compile(r'^\s*#REDIRECT\s*:?\s*\[\[([^\]|#]+)',
+                          re.IGNORECASE)
+
+
+def _local_name(tag):
+    # Tags are namespaced with the export schema version, e.g.
+    # {http://www.mediawiki.org/xml/export-0.8/}page
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child_text(elem, name):
+    for child in elem:
+        if _local_name(child.tag) == name:
+            return child.text
+    return None
+
+
+def open_dump(path):
+    """
+    Opens a dump file, decompressing it if the name says it's compressed.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+
+class DumpPage(object):
+    """
+    A page read from a dump.
+
+    Attrs:
+        title: Page title, with namespace prefix.
+        pageid: MediaWiki page id.
+        namespace: Namespace number.
+        redirect_target: Title the page redirects to, or None.
+        categories: Categories the latest revision links to.
+        revisions: List of revision dictionaries, newest first, with the
+            same keys the API uses: revid, parentid, timestamp, user,
+            comment, sha1, size.
+    """
+    def __init__(self, title, pageid, namespace, redirect_target=None,
+                 categories=None, revisions=None):
+        self.title = title
+        self.pageid = pageid
+        self.namespace = namespace
+        self.redirect_target = redirect_target
+        self.categories = categories or []
+        self.revisions = revisions or []
+
+    @property
+    def length(self):
+        if self.revisions:
+            return self.revisions[0].get('size')
+        return None
+
+    @property
+    def num_revisions(self):
+        return len(self.revisions)
+
+    def __repr__(self):
+        return '<DumpPage %r>' % self.title
+
+
+class DumpReader(object):
+    """
+    Attrs:
+        path: Path to the dump file.  May be .gz or .bz2 compressed.
+    """
+    def __init__(self, path):
+        self.path = path
+        # Namespace number -> local name, read from the dump's siteinfo.
+        self.namespaces = {}
+
+    def _namespace_of(self, title):
+        if ':' in title:
+            prefix = title.split(':', 1)[0]
+            for key, name in self.namespaces.iteritems():
+                if name and name == prefix:
+                    return key
+        return 0
+
+    def _category_names(self):
+        names = set(['Category'])
+        if self.namespaces.get(14):
+            names.add(self.namespaces[14])
+        return names
+
+    def _categories_in(self, text):
+        names = '|'.join([re.escape(n) for n in self._category_names()])
+        category_re = re.compile(r'\[\[\s*(?:%s)\s*:\s*([^\]|]+)' % names,
+                                 re.IGNORECASE)
+        categories = []
+        for match in category_re.finditer(text):
+            category = match.group(1).strip().replace('_', ' ')
+            if category not in categories:
+                categories.append(category)
+        return categories
+
+    def _read_siteinfo(self, elem):
+        for item in elem.iter():
+            if _local_name(item.tag) == 'namespace':
+                self.namespaces[int(item.get('key'))] = item.text or ''
+
+    def _read_revision(self, elem):
+        revision = {}
+        for child in elem:
+            name = _local_name(child.tag)
+            if name == 'id':
+                revision['revid'] = int(child.text)
+            elif name == 'parentid':
+                revision['parentid'] = int(child.text)
+            elif name == 'timestamp':
+                revision['timestamp'] = child.text
+            elif name == 'comment' and child.text:
+                revision['comment'] = child.text
+            elif name == 'sha1' and child.text:
+                revision['sha1'] = child.text
+            elif name == 'contributor':
+                user = (_child_text(child, 'username') or
+                        _child_text(child, 'ip'))
+                if user:
+                    revision['user'] = user
+            elif name == 'text':
+                text = child.text or ''
+                revision['size'] = int(child.get('bytes', len(text)))
+        return revision
+
+    def iter_pages(self, namespaces=None):
+        """
+        Yields a DumpPage for every page in the dump.
+
+        Attrs:
+            namespaces: If given, only yield pages in these namespaces.
+        """
+        if namespaces is not None:
+            namespaces = set([int(ns) for ns in namespaces])
+
+        f = open_dump(self.path)
+        try:
+            page = None
+            latest_text = None
+            for event, elem in etree.iterparse(f, events=('start', 'end')):
+                name = _local_name(elem.tag)
+                if event == 'start':
+                    if name == 'page':
+                        page = DumpPage(None, None, None)
+                        latest_text = None
+                    continue
+
+                if name == 'siteinfo':
+                    self._read_siteinfo(elem)
+                    elem.clear()
+                elif name == 'revision' and page is not None:
+                    page.revisions.append(self._read_revision(elem))
+                    # Revisions run oldest to newest, so the last text we
+                    # see is the current one.
+                    latest_text = _child_text(elem, 'text') or ''
+                    # Drop the text as soon as we've seen it.
+                    elem.clear()
+                elif name == 'page' and page is not None:
+                    page.title = _child_text(elem, 'title')
+                    page.pageid = int(_child_text(elem, 'id'))
+                    ns = _child_text(elem, 'ns')
+                    if ns is not None:
+                        page.namespace = int(ns)
+                    else:
+                        # Older dumps don't have <ns>.
+                        page.namespace = self._namespace_of(page.title)
+                    for child in elem:
+                        if _local_name(child.tag) == 'redirect':
+                            page.redirect_target = child.get('title')
+                    if latest_text:
+                        if page.redirect_target is None:
+                            match = _redirect_re.match(latest_text)
+                            if match:
+                                page.redirect_target = (
+                                    match.group(1).strip().replace('_', ' '))
+                        page.categories = self._categories_in(latest_text)
+                    page.revisions.reverse()
+
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+
+                    if namespaces is None or page.namespace in namespaces:
+                        yield page
+                    page = None
+                    latest_text = None
+        finally:
+            f.close()
+
+
+def iter_dump_pages(path, namespaces=None):
+    return DumpReader(path).iter_pages(namespaces)
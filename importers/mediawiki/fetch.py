@@ -0,0 +1,536 @@
+"""
+An event-driven fetch engine that keeps many HTTP requests in flight
+from a single thread.
+
+Python 2 has no asyncio, so this is built on asyncore's select loop.
+Requests are queued with a callback; the engine runs up to
+max_in_flight of them at once over non-blocking, keep-alive connections
+and calls each callback from the loop when its response arrives.
+Callbacks may queue more requests, which is how dependent requests (a
+page, then its revisions, then their renderings) are chained.
+
+Like HTTPTransport, the engine asks for gzip responses, sends maxlag with
+API requests and retries requests the server turns away after the delay
+it asks for.
+"""
+import asyncore
+import collections
+import errno
+import heapq
+import itertools
+import json
+import socket
+import ssl
+import time
+import traceback
+import zlib
+from urlparse import urlsplit
+
+from transport import (USER_AGENT, MAX_REDIRECTS, REDIRECT_STATUSES,
+                       APIError, HTTPError, _encode_params, _is_retryable,
+                       _redirect, _retry_after)
+
+
+class FetchTimeout(Exception):
+    pass
+
+
+class _ResponseParser(object):
+    """
+    Incrementally parses an HTTP/1.x response.
+    """
+    def __init__(self, method):
+        self.method = method
+        self.buffer = ''
+        self.state = 'headers'
+        self.status = None
+        self.version = None
+        self.headers = {}
+        self.body = []
+        self.remaining = None
+        self.done = False
+
+    def feed(self, data):
+        self.buffer += data
+        while not self.done and self.buffer:
+            if not self._step():
+                break
+
+    def eof(self):
+        """
+        Called when the server closes the connection.  Returns True if that
+        completes the response.
+        """
+        if self.state == 'body' and self.remaining is None:
+            self.done = True
+        return self.done
+
+    def data(self):
+        return ''.join(self.body)
+
+    def _step(self):
+        if self.state == 'headers':
+            end = self.buffer.find('\r\n\r\n')
+            if end == -1:
+                return False
+            head, self.buffer = self.buffer[:end], self.buffer[end + 4:]
+            lines = head.split('\r\n')
+            parts = lines[0].split(' ', 2)
+            self.version = parts[0]
+            self.status = int(parts[1])
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    self.headers[name.strip().lower()] = value.strip()
+            if (self.method == 'HEAD' or self.status in (204, 304) or
+                    100 <= self.status < 200):
+                self.done = True
+            elif 'chunked' in self.headers.get('transfer-encoding', ''):
+                self.state = 'chunk_size'
+            elif 'content-length' in self.headers:
+                self.remaining = int(self.headers['content-length'])
+                self.state = 'body'
+                self.done = (self.remaining == 0)
+            else:
+                # Body runs until the server closes the connection.
+                self.state = 'body'
+            return True
+
+        if self.state == 'body':
+            if self.remaining is None:
+                self.body.append(self.buffer)
+                self.buffer = ''
+                return False
+            chunk = self.buffer[:self.remaining]
+            self.buffer = self.buffer[self.remaining:]
+            self.body.append(chunk)
+            self.remaining -= len(chunk)
+            self.done = (self.remaining == 0)
+            return not self.done
+
+        if self.state == 'chunk_size':
+            end = self.buffer.find('\r\n')
+            if end == -1:
+                return False
+            size = int(self.buffer[:end].split(';')[0], 16)
+            self.buffer = self.buffer[end + 2:]
+            if size == 0:
+                self.state = 'trailer'
+            else:
+                self.remaining = size
+                self.state = 'chunk_data'
+            return True
+
+        if self.state == 'chunk_data':
+            if len(self.buffer) < self.remaining + 2:
+                return False
+            self.body.append(self.buffer[:self.remaining])
+            self.buffer = self.buffer[self.remaining + 2:]
+            self.state = 'chunk_size'
+            return True
+
+        if self.state == 'trailer':
+            end = self.buffer.find('\r\n')
+            if end == -1:
+                return False
+            line, self.buffer = self.buffer[:end], self.buffer[end + 2:]
+            if not line:
+                self.done = True
+            return True
+
+    def keep_alive(self):
+        if self.state == 'body' and self.remaining is None:
+            return False
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+class _Fetch(object):
+    def __init__(self, method, url, body, headers, callback, errback,
+                 is_api):
+        self.method = method
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.callback = callback
+        self.errback = errback
+        self.is_api = is_api
+        self.attempts = 0
+        self.redirects = 0
+
+
+class _Connection(asyncore.dispatcher):
+    def __init__(self, engine, scheme, host, port):
+        asyncore.dispatcher.__init__(self, map=engine._map)
+        self.engine = engine
+        self.key = (scheme, host, port)
+        self.host = host
+        self.use_ssl = (scheme == 'https')
+        self.handshaking = False
+        self.outgoing = ''
+        self.fetch = None
+        self.parser = None
+        self.reused = False
+        self.last_active = time.time()
+        self.connect_error = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((host, port))
+        except socket.error as e:
+            # e.g. the name didn't resolve.  Failed once the request is
+            # attached, so it's retried like any other failure.
+            self.connect_error = e
+
+    def start(self, fetch, reused):
+        split = urlsplit(fetch.url)
+        path = split.path or '/'
+        if split.query:
+            path += '?' + split.query
+        lines = ['%s %s HTTP/1.1' % (fetch.method, path),
+                 'Host: %s' % split.netloc]
+        for name, value in fetch.headers.iteritems():
+            lines.append('%s: %s' % (name, value))
+        if fetch.body is not None:
+            lines.append('Content-Length: %d' % len(fetch.body))
+        self.outgoing = '\r\n'.join(lines) + '\r\n\r\n' + (fetch.body or '')
+        self.fetch = fetch
+        self.parser = _ResponseParser(fetch.method)
+        self.reused = reused
+        self.last_active = time.time()
+
+    def handle_connect(self):
+        if self.use_ssl:
+            context = ssl.create_default_context()
+            self.socket = context.wrap_socket(
+                self.socket, server_hostname=self.host,
+                do_handshake_on_connect=False)
+            self.handshaking = True
+            self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        self.handshaking = False
+
+    def writable(self):
+        return (not self.connected or self.handshaking or
+                bool(self.outgoing))
+
+    def readable(self):
+        return True
+
+    def handle_write(self):
+        if self.handshaking:
+            self._handshake()
+            return
+        try:
+            sent = self.send(self.outgoing)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        self.outgoing = self.outgoing[sent:]
+        self.engine.bytes_sent += sent
+        self.last_active = time.time()
+
+    def handle_read(self):
+        if self.handshaking:
+            self._handshake()
+            return
+        try:
+            data = self.recv(65536)
+            while self.use_ssl and self.socket.pending():
+                data += self.socket.recv(65536)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        if not data:
+            return  # recv() has already called handle_close()
+        self.last_active = time.time()
+        self.engine.bytes_received += len(data)
+        if self.parser is None:
+            # Idle connections shouldn't be sent anything.
+            self.close()
+            return
+        self.parser.feed(data)
+        if self.parser.done:
+            self._finish()
+
+    def _finish(self):
+        fetch, parser = self.fetch, self.parser
+        self.fetch = None
+        self.parser = None
+        self.engine._finished(self, fetch, parser)
+
+    def handle_close(self):
+        if self.parser is not None and self.parser.eof():
+            self._finish()
+        elif self.fetch is not None:
+            self.fail(socket.error(errno.ECONNRESET,
+                                   'Connection closed by server'))
+        else:
+            self.close()
+
+    def handle_error(self):
+        if self.fetch is not None:
+            self.fail(socket.error(traceback.format_exc().splitlines()[-1]))
+        else:
+            self.close()
+
+    def fail(self, exc):
+        fetch = self.fetch
+        got_response = (self.parser is not None and
+                        self.parser.status is not None)
+        self.fetch = None
+        self.parser = None
+        self.engine._failed(self, fetch, exc, got_response)
+
+    def close(self):
+        self.engine._forget(self)
+        asyncore.dispatcher.close(self)
+
+
+class FetchEngine(object):
+    """
+    Attrs:
+        max_in_flight: Most requests to have running at once.
+        timeout: Seconds a request may go without any progress.
+        maxlag: Sent with every API request.
+        max_retries: Times to retry a request that failed or was turned
+            away before giving up on it.
+    """
+    def __init__(self, max_in_flight=100, timeout=60, maxlag=None,
+                 max_retries=5):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.maxlag = maxlag
+        self.max_retries = max_retries
+        self._map = {}
+        self._queue = collections.deque()
+        self._idle = {}
+        self._busy = set()
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def fetch(self, method, url, callback, body=None, headers=None,
+              errback=None):
+        """
+        Queues a request.  callback(data) is called with the (decoded)
+        response body; errback(exception), if given, is called if the
+        request fails for good.
+        """
+        self._queue_fetch(method, url, body, headers, callback, errback,
+                          is_api=False)
+
+    def api_request(self, api_url, params, callback, errback=None):
+        """
+        Queues a MediaWiki API request.  callback(response) is called with
+        the decoded JSON response.
+        """
+        params = dict(params)
+        params['format'] = 'json'
+        if self.maxlag is not None:
+            params['maxlag'] = self.maxlag
+        self._queue_fetch(
+            'POST', api_url, _encode_params(params),
+            {'Content-Type': 'application/x-www-form-urlencoded'},
+            callback, errback, is_api=True)
+
+    def call_later(self, delay, func):
+        heapq.heappush(self._timers,
+                       (time.time() + delay, self._timer_ids.next(), func))
+
+    def _queue_fetch(self, method, url, body, headers, callback, errback,
+                     is_api):
+        all_headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        all_headers.update(headers or {})
+        self._queue.append(_Fetch(method, url, body, all_headers, callback,
+                                  errback, is_api))
+
+    def outstanding(self):
+        """
+        Number of requests queued, running or waiting to be retried.
+        """
+        return self.in_flight + len(self._queue) + len(self._timers)
+
+    def _start(self, fetch):
+        split = urlsplit(fetch.url)
+        scheme = split.scheme or 'http'
+        port = split.port or (443 if scheme == 'https' else 80)
+        key = (scheme, split.hostname, port)
+        conn = None
+        idle = self._idle.get(key, [])
+        while idle and conn is None:
+            candidate = idle.pop()
+            if candidate.connected:
+                conn = candidate
+        reused = conn is not None
+        if reused:
+            self.connections_reused += 1
+        else:
+            conn = _Connection(self, scheme, split.hostname, port)
+            self.connections_opened += 1
+        self._busy.add(conn)
+        self.in_flight += 1
+        conn.start(fetch, reused)
+        if conn.connect_error is not None:
+            conn.fail(conn.connect_error)
+
+    def _forget(self, conn):
+        self._busy.discard(conn)
+        idle = self._idle.get(conn.key)
+        if idle and conn in idle:
+            idle.remove(conn)
+
+    def _release(self, conn, keep_alive):
+        self.in_flight -= 1
+        self._busy.discard(conn)
+        if keep_alive and conn.connected:
+            self._idle.setdefault(conn.key, []).append(conn)
+        else:
+            conn.close()
+
+    def _retry(self, fetch, delay):
+        fetch.attempts += 1
+        self.retries += 1
+        self.call_later(delay, lambda: self._queue.append(fetch))
+
+    def _give_up(self, fetch, exc):
+        self.failures += 1
+        if fetch.errback is not None:
+            self._call(fetch.errback, exc)
+        else:
+            print "Giving up on %s: %s" % (fetch.url, exc)
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _finished(self, conn, fetch, parser):
+        self.requests += 1
+        self._release(conn, parser.keep_alive())
+        data = parser.data()
+        if parser.headers.get('content-encoding', '').lower() == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+        if (parser.status in REDIRECT_STATUSES and
+                fetch.redirects < MAX_REDIRECTS):
+            redirect = _redirect(fetch.method, fetch.url, fetch.body,
+                                 parser.status, parser.headers)
+            if redirect is not None:
+                fetch.method, fetch.url, fetch.body = redirect
+                fetch.redirects += 1
+                self._queue.append(fetch)
+                return
+
+        if parser.status >= 300:
+            if (_is_retryable(parser.status) and
+                    fetch.attempts < self.max_retries):
+                self._retry(fetch, _retry_after(parser.headers,
+                                                fetch.attempts))
+            else:
+                self._give_up(fetch, HTTPError(fetch.url, parser.status, '',
+                                               parser.headers))
+            return
+
+        if not fetch.is_api:
+            self._call(fetch.callback, data)
+            return
+
+        try:
+            response = json.loads(data)
+        except ValueError as e:
+            self._give_up(fetch, e)
+            return
+        error = response.get('error')
+        if error and error.get('code') == 'maxlag':
+            if fetch.attempts < self.max_retries:
+                self._retry(fetch, _retry_after(parser.headers,
+                                                fetch.attempts))
+                return
+        if error:
+            self._give_up(fetch, APIError(error.get('code'),
+                                          error.get('info')))
+            return
+        self._call(fetch.callback, response)
+
+    def _failed(self, conn, fetch, exc, got_response):
+        self._release(conn, keep_alive=False)
+        if conn.reused and not got_response:
+            # The server closed a kept-alive connection before we used it.
+            # That's not the request's fault, so try again right away.
+            self._queue.append(fetch)
+        elif fetch.attempts < self.max_retries:
+            self._retry(fetch, min(2 ** fetch.attempts, 60))
+        else:
+            self._give_up(fetch, exc)
+
+    def _fire_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, timer_id, func = heapq.heappop(self._timers)
+            self._call(func)
+
+    def _check_timeouts(self):
+        now = time.time()
+        for conn in list(self._busy):
+            if now - conn.last_active > self.timeout:
+                conn.fail(FetchTimeout('No response from %s in %d seconds' %
+                                       (conn.host, self.timeout)))
+
+    def run(self, source=None, start=None):
+        """
+        Runs the loop until every request is done.
+
+        If an iterator `source` and a function `start` are given, start(item)
+        is called for the items in `source` one at a time, whenever fewer
+        than max_in_flight requests are outstanding.  That way items are
+        only pulled in as fast as their requests complete.
+        """
+        while True:
+            self._fire_timers()
+            while source is not None and self.outstanding() < self.max_in_flight:
+                try:
+                    item = source.next()
+                except StopIteration:
+                    source = None
+                    break
+                self._call(start, item)
+            while self._queue and self.in_flight < self.max_in_flight:
+                self._start(self._queue.popleft())
+
+            if source is None and not self.outstanding():
+                break
+            if self._map:
+                asyncore.loop(timeout=0.1, map=self._map, count=1)
+            else:
+                time.sleep(0.1)
+            self._check_timeouts()
+        self.close()
+
+    def close(self):
+        for conn in self._map.values():
+            conn.close()
+        self._idle = {}
+
+    def stats(self):
+        return ("%d HTTP requests, %d connections opened, %d reused, "
+                "%d bytes received, %d bytes sent, %d retries, %d failed" % (
+                    self.requests, self.connections_opened,
+                    self.connections_reused, self.bytes_received,
+                    self.bytes_sent, self.retries, self.failures))
@@ -0,0 +1,135 @@
+"""
+Policies for thinning out the revision history that gets imported.
+
+Each policy takes revision dictionaries, newest first (as the API and
+DumpReader give them), and yields the ones to keep.  The newest revision
+is always kept, since it's the page itself.  Policies are lazy, so when
+one stops early (e.g. after the last N revisions) the rest of the history
+isn't fetched at all.
+
+Policies are given on the command line as a comma-separated list of
+name:value pairs, e.g. "last:50,since:2010-01-01".  All of them apply,
+always in the order of POLICY_ORDER (last, since, per-author, size-delta)
+whatever order they're given in, since e.g. per-author keeps different
+revisions depending on whether last has already dropped some.
+"""
+import datetime
+import itertools
+
+from dateutil.parser import parse as date_parse
+from dateutil.tz import tzutc
+
+
+def last(revisions, n):
+    """
+    Keeps the newest n revisions.
+    """
+    return itertools.islice(revisions, max(n, 1))
+
+
+def since(revisions, date):
+    """
+    Keeps revisions made on or after date.
+    """
+    for i, revision in enumerate(revisions):
+        if i > 0 and date_parse(revision['timestamp']) < date:
+            break
+        yield revision
+
+
+def per_author(revisions, window):
+    """
+    Keeps at most one revision per author in any window seconds, the newest.
+    """
+    window = datetime.timedelta(seconds=window)
+    # Author -> time of their oldest revision kept so far.
+    kept = {}
+    for i, revision in enumerate(revisions):
+        author = revision.get('user')
+        when = date_parse(revision['timestamp'])
+        newer = kept.get(author)
+        if i == 0 or newer is None or newer - when >= window:
+            kept[author] = when
+            yield revision
+
+
+def with_parent_sizes(revisions):
+    """
+    Sets each revision's parentsize to the size of the revision before it,
+    or 0 for the oldest.
+    """
+    revisions = iter(revisions)
+    try:
+        revision = revisions.next()
+    except StopIteration:
+        return
+    for older in itertools.chain(revisions, [None]):
+        revision.setdefault('parentsize',
+                            older.get('size', 0) if older is not None else 0)
+        yield revision
+        revision = older
+
+
+def size_delta(revisions, threshold):
+    """
+    Keeps revisions that changed the page's size by more than threshold
+    bytes.  Revisions need their parentsize, which thin() sets before
+    any policy drops revisions.
+    """
+    for i, revision in enumerate(revisions):
+        delta = revision.get('size', 0) - revision.get('parentsize', 0)
+        if i == 0 or abs(delta) > threshold:
+            yield revision
+
+
+def _parse_date(value):
+    date = date_parse(value)
+    if date.tzinfo is None:
+        # Revision timestamps are in UTC.
+        date = date.replace(tzinfo=tzutc())
+    return date
+
+
+# Name -> (policy, function to parse its value).
+POLICIES = {
+    'last': (last, int),
+    'since': (since, _parse_date),
+    'per-author': (per_author, int),
+    'size-delta': (size_delta, int),
+}
+
+
+# The order policies are applied in.
+POLICY_ORDER = [last, since, per_author, size_delta]
+
+
+def parse_policies(spec):
+    """
+    Turns a policy list like "last:50,size-delta:100" into a list of
+    (policy, value) pairs.  Raises ValueError if it can't.
+    """
+    policies = []
+    for part in spec.split(','):
+        name, sep, value = part.strip().partition(':')
+        if name not in POLICIES or not sep:
+            raise ValueError('Unknown history policy %r.  Use one of: %s' % (
+                part, ', '.join('%s:VALUE' % n for n in sorted(POLICIES))))
+        policy, parse_value = POLICIES[name]
+        policies.append((policy, parse_value(value)))
+    return policies
+
+
+def thin(revisions, policies):
+    """
+    Applies each of the (policy, value) pairs to the revisions, in the
+    order of POLICY_ORDER.
+    """
+    policies = sorted(policies or [],
+                      key=lambda (policy, value): POLICY_ORDER.index(policy))
+    if any(policy is size_delta for policy, value in policies):
+        # From the whole history, so that earlier policies dropping
+        # revisions doesn't change what each one's size changed by.
+        revisions = with_parent_sizes(revisions)
+    for policy, value in policies:
+        revisions = policy(revisions, value)
+    return revisions
@@ -0,0 +1,192 @@
+"""
+A durable record of how far an import has got.
+
+The journal is a SQLite file that notes when each stage of the import,
+each page and each historic revision is finished, and which pages
+failed.  If the import is stopped, running it again with the same
+journal skips everything already done.
+"""
+import sqlite3
+import threading
+import time
+
+
+STARTED = 'started'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class ImportJournal(object):
+    """
+    Attrs:
+        path: Path to the SQLite journal file.  Created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                         'name TEXT PRIMARY KEY, '
+                         'value TEXT)')
+            conn.execute('CREATE TABLE IF NOT EXISTS stages ('
+                         'name TEXT PRIMARY KEY, '
+                         'finished REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS pages ('
+                         'title TEXT PRIMARY KEY, '
+                         'status TEXT NOT NULL, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'error TEXT, '
+                         'revid INTEGER, '
+                         'updated REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pages_status '
+                         'ON pages (status)')
+            conn.execute('CREATE TABLE IF NOT EXISTS revisions ('
+                         'title TEXT NOT NULL, '
+                         'revid INTEGER NOT NULL, '
+                         'PRIMARY KEY (title, revid))')
+            conn.execute('CREATE TABLE IF NOT EXISTS mapdata ('
+                         'pagename TEXT NOT NULL, '
+                         'lat TEXT NOT NULL, '
+                         'lon TEXT NOT NULL, '
+                         'added INTEGER NOT NULL DEFAULT 0, '
+                         'PRIMARY KEY (pagename, lat, lon))')
+
+    def set_origin(self, api_url):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO meta (name, value) '
+                         'VALUES (?, ?)', ('api_url', api_url))
+
+    def origin(self):
+        row = self._connection().execute(
+            'SELECT value FROM meta WHERE name = ?', ('api_url',)).fetchone()
+        return row and row[0]
+
+    def is_empty(self):
+        conn = self._connection()
+        return not (
+            conn.execute('SELECT 1 FROM stages LIMIT 1').fetchone() or
+            conn.execute('SELECT 1 FROM pages LIMIT 1').fetchone())
+
+    def finish_stage(self, name):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO stages (name, finished) '
+                         'VALUES (?, ?)', (name, time.time()))
+
+    def stage_finished(self, name):
+        return self._connection().execute(
+            'SELECT 1 FROM stages WHERE name = ?', (name,)).fetchone() is not None
+
+    def _set_page(self, title, status, error=None, revid=None, attempt=0):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO pages (title, status, updated) '
+                         'VALUES (?, ?, ?)', (title, status, time.time()))
+            conn.execute('UPDATE pages SET status = ?, error = ?, '
+                         'revid = ?, attempts = attempts + ?, updated = ? '
+                         'WHERE title = ?',
+                         (status, error, revid, attempt, time.time(), title))
+
+    def start_page(self, title):
+        self._set_page(title, STARTED, attempt=1)
+
+    def finish_page(self, title, revid=None):
+        """
+        Attrs:
+            title: MediaWiki title of the page.
+            revid: The page's latest revision that was imported.
+        """
+        self._set_page(title, DONE, revid=revid)
+
+    def fail_page(self, title, error):
+        if isinstance(error, str):
+            error = error.decode('utf-8', 'replace')
+        self._set_page(title, FAILED, error=error)
+
+    def page_status(self, title):
+        """
+        Returns STARTED, DONE or FAILED, or None if the page hasn't been
+        started.
+        """
+        row = self._connection().execute(
+            'SELECT status FROM pages WHERE title = ?', (title,)).fetchone()
+        return row and row[0]
+
+    def done_pages(self):
+        """
+        Returns a dictionary of title -> latest revision imported for the
+        pages that are done.
+        """
+        return dict(self._connection().execute(
+            'SELECT title, revid FROM pages WHERE status = ?', (DONE,)))
+
+    def finish_revision(self, title, revid):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO revisions (title, revid) '
+                         'VALUES (?, ?)', (title, revid))
+
+    def done_revisions(self, title):
+        return set(row[0] for row in self._connection().execute(
+            'SELECT revid FROM revisions WHERE title = ?', (title,)))
+
+    def add_mapdata(self, item):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO mapdata (pagename, lat, lon) '
+                         'VALUES (?, ?, ?)',
+                         (item['pagename'], item['lat'], item['lon']))
+
+    def mapdata(self):
+        """
+        Returns the map data that hasn't been added to its page yet.
+        """
+        return [{'pagename': row[0], 'lat': row[1], 'lon': row[2]}
+                for row in self._connection().execute(
+                    'SELECT pagename, lat, lon FROM mapdata WHERE added = 0')]
+
+    def finish_mapdata(self, item):
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE mapdata SET added = 1 WHERE pagename = ? '
+                         'AND lat = ? AND lon = ?',
+                         (item['pagename'], item['lat'], item['lon']))
+
+    def counts(self):
+        """
+        Returns a dictionary of page status -> number of pages.
+        """
+        return dict(self._connection().execute(
+            'SELECT status, COUNT(*) FROM pages GROUP BY status'))
+
+    def num_revisions(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM revisions').fetchone()[0]
+
+    def stages(self):
+        """
+        Returns (stage name, time finished) for the finished stages.
+        """
+        return list(self._connection().execute(
+            'SELECT name, finished FROM stages ORDER BY finished'))
+
+    def failures(self):
+        """
+        Returns (title, attempts, error) for pages that failed.
+        """
+        return list(self._connection().execute(
+            'SELECT title, attempts, error FROM pages WHERE status = ? '
+            'ORDER BY title', (FAILED,)))
@@ -1,5 +1,6 @@
 # coding=utf-8
 import os
+import signal
 import site
 import sys
 
@@ -8,7 +9,14 @@ if "DJANGO_SETTINGS_MODULE" not in os.environ:
     sys.exit(1)
 
 import time
+import collections
 import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import threading
+import traceback
 import html5lib
 from lxml import etree
 
@@ -19,13 +27,25 @@ from urlparse import urljoin, urlsplit, urlparse, parse_qs
 import urllib
 import re
 from dateutil.parser import parse as date_parse
-from mediawikitools import *
 
 from django.db import transaction
 from django.db import IntegrityError, connection
 from pages.plugins import unquote_url
 from django.db.utils import IntegrityError
 
+from cache import APICache, request_key
+from concurrency import SingleFlight, ConcurrencyController
+from mirror import MirrorStore
+from dump import iter_dump_pages
+from fetch import FetchEngine
+import history
+from journal import ImportJournal
+from replay import RecordingArchive
+import retry
+from sharding import Shard
+from transport import HTTPTransport
+import watchdog
+
 _maps_installed = False
 try:
     import maps.models
@@ -34,11 +54,52 @@ except ImportError:
     pass
 
 
-site = None
+API_URL = None
 SCRIPT_PATH = None
+transport = HTTPTransport()
+concurrency_controller = None
+api_cache = None
+mirror_store = None
+dump_path = None
+recorder = None
+journal = None
+# This process's Shard, in a sharded import.
+shard = None
+# Pool of processes that transform the HTML of old revisions, or None.
+transform_pool = None
+# Map data found by a transform process, to be sent back to the importer.
+_transform_mapdata = None
+# Times to retry a page that fails with a transient error.
+page_retries = 3
+# retry.DeadLetterFile listing the pages that couldn't be imported, or None.
+dead_letter_file = None
+# Stage -> seconds before the watchdog gives up on a page stuck in it.
+stage_deadlines = watchdog.DEADLINES
+# (policy, value) pairs from history.parse_policies().
+history_policies = None
+# MediaWiki title -> latest revision imported, saved for incremental imports.
+imported_revisions = {}
+# Image title -> imageinfo, shared by every page we import.
+_image_info_cache = {}
+_image_info_lock = threading.Lock()
+# Coalesce identical requests made by several workers at once.
+_api_calls = SingleFlight()
+_image_info_calls = SingleFlight()
+_template_page_calls = SingleFlight()
+# Image titles whose info the mirror has already asked for.
+_image_infos_requested = set()
+# Image URLs the mirror has already asked for.
+_files_requested = set()
+# Username -> LocalWiki user id, loaded once and shared by every revision
+# we save.
+_user_ids = None
+_user_ids_lock = threading.Lock()
 include_pages_to_create = []
 mapdata_objects_to_create = []
 
+# Main, Talk, User, User talk, Category, Category talk
+IMPORT_NAMESPACES = ['0', '1', '2', '3', '14', '15']
+
 
 def guess_api_endpoint(url):
     if url.endswith('api.php'):
@@ -60,39 +121,419 @@ def set_script_path(path):
     SCRIPT_PATH = path
 
 
-def process_concurrently(work_items, work_func, num_workers=1, name='items'):
+def set_transport(t):
+    global transport
+    transport = t
+
+
+def set_concurrency_controller(controller):
+    global concurrency_controller
+    concurrency_controller = controller
+
+
+def set_api_cache(cache):
+    global api_cache
+    api_cache = cache
+
+
+def set_mirror_store(store):
+    global mirror_store
+    mirror_store = store
+
+
+def set_dump_path(path):
+    global dump_path
+    dump_path = path
+
+
+def set_page_priority(func):
+    """
+    Sets the function used to order pages for import.  It's given a
+    MWPage and returns a number; pages with higher numbers go first.
+    None imports pages in the order they're listed.
+    """
+    global page_priority
+    page_priority = func
+
+
+def set_history_policies(policies):
+    global history_policies
+    history_policies = policies
+
+
+def set_recorder(archive):
+    global recorder
+    recorder = archive
+
+
+def set_journal(j):
+    global journal
+    journal = j
+
+
+def set_shard(s):
+    global shard
+    shard = s
+
+
+def set_transform_pool(pool):
+    global transform_pool
+    transform_pool = pool
+
+
+def set_page_retries(n):
+    global page_retries
+    page_retries = n
+
+
+def set_dead_letter_file(f):
+    global dead_letter_file
+    dead_letter_file = f
+
+
+def set_stage_deadlines(deadlines):
+    global stage_deadlines
+    stage_deadlines = deadlines
+
+
+def query_api(params):
+    """
+    Sends a request to the MediaWiki API and returns the decoded response.
+    Responses are served from, and stored in, the API cache if one is set.
+
+    Only the first batch of results is returned; use iter_query() to walk
+    through the rest.
+    """
+    response = None
+    if api_cache is not None:
+        response = api_cache.get(params)
+
+    def _send():
+        response = transport.api_request(API_URL, params)
+        if api_cache is not None:
+            api_cache.set(params, response)
+        return response
+
+    if response is None:
+        with watchdog.stage('api'):
+            response = _api_calls.do(request_key(params), _send)
+    if recorder is not None:
+        recorder.record_api(params, response)
+    return response
+
+
+def iter_query(params):
+    """
+    Sends a query and follows its continuations, yielding each batch of
+    results as it arrives.
+    """
+    params = dict(params)
+    # Ask for the new-style continuation.  Older MediaWikis ignore this
+    # and send 'query-continue' instead.
+    params.setdefault('continue', '')
+    continue_params = {}
+    while continue_params is not None:
+        request_params = dict(params)
+        request_params.update(continue_params)
+        response = query_api(request_params)
+        yield response
+        continue_params = _continue_params(response, request_params)
+
+
+def _continue_params(response, request_params=None):
+    """
+    Returns the parameters that fetch the batch after this response, or
+    None if this was the last batch.
+
+    With the old-style continuation, a generator query's props (e.g. the
+    categories of the pages generated) are followed to the end before the
+    generator moves on to the next pages, or the props of this batch would
+    be cut short.  request_params are the parameters that got the response.
+    """
+    if 'continue' in response:
+        return response['continue']
+    if 'query-continue' in response:
+        request_params = request_params or {}
+        modules = dict(response['query-continue'])
+        generator = request_params.get('generator')
+        generator_params = modules.pop(generator, None) if generator else None
+        continue_params = {}
+        for module_params in modules.values():
+            continue_params.update(module_params)
+        if generator_params is None:
+            return continue_params
+        if not continue_params:
+            return generator_params
+        # Keep the generator where it was for this batch.
+        for name in generator_params:
+            if name in request_params:
+                continue_params[name] = request_params[name]
+        return continue_params
+    return None
+
+
+def fetch_api(engine, params, callback):
+    """
+    Like query_api(), but sends the request through a FetchEngine.
+    callback(response) is called once the response is in.  Requires the
+    API cache.
+    """
+    response = api_cache.get(params)
+    if response is not None:
+        if recorder is not None:
+            recorder.record_api(params, response)
+        callback(response)
+        return
+
+    def _store(response):
+        api_cache.set(params, response)
+        if recorder is not None:
+            recorder.record_api(params, response)
+        callback(response)
+
+    engine.api_request(API_URL, params, _store)
+
+
+def fetch_query(engine, params, callback, continue_params=None):
+    """
+    Like iter_query(), but through a FetchEngine.  callback(response) is
+    called for each batch of results, in order.
+    """
+    params = dict(params)
+    params.setdefault('continue', '')
+    request_params = dict(params)
+    request_params.update(continue_params or {})
+
+    def _got(response):
+        callback(response)
+        next_params = _continue_params(response, request_params)
+        if next_params is not None:
+            fetch_query(engine, params, callback, next_params)
+
+    fetch_api(engine, request_params, _got)
+
+
+def longest_first(items, priority, small_share=4):
+    """
+    Orders items by priority, highest first, so that long-running items
+    aren't picked up late and left running after everything else is done.
+
+    Every small_share'th item is taken from the low end instead, so small
+    items keep getting done along the way.
+    """
+    items = sorted(items, key=priority, reverse=True)
+    ordered = []
+    low, high = len(items) - 1, 0
+    while high <= low:
+        if small_share and len(ordered) % small_share == small_share - 1:
+            ordered.append(items[low])
+            low -= 1
+        else:
+            ordered.append(items[high])
+            high += 1
+    return ordered
+
+
+def collect_heaviest(items, priority, n, found):
+    """
+    Yields the items, and once they've all been yielded, adds the n with
+    the highest priority to the list found, in the order they came.  Only
+    those n are held in memory.
+    """
+    heap = []
+    for i, item in enumerate(items):
+        entry = (priority(item), -i, item)
+        if len(heap) < n:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heappushpop(heap, entry)
+        yield item
+    found.extend(item for p, i, item in sorted(heap, key=lambda e: -e[1]))
+
+
+def _to_str(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def process_concurrently(work_items, work_func, num_workers=1, name='items',
+                         controller=None, priority=None, backlog=100,
+                         retries=0, dead_letter=None, item_key=repr,
+                         deadlines=None, before_retry=None):
     """ Apply a function to all work items using a number of concurrent workers
+
+    work_items may be any iterable, including a generator.  Workers start on
+    the first items while the rest are still being produced, and only a
+    bounded number of items are held in memory at once.
+
+    If a ConcurrencyController is given, it decides how many of the workers
+    may work at once, and num_workers is ignored.
+
+    If a priority function is given, all the work items are read first and
+    handed out longest_first() by their priority.
+
+    At most backlog items per worker are read ahead of the workers.
+
+    Items that fail with a transient error (see retry.py) are tried up to
+    retries more times, after a backoff, with before_retry(item), if given,
+    called first to clean up after the failed attempt.  Items that still
+    fail, or fail with any other error, are added to the dead_letter file,
+    if given, under their item_key().
+
+    If deadlines for the stages of the work are given, a Watchdog gives up
+    on items that get stuck in a stage for longer (see watchdog.py).  They
+    count as failing with a transient error, and a new worker takes the
+    stuck one's place.
+
+    Returns:
+        List of the item_key()s of the items that failed for good.
     """
     from Queue import Queue
-    from threading import Thread
-    import traceback
-
-    q = Queue()
-    for item in work_items:
-        q.put(item)
+    from threading import Thread, Lock, Timer
 
-    num_items = q.qsize()
+    if priority is not None:
+        work_items = longest_first(work_items, priority)
+    if controller is not None:
+        num_workers = controller.max_workers
+    q = Queue(maxsize=num_workers * backlog)
+    try:
+        num_items = len(work_items)
+    except TypeError:
+        num_items = None  # Don't know until the generator runs out.
+    counts = {'done': 0}
+    counts_lock = Lock()
+    failures = []
+
+    def requeue(item, attempt):
+        q.put((item, attempt))
+        # Only now, so that q.join() doesn't return while we wait.
+        q.task_done()
+
+    def failed(item, attempt, error):
+        """
+        Returns True if the item will be retried.
+        """
+        key = item_key(item)
+        transient = retry.is_transient(error)
+        if retry.is_database_error(error):
+            connection.close()  # Reconnect for the next item.
+        if transient and attempt < retries:
+            delay = retry.backoff(attempt)
+            print "Retrying %s in %.1f seconds (%d of %d retries)" % (
+                _to_str(key), delay, attempt + 1, retries)
+            t = Timer(delay, requeue, [item, attempt + 1])
+            t.daemon = True
+            t.start()
+            return True
+        print "Unable to process %s" % _to_str(key)
+        with counts_lock:
+            failures.append(key)
+        if dead_letter is not None:
+            dead_letter.add(key, retry.describe_error(error), attempt + 1,
+                            transient)
+        return False
+
+    def finished():
+        with counts_lock:
+            counts['done'] += 1
+            done = counts['done']
+        if num_items:
+            progress = 100 * done / num_items
+            print "%d %s left to process (%d%% done)" % (
+                num_items - done, name, progress)
+        else:
+            print "%d %s processed" % (done, name)
+        q.task_done()
 
     def worker():
         while True:
-            items_left = q.qsize()
-            progress = 100 * (num_items - items_left) / num_items
-            print "%d %s left to process (%d%% done)" % (items_left, name,
-                                                         progress)
-            item = q.get()
+            item, attempt = q.get()
+            if controller is not None:
+                controller.acquire()
+            if dog is not None:
+                dog.begin(item, attempt)
+            error = None
             try:
+                if attempt and before_retry is not None:
+                    before_retry(item)
                 work_func(item)
             except:
                 traceback.print_exc()
-                "Unable to process %s" % item
-            q.task_done()
+                error = sys.exc_info()[1]
+            if dog is not None and not dog.end():
+                # The watchdog gave up on us and has seen to the item.
+                return
+            if controller is not None:
+                controller.release()
+            if error is not None and failed(item, attempt, error):
+                continue
+            finished()
 
-    for i in range(num_workers):
+    def start_worker():
         t = Thread(target=worker)
         t.daemon = True
         t.start()
+
+    def stuck(item, attempt, error):
+        if controller is not None:
+            controller.release()
+        start_worker()
+        if not failed(item, attempt, error):
+            finished()
+
+    dog = None
+    if deadlines:
+        dog = watchdog.Watchdog(deadlines, stuck)
+        dog.start()
+    for i in range(num_workers):
+        start_worker()
+    for item in work_items:
+        q.put((item, 0))
     # wait for all workers to finish
     q.join()
+    if dog is not None:
+        dog.stop()
+    return failures
+
+
+def iter_concurrently(iter_func, args_list):
+    """
+    Runs iter_func(args) for each item in args_list in its own thread,
+    yielding the items each one produces as they arrive.
+    """
+    from Queue import Queue
+    from threading import Thread
+
+    results = Queue(maxsize=1000)
+    finished = object()
+
+    class Failure(object):
+        def __init__(self, exc_info):
+            self.exc_info = exc_info
+
+    def producer(args):
+        try:
+            for item in iter_func(args):
+                results.put(item)
+        except:
+            results.put(Failure(sys.exc_info()))
+        results.put(finished)
+
+    for args in args_list:
+        t = Thread(target=producer, args=(args,))
+        t.daemon = True
+        t.start()
+
+    running = len(args_list)
+    while running:
+        item = results.get()
+        if item is finished:
+            running -= 1
+        elif isinstance(item, Failure):
+            raise item.exc_info[0], item.exc_info[1], item.exc_info[2]
+        else:
+            yield item
 
 
 def get_robot_user():
@@ -107,31 +548,76 @@ def get_robot_user():
     return u
 
 
+def _load_user_ids():
+    global _user_ids
+    from django.contrib.auth.models import User
+
+    with _user_ids_lock:
+        if _user_ids is None:
+            _user_ids = dict(User.objects.values_list('username', 'id'))
+        return _user_ids
+
+
+def get_user_id(username):
+    """
+    Returns the id of the LocalWiki user with this username, or None if
+    there isn't one.  Users are loaded in one query the first time this
+    is called, rather than once per revision.
+    """
+    if not username:
+        return None
+    return _load_user_ids().get(username)
+
+
 def import_users():
     from django.contrib.auth.models import User
 
-    request = api.APIRequest(site, {
+    user_ids = _load_user_ids()
+    # Also catches the same truncated name coming up twice.
+    seen = set()
+    for response in iter_query({
         'action': 'query',
         'list': 'allusers',
-        'aulimit': 500,
-    })
-    for item in request.query()['query']['allusers']:
-        username = item['name'][:30]
-
-        # TODO: how do we get their email address here? I don't think
-        # it's available via the API. Maybe we'll have to fill in the
-        # users' emails in a separate step.
-        # We require users to have an email address, so we fill this in with a
-        # dummy value for now.
-        name_hash = hashlib.sha1(username.encode('utf-8')).hexdigest()
-        email = "%s@FIXME.localwiki.org" % name_hash
-
-        if User.objects.filter(username=username).exists():
-            continue
-
-        print "Importing user %s" % username.encode('utf-8')
-        u = User(username=username, email=email)
-        u.save()
+        'aulimit': 'max',
+    }):
+        # Each batch is checked against the users we already have and
+        # saved in one go.
+        new_users = []
+        for item in response.get('query', {}).get('allusers', []):
+            username = item['name'][:30]
+            if username in user_ids or username in seen:
+                continue
+            seen.add(username)
+
+            # TODO: how do we get their email address here? I don't think
+            # it's available via the API. Maybe we'll have to fill in the
+            # users' emails in a separate step.
+            # We require users to have an email address, so we fill this in
+            # with a dummy value for now.
+            name_hash = hashlib.sha1(username.encode('utf-8')).hexdigest()
+            email = "%s@FIXME.localwiki.org" % name_hash
+
+            print "Importing user %s" % username.encode('utf-8')
+            new_users.append(User(username=username, email=email))
+        saved = []
+        with transaction.commit_on_success():
+            for u in new_users:
+                # e.g. a name the database takes for an existing user's,
+                # such as one that only differs in case.
+                sid = transaction.savepoint()
+                try:
+                    u.save()
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    print "Skipping user %s: the name is taken" % (
+                        u.username.encode('utf-8'))
+                    continue
+                transaction.savepoint_commit(sid)
+                saved.append(u)
+        # Only once they're committed, so that users rolled back with
+        # their batch aren't taken to exist.
+        for u in saved:
+            user_ids[u.username] = u.id
 
 
 def fix_pagename(name):
@@ -152,56 +638,168 @@ def fix_pagename(name):
     return name
 
 
-def import_redirect(from_pagename):
-    # We create the Redirects here.  We don't try and port over the
-    # version information for the formerly-page-text-based redirects.
-    to_pagename = parse_redirect(from_pagename)
-    if to_pagename is None:
-        print "Error creating redirect: %s has no link" % from_pagename
-        return
-    to_pagename = fix_pagename(to_pagename)
+# Redirects saved per transaction.
+REDIRECT_BATCH_SIZE = 500
 
-    from pages.models import Page, slugify
-    from redirects.models import Redirect
 
-    u = get_robot_user()
+def get_redirect_targets():
+    """
+    Returns a dictionary mapping the title of every redirect page to the
+    title it points to.  Targets are listed in bulk, many redirects per
+    request.
+    """
+    if dump_path is not None:
+        # Pages read from a dump already know their redirect target.
+        return dict((mw_p.title, mw_p.redirect_target)
+                    for mw_p in get_redirects())
+
+    targets = {}
+    for namespace in IMPORT_NAMESPACES:
+        for response in iter_query({
+            'action': 'query',
+            'generator': 'allpages',
+            'gapnamespace': namespace,
+            'gapfilterredir': 'redirects',
+            'gaplimit': 'max',
+            'redirects': '',
+        }):
+            for redirect in response.get('query', {}).get('redirects', []):
+                targets[redirect['from']] = redirect['to']
+    return targets
+
+
+def resolve_redirects(targets):
+    """
+    Follows chains of redirects (double redirects) to their ends.
 
-    try:
-        to_page = Page.objects.get(slug=slugify(to_pagename))
-    except Page.DoesNotExist:
-        print "Error creating redirect: %s --> %s" % (
-            from_pagename.encode('utf-8'), to_pagename.encode('utf-8'))
-        print "  (page %s does not exist)" % to_pagename.encode('utf-8')
-        return
+    Attrs:
+        targets: Dictionary mapping redirect titles to the titles they
+            point to.
 
-    if slugify(from_pagename) == to_page.slug:
-        return
-    if not Redirect.objects.filter(source=slugify(from_pagename)):
-        r = Redirect(source=slugify(from_pagename), destination=to_page)
+    Returns:
+        Tuple of (resolved, looped).  resolved maps each redirect title to
+        the first title on its chain that isn't a redirect.  looped is the
+        set of redirect titles whose chains run in a circle.
+    """
+    resolved = {}
+    looped = set()
+    for source in targets:
+        chain = []
+        on_chain = set()
+        title = source
+        while (title in targets and title not in resolved and
+               title not in looped and title not in on_chain):
+            chain.append(title)
+            on_chain.add(title)
+            title = targets[title]
+
+        if title in on_chain or title in looped:
+            looped.update(chain)
+            continue
+        end = resolved.get(title, title)
+        for title in chain:
+            resolved[title] = end
+    return resolved, looped
+
+
+def _import_redirect_batch(redirects, user):
+    """
+    Creates Redirects for a list of (from_pagename, to_pagename) pairs.
+    The destination pages and existing redirects are looked up for the
+    whole batch at once.
+    """
+    from pages.models import Page, slugify
+    from redirects.models import Redirect
+
+    dest_slugs = set([slugify(to) for from_, to in redirects])
+    pages = dict((p.slug, p) for p in Page.objects.filter(
+        slug__in=dest_slugs))
+    # Redirects to existing redirects go where those do.
+    for r in Redirect.objects.filter(
+            source__in=dest_slugs - set(pages)).select_related('destination'):
+        pages[r.source] = r.destination
+    existing = set(Redirect.objects.filter(
+        source__in=[slugify(from_) for from_, to in redirects]
+    ).values_list('source', flat=True))
+
+    for from_pagename, to_pagename in redirects:
+        source = slugify(from_pagename)
+        to_page = pages.get(slugify(to_pagename))
+        if to_page is None:
+            print "Error creating redirect: %s --> %s" % (
+                from_pagename.encode('utf-8'), to_pagename.encode('utf-8'))
+            print "  (page %s does not exist)" % to_pagename.encode('utf-8')
+            continue
+        if source in existing:
+            continue
+        r = Redirect(source=source, destination=to_page)
+        # e.g. a redirect another shard just added.  Rolled back to a
+        # savepoint so the rest of the batch is kept.
+        sid = transaction.savepoint()
         try:
-            r.save(user=u, comment="Automated edit. Creating redirect.")
+            r.save(user=user, comment="Automated edit. Creating redirect.")
         except IntegrityError:
-            connection.close()
+            transaction.savepoint_rollback(sid)
+            print "Error creating redirect: %s --> %s" % (
+                from_pagename.encode('utf-8'), to_pagename.encode('utf-8'))
+            continue
+        transaction.savepoint_commit(sid)
+        existing.add(source)
         print "Redirect %s --> %s created" % (from_pagename.encode('utf-8'),
                                               to_pagename.encode('utf-8'))
 
 
 def import_redirects():
-    redirects = [mw_p.title for mw_p in get_redirects()]
-    process_concurrently(redirects, import_redirect,
-                         num_workers=4, name='redirects')
+    # We create the Redirects here.  We don't try and port over the
+    # version information for the formerly-page-text-based redirects.
+    from pages.models import slugify
+
+    resolved, looped = resolve_redirects(get_redirect_targets())
+    for title in sorted(looped):
+        print "Skipping redirect %s: it's part of a redirect loop" % (
+            title.encode('utf-8'))
+
+    redirects = []
+    for from_pagename, to_pagename in sorted(resolved.iteritems()):
+        to_pagename = fix_pagename(to_pagename)
+        if slugify(from_pagename) != slugify(to_pagename):
+            redirects.append((from_pagename, to_pagename))
+
+    u = get_robot_user()
+    for i in range(0, len(redirects), REDIRECT_BATCH_SIZE):
+        with transaction.commit_on_success():
+            _import_redirect_batch(redirects[i:i + REDIRECT_BATCH_SIZE], u)
+        print "%d of %d redirects processed" % (
+            min(i + REDIRECT_BATCH_SIZE, len(redirects)), len(redirects))
+
+
+def _add_mapdata(item):
+    if _transform_mapdata is not None:
+        _transform_mapdata.append(item)
+        return
+    mapdata_objects_to_create.append(item)
+    if journal is not None:
+        # Kept in the journal so that map data found before an interrupted
+        # import isn't lost when it's resumed.
+        journal.add_mapdata(item)
+    if shard is not None:
+        # Shard 0 adds everyone's map data once the pages are done.
+        shard.add_mapdata(item)
 
 
 def process_mapdata():
     # We create the MapData models here.  We can't create them until the
     # Page objects are created.
-    global mapdata_objects_to_create
-
     from maps.models import MapData
     from pages.models import Page, slugify
     from django.contrib.gis.geos import Point, MultiPoint
 
-    for item in mapdata_objects_to_create:
+    items = mapdata_objects_to_create
+    if shard is not None:
+        items = shard.mapdata()
+    elif journal is not None:
+        items = journal.mapdata()
+    for item in items:
         page_name = item['pagename'].encode('utf-8')
         print "Adding mapdata for", page_name
         try:
@@ -228,6 +826,15 @@ def process_mapdata():
             m.save()
         except IntegrityError:
             connection.close()
+        else:
+            if shard is not None:
+                shard.finish_mapdata(item)
+            if journal is not None:
+                journal.finish_mapdata(item)
+
+
+# Everything the import needs from a page, so it only has to be parsed once.
+PARSE_PROPS = 'text|templates|categories|images|links|revid|displaytitle'
 
 
 def parse_page(page_name):
@@ -241,12 +848,15 @@ def parse_page(page_name):
          "links" - List of links in the page
          "templates" - List of templates used in the page
          "categories" - List of categories
+         "images" - List of images (File: titles) used in the page
+         "revid" - Revision that was rendered
+         "displaytitle" - Title as displayed on the page
     """
-    request = api.APIRequest(site, {
-        'action': 'parse',
-        'page': page_name
-    })
-    return parse_result(request)
+    return parse_result(query_api(_parse_page_params(page_name)))
+
+
+def _parse_page_params(page_name):
+    return {'action': 'parse', 'page': page_name, 'prop': PARSE_PROPS}
 
 
 def parse_revision(rev_id):
@@ -260,35 +870,19 @@ def parse_revision(rev_id):
          "links" - List of links in the page
          "templates" - List of templates used in the page
          "categories" - List of categories
+         "images" - List of images (File: titles) used in the page
+         "revid" - Revision that was rendered
+         "displaytitle" - Title as displayed on the page
     """
-    request = api.APIRequest(site, {
-        'action': 'parse',
-        'oldid': rev_id
-    })
-    return parse_result(request)
+    return parse_result(query_api(_parse_revision_params(rev_id)))
 
 
-def parse_redirect(page_name):
-    """
-    Attrs:
-        page_name: Name of redirect page to parse
-
-    Returns:
-        Redirect destination link or None
-    """
-    request = api.APIRequest(site, {
-        'action': 'parse',
-        'page': page_name,
-        'prop': 'links'
-    })
-    result = parse_result(request)
-    if result["links"]:
-        return result["links"][0]
-    return None
+def _parse_revision_params(rev_id):
+    return {'action': 'parse', 'oldid': rev_id, 'prop': PARSE_PROPS}
 
 
-def parse_result(request):
-    result = request.query()['parse']
+def parse_result(response):
+    result = response['parse']
 
     parsed = {}
     html = result.get('text', None)
@@ -300,9 +894,31 @@ def parse_result(request):
     parsed["templates"] = [t['*'] for t in templates]
     categories = result.get('categories', [])
     parsed["categories"] = [c['*'] for c in categories]
+    images = result.get('images', [])
+    # Image names come as database keys, with underscores for spaces.
+    parsed["images"] = ['File:%s' % i.replace('_', ' ') for i in images]
+    parsed["revid"] = result.get('revid')
+    parsed["displaytitle"] = result.get('displaytitle')
     return parsed
 
 
+def parse_text(wikitext, title):
+    """
+    Attrs:
+        wikitext: Wikitext to parse.
+        title: Title with which to render the page.
+
+    Returns:
+        Dictionary like parse_page's.
+    """
+    return parse_result(query_api(_parse_text_params(wikitext, title)))
+
+
+def _parse_text_params(wikitext, title):
+    return {'action': 'parse', 'text': wikitext, 'title': title,
+            'prop': PARSE_PROPS}
+
+
 def parse_wikitext(wikitext, title):
     """
     Attrs:
@@ -312,13 +928,7 @@ def parse_wikitext(wikitext, title):
     Returns:
         HTML string of the parsed wikitext
     """
-    request = api.APIRequest(site, {
-        'action': 'parse',
-        'text': wikitext,
-        'title': title
-    })
-    result = request.query()['parse']
-    return result['text']['*']
+    return parse_text(wikitext, title)['html']
 
 
 def _convert_to_string(l):
@@ -499,40 +1109,26 @@ def remove_elements_tagged_for_removal(tree):
     return new_tree
 
 
-def _get_templates_on_page(pagename):
-    params = {
-        'action': 'query',
-        'prop': 'templates',
-        'titles': pagename,
-    }
-    req = api.APIRequest(site, params)
-    response = req.query()
-    pages = response['query']['pages']
-
-    if not pages:
-        return []
-
-    page_info = pages[pages.keys()[0]]
-    if not 'templates' in page_info:
-        return []
-
-    # There are some templates in use.
-    return [e['title'] for e in page_info['templates']]
+def _render_template(template_name, page_title=None):
+    return parse_result(query_api(
+        _render_template_params(template_name, page_title)))
 
 
-def _render_template(template_name, page_title=None):
+def _render_template_params(template_name, page_title=None):
     if page_title is None:
         page_title = template_name
     name_part = template_name[len('Template:'):]
     wikitext = '{{%s}}' % name_part
-    html = parse_wikitext(wikitext, page_title)
-    return html
+    return _parse_text_params(wikitext, page_title)
 
 
-def create_mw_template_as_page(template_name, template_html):
+def create_mw_template_as_page(template_name, template_html, images=None):
     """
     Create a page to hold the rendered template.
 
+    Attrs:
+        images: Images used in the rendered template.
+
     Returns:
         String representing the pagename of the new include-able page.
     """
@@ -544,11 +1140,12 @@ def create_mw_template_as_page(template_name, template_html):
     # Keeping it simple for now.  We can namespace later if people want that.
     include_name = name_part
 
-    if not Page.objects.filter(slug=slugify(include_name)):
-        mw_page = page.Page(site, title=template_name)
+    def _create():
+        if Page.objects.filter(slug=slugify(include_name)):
+            return
         p = Page(name=include_name)
         p.content = process_html(template_html, pagename=template_name,
-                                 mw_page_id=mw_page.pageid,
+                                 images=images,
                                  attach_img_to_pagename=include_name,
                                  show_img_borders=False)
         p.clean_fields()
@@ -557,15 +1154,36 @@ def create_mw_template_as_page(template_name, template_html):
             p.save(user=robot,
                    comment="Automated edit. Creating included page.")
 
+    # Other workers that hit the same template wait for this one to create
+    # the page rather than processing it themselves.
+    _template_page_calls.do(slugify(include_name), _create)
     return include_name
 
 
-def replace_mw_templates_with_includes(tree, templates, page_title):
+def _include_html(include_pagename):
+    include_classes = ''
+    return (
+        '<a href="%(quoted_pagename)s" '
+        'class="plugin includepage%(include_classes)s">'
+        'Include page %(pagename)s'
+        '</a>' % {
+            'quoted_pagename': urllib.quote(include_pagename),
+            'pagename': include_pagename,
+            'include_classes': include_classes,
+        }
+    )
+
+
+def replace_mw_templates_with_includes(tree, templates, page_title,
+                                       decisions=None):
     """
     Replace {{templatethings}} inside of pages with our page include plugin.
 
     We can safely do this when the template doesn't have any arguments.
     When it does have arguments we just import it as raw HTML for now.
+
+    If a decisions dictionary is given, the (template HTML, include HTML)
+    replacements made are added to its 'templates' list.
     """
     # We use the API to figure out what templates are being used on a given
     # page, and then translate them to page includes.  This can be done for
@@ -588,24 +1206,17 @@ def replace_mw_templates_with_includes(tree, templates, page_title):
 
     html = _convert_to_string(tree)
     for template in templates:
-        normalized = _normalize_html(_render_template(template, page_title))
+        rendered = _render_template(template, page_title)
+        normalized = _normalize_html(rendered['html'])
         template_html = normalized.strip()
         if template_html and template_html in html:
             # It's an include-style template.
-            include_pagename = create_mw_template_as_page(template,
-                                                          template_html)
-            include_classes = ''
-            include_html = (
-                '<a href="%(quoted_pagename)s" '
-                'class="plugin includepage%(include_classes)s">'
-                'Include page %(pagename)s'
-                '</a>' % {
-                    'quoted_pagename': urllib.quote(include_pagename),
-                    'pagename': include_pagename,
-                    'include_classes': include_classes,
-                }
-            )
+            include_pagename = create_mw_template_as_page(
+                template, template_html, images=rendered['images'])
+            include_html = _include_html(include_pagename)
             html = html.replace(template_html, include_html)
+            if decisions is not None:
+                decisions['templates'].append((template_html, include_html))
 
     p = html5lib.HTMLParser(tokenizer=html5lib.tokenizer.HTMLTokenizer,
                             tree=_treebuilder,
@@ -614,6 +1225,23 @@ def replace_mw_templates_with_includes(tree, templates, page_title):
     return tree
 
 
+def reuse_template_includes(tree, decisions):
+    """
+    Replaces templates with includes the same way they were replaced in the
+    page's current revision, without asking the API about them again.
+    """
+    html = _convert_to_string(tree)
+    replaced = html
+    for template_html, include_html in decisions['templates']:
+        replaced = replaced.replace(template_html, include_html)
+    if replaced == html:
+        return tree
+    p = html5lib.HTMLParser(tokenizer=html5lib.tokenizer.HTMLTokenizer,
+                            tree=_treebuilder,
+                            namespaceHTMLElements=False)
+    return p.parseFragment(replaced, encoding='UTF-8')
+
+
 def fix_googlemaps(tree, pagename, save_data=True):
     """
     If the googlemaps extension is installed, then we process googlemaps here.
@@ -630,8 +1258,7 @@ def fix_googlemaps(tree, pagename, save_data=True):
         src = img.attrib.get('src')
         center = parse_qs(urlparse(src).query)['center']
         lat, lon = center[0].split(',')
-        d = {'pagename': pagename, 'lat': lat, 'lon': lon}
-        mapdata_objects_to_create.append(d)
+        _add_mapdata({'pagename': pagename, 'lat': lat, 'lon': lon})
 
     for elem in tree:
         if elem is None or isinstance(elem, basestring):
@@ -739,7 +1366,6 @@ def process_non_html_elements(html, pagename):
     &lt;googlemap&gt;.  We process those here.
     """
     def _repl_googlemap(match):
-        global mapdata_objects_to_create
         xml = '<googlemap %s></googlemap>' % match.group('attribs')
         try:
             dom = minidom.parseString(xml)
@@ -749,8 +1375,7 @@ def process_non_html_elements(html, pagename):
         lon = elem.getAttribute('lon')
         lat = elem.getAttribute('lat')
 
-        d = {'pagename': pagename, 'lat': lat, 'lon': lon}
-        mapdata_objects_to_create.append(d)
+        _add_mapdata({'pagename': pagename, 'lat': lat, 'lon': lon})
 
         return ''  # Clear out the googlemap tag nonsense.
 
@@ -880,51 +1505,146 @@ def page_url_to_name(page_url):
     return urlsplit(page_url).path.split('/')[-1]
 
 
+IMAGEINFO_PROPS = 'timestamp|user|url|dimensions|comment'
+# Titles per request when looking up image info in bulk.
+IMAGEINFO_BATCH_SIZE = 50
+
+
+def _store_image_infos(pages):
+    """
+    Puts the imageinfo from the 'pages' part of a query response into the
+    image info cache.  Returns the titles of the pages.
+    """
+    titles = []
+    with _image_info_lock:
+        for info in pages:
+            titles.append(info['title'])
+            if 'imageinfo' in info:
+                _image_info_cache[info['title']] = info['imageinfo'][0]
+            else:
+                # For some reason we can't get the image info.
+                _image_info_cache[info['title']] = None
+    return titles
+
+
+def _image_infos_params(titles):
+    return {'action': 'query',
+            'prop': 'imageinfo',
+            'titles': '|'.join(titles),
+            'iiprop': IMAGEINFO_PROPS,
+            }
+
+
+def _store_image_info_batch(titles, response):
+    query = response['query']
+    _store_image_infos(query['pages'].values())
+    with _image_info_lock:
+        # The info is stored under the titles the wiki normalized ours to,
+        # e.g. "Datei:Foo.jpg" for "File:Foo.jpg", so it's also stored
+        # under the titles we asked for.
+        for normalized in query.get('normalized', []):
+            if normalized['to'] in _image_info_cache:
+                _image_info_cache[normalized['from']] = _image_info_cache[
+                    normalized['to']]
+        for title in titles:
+            _image_info_cache.setdefault(title, None)
+
+
+def get_image_infos(image_titles):
+    """
+    Returns a dictionary mapping each of the image titles to its image
+    info, or to None if the wiki has no info for it.  Images that haven't
+    been seen before are looked up in batches.
+    """
+    def _fetch(titles):
+        with _image_info_lock:
+            # Someone may have finished looking these up in the meantime.
+            titles = [t for t in titles if t not in _image_info_cache]
+        for i in range(0, len(titles), IMAGEINFO_BATCH_SIZE):
+            batch = titles[i:i + IMAGEINFO_BATCH_SIZE]
+            _store_image_info_batch(batch,
+                                    query_api(_image_infos_params(batch)))
+
+    with _image_info_lock:
+        missing = [t for t in image_titles if t not in _image_info_cache]
+    if missing:
+        # Titles another worker is already looking up are waited for.
+        _image_info_calls.do_batch(missing, _fetch)
+    with _image_info_lock:
+        return dict((t, _image_info_cache.get(t)) for t in image_titles)
+
+
 def get_image_info(image_title):
-    params = {'action': 'query',
-              'prop': 'imageinfo',
-              'imlimit': 500,
-              'titles': image_title,
-              'iiprop': 'timestamp|user|url|dimensions|comment',
-              }
-    req = api.APIRequest(site, params)
-    response = req.query()
-    info_by_pageid = response['query']['pages']
-    # Doesn't matter what page it's on, we just want the info.
-    info = info_by_pageid[info_by_pageid.keys()[0]]
-    return info['imageinfo'][0]
+    info = get_image_infos([image_title])[image_title]
+    if info is None:
+        raise KeyError(image_title)
+    return info
+
+
+def get_images_on_page(page_id, pagename=None):
+    """
+    Returns the titles of the images used on a page.  Their image info is
+    looked up at the same time and kept for get_image_info().
+    """
+    if mirror_store is not None and pagename is not None:
+        page_info = mirror_store.get(pagename)
+        if page_info is not None:
+            get_image_infos(page_info['images'])
+            return page_info['images']
+
+    titles = []
+    for response in iter_query({
+        'action': 'query',
+        'generator': 'images',
+        'gimlimit': 'max',
+        'pageids': page_id,
+        'prop': 'imageinfo',
+        'iiprop': IMAGEINFO_PROPS,
+    }):
+        if 'query' not in response:
+            # Page doesn't have images.
+            break
+        for title in _store_image_infos(response['query']['pages'].values()):
+            if title not in titles:
+                titles.append(title)
+    return sorted(titles)
+
+
+def download(url):
+    data = None
+    if mirror_store is not None:
+        data = mirror_store.get_file(url)
+    if data is None:
+        with watchdog.stage('download'):
+            data = transport.download(url)
+    if recorder is not None:
+        recorder.record_file(url, data)
+    return data
 
 
 def grab_images(tree, page_id, pagename, attach_to_pagename=None,
-                show_image_borders=True):
+                show_image_borders=True, image_titles=None, decisions=None):
     """
     Imports the images on a page as PageFile objects and fixes the page's
     HTML to be what we want for images.
+
+    If image_titles isn't given, the images on the page are looked up
+    using page_id.
+
+    If a decisions dictionary is given, the (title, quoted title, filename)
+    of each image fixed up is added to its 'images' list.
     """
     from django.core.files.base import ContentFile
     from pages.models import slugify, PageFile
 
     robot = get_robot_user()
 
-    # Get the list of images on this page
-    params = {
-        'action': 'query',
-        'prop': 'images',
-        'imlimit': 500,
-        'pageids': page_id,
-    }
-    req = api.APIRequest(site, params)
-    response = req.query()
-    imagelist_by_pageid = response['query']['pages']
-    # We're processing one page at a time, so just grab the first.
-    imagelist = imagelist_by_pageid[imagelist_by_pageid.keys()[0]]
-    if not 'images' in imagelist:
-        # Page doesn't have images.
-        return tree
-    images = imagelist['images']
+    if image_titles is None:
+        image_titles = get_images_on_page(page_id, pagename)
+    else:
+        get_image_infos(image_titles)
 
-    for image_dict in images:
-        image_title = image_dict['title']
+    for image_title in image_titles:
         filename = image_title[len('File:'):]
         # Get the image info for this image title
         try:
@@ -953,26 +1673,38 @@ def grab_images(tree, page_id, pagename, attach_to_pagename=None,
             # Image isn't actually on the page, so let's not create or attach
             # the PageFile.
             continue
+        if decisions is not None:
+            decisions['images'].append(
+                (image_title, quoted_image_title, filename))
 
         # Get the full-size image binary and store it in a string.
-        img_ptr = urllib.URLopener()
-        img_tmp_f = open(img_ptr.retrieve(image_url)[0], 'r')
-        file_content = ContentFile(img_tmp_f.read())
-        img_tmp_f.close()
-        img_ptr.close()
+        file_content = ContentFile(download(urljoin(API_URL, image_url)))
 
         # Create the PageFile and associate it with the current page.
         print "Creating image %s on page %s" % (filename.encode('utf-8'), pagename.encode('utf-8'))
         try:
             pfile = PageFile(name=filename, slug=slugify(attach_to_pagename))
             pfile.file.save(filename, file_content, save=False)
-            pfile.save(user=robot, comment="Automated edit. Creating file.")
+            with watchdog.stage('db'):
+                pfile.save(user=robot,
+                           comment="Automated edit. Creating file.")
         except IntegrityError:
             connection.close()
 
     return tree
 
 
+def reuse_images(tree, decisions, show_image_borders=True):
+    """
+    Fixes up image HTML for the images attached to the page's current
+    revision, without looking them up again.
+    """
+    for image_title, quoted_image_title, filename in decisions['images']:
+        tree = fix_image_html(image_title, quoted_image_title, filename, tree,
+                              border=show_image_borders)
+    return tree
+
+
 def fix_indents(tree):
     def _change_to_p():
         # We replace the dl_parent with the dd_item
@@ -1147,26 +1879,47 @@ def convert_some_divs_to_tables(tree):
 
 def process_html(html, pagename=None, mw_page_id=None, templates=[],
                  attach_img_to_pagename=None, show_img_borders=True,
-                 historic=False):
+                 historic=False, images=None, parsed=None, decisions=None):
     """
     This is the real workhorse.  We take an html string which represents
     a rendered MediaWiki page and process bits and pieces of it, normalize
     elements / attributes and return cleaned up HTML.
+
+    If parsed, the result of the parse call the html came from, is given
+    then the templates and images it lists are used instead of asking the
+    API for them again.
+
+    decisions is a dictionary with 'templates' and 'images' lists.  For the
+    current revision of a page, the template includes and images it ends
+    up with are recorded there.  For historic revisions, those are reused
+    instead of rendering templates and looking up images, so processing
+    makes no API calls.
     """
+
+    if parsed is not None:
+        templates = parsed['templates']
+        images = parsed['images']
     html = process_non_html_elements(html, pagename)
     html = remove_script_tags(html)
     p = html5lib.HTMLParser(tokenizer=html5lib.tokenizer.HTMLTokenizer,
                             tree=_treebuilder,
                             namespaceHTMLElements=False)
     tree = p.parseFragment(html, encoding='UTF-8')
-    tree = replace_mw_templates_with_includes(tree, templates, pagename)
+    if historic and decisions is not None:
+        tree = reuse_template_includes(tree, decisions)
+    else:
+        tree = replace_mw_templates_with_includes(tree, templates, pagename,
+                                                  decisions=decisions)
     tree = fix_references(tree)
     tree = fix_embeds(tree)
     tree = fix_googlemaps(tree, pagename, save_data=(not historic))
     tree = remove_elements_tagged_for_removal(tree)
-    if pagename is not None and mw_page_id:
+    if historic and decisions is not None:
+        tree = reuse_images(tree, decisions, show_img_borders)
+    elif pagename is not None and (mw_page_id or images is not None):
         tree = grab_images(tree, mw_page_id, pagename,
-                           attach_img_to_pagename, show_img_borders)
+                           attach_img_to_pagename, show_img_borders,
+                           image_titles=images, decisions=decisions)
     tree = fix_internal_links(tree)
     tree = fix_basic_tags(tree)
     tree = remove_edit_links(tree)
@@ -1184,25 +1937,175 @@ def process_html(html, pagename=None, mw_page_id=None, templates=[],
     return _convert_to_string(tree)
 
 
-def create_page_revisions(p, mw_p, parsed_page):
-    from django.contrib.auth.models import User
-    from pages.models import Page, slugify
+def iter_page_revisions(title):
+    """
+    Yields the page's revisions, newest first.
 
-    request = api.APIRequest(site,
-                             {'action': 'query',
-                              'prop': 'revisions',
-                              'rvprop': 'ids|timestamp|user|comment',
-                              'rvlimit': '500',
-                              'titles': mw_p.title,
-                              })
-    response_pages = request.query()['query']['pages']
-    first_pageid = response_pages.keys()[0]
-    rev_num = 0
-    total_revs = len(response_pages[first_pageid]['revisions'])
-    for revision in response_pages[first_pageid]['revisions']:
-        rev_num += 1
-        if rev_num == total_revs:
-            history_type = 0  # Added
+    Revisions are fetched one batch at a time as the caller works through
+    them, so the whole history is never held in memory.
+    """
+    for response in iter_query(_page_revisions_params(title)):
+        for revision in _revisions_in(response):
+            yield revision
+
+
+def _page_revisions_params(title):
+    return {'action': 'query',
+            'prop': 'revisions',
+            'rvprop': 'ids|timestamp|user|comment|sha1|size',
+            'rvlimit': '500',
+            'titles': title,
+            }
+
+
+def _revisions_in(response):
+    response_pages = response['query']['pages']
+    first_pageid = response_pages.keys()[0]
+    return response_pages[first_pageid].get('revisions', [])
+
+
+def _mark_last(items):
+    """
+    Yields (item, is_last) for each item, looking only one item ahead.
+    """
+    items = iter(items)
+    try:
+        previous = items.next()
+    except StopIteration:
+        return
+    for item in items:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+# Old revisions of a page to have waiting on the transform pool at once.
+TRANSFORM_BACKLOG = 20
+# Number of recent revision sha1s a page's import keeps the transformed
+# content of, for reverts to reuse.
+SHA1_CACHE_SIZE = 200
+
+
+class _Transformed(object):
+    """
+    A revision transformed in the importer itself.  It has the same get()
+    as the AsyncResults of revisions sent to the transform pool.
+    """
+    def __init__(self, html, mapdata=None):
+        self.html = html
+        self.mapdata = mapdata or []
+
+    def get(self):
+        return self.html, self.mapdata
+
+
+def _init_transform_worker():
+    global _transform_mapdata
+    # Ctrl-C is left to the importer, which takes the pool down with it.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _transform_mapdata = []
+
+
+def transform_revision(html, pagename, mw_page_id, decisions, parsed=None):
+    """
+    Processes the HTML of an old revision of a page.  With decisions from
+    the page's current revision, this makes no API calls or database
+    writes, so it can run in the transform pool.
+
+    Returns:
+        (processed HTML, map data found).  Map data is only returned when
+        run in the transform pool; otherwise it's saved as usual.
+    """
+    from pages.models import Page
+
+    # Create a dummy Page object to get the correct cleaning behavior
+    dummy_p = Page(name=pagename, content=html)
+    dummy_p.content = process_html(dummy_p.content, pagename=pagename,
+                                   parsed=parsed, mw_page_id=mw_page_id,
+                                   historic=True, decisions=decisions)
+    if not (dummy_p.content.strip()):
+        dummy_p.content = '<p></p>'  # Can't be blank
+    dummy_p.clean_fields()
+    mapdata = []
+    if _transform_mapdata is not None:
+        mapdata = list(_transform_mapdata)
+        del _transform_mapdata[:]
+    return dummy_p.content, mapdata
+
+
+def _start_transform(parsed, pagename, mw_page_id, decisions):
+    if transform_pool is None or decisions is None:
+        # Without decisions, processing needs the API and the database.
+        with watchdog.stage('transform'):
+            return _Transformed(*transform_revision(
+                parsed['html'], pagename, mw_page_id, decisions,
+                parsed=parsed))
+    return transform_pool.apply_async(
+        transform_revision, (parsed['html'], pagename, mw_page_id, decisions))
+
+
+def _save_revision(mw_p, p_h, revid, result, first_use):
+    with watchdog.stage('transform'):
+        html, mapdata = result.get()
+    if first_use:
+        for item in mapdata:
+            _add_mapdata(item)
+    p_h.content = html
+    try:
+        with watchdog.stage('db'):
+            p_h.save()
+    except IntegrityError:
+        connection.close()
+    else:
+        if journal is not None and revid:
+            journal.finish_revision(mw_p.title, revid)
+    print "Imported historical page %s" % p_h.name.encode('utf-8')
+
+
+def create_page_revisions(p, mw_p, parsed_page, decisions=None,
+                          revisions=None, page_is_new=True):
+    """
+    Creates the page's history.  The latest revision is the page itself;
+    older revisions are processed reusing the current revision's
+    decisions, if given.
+
+    revisions, newest first, may be given to import only those.  If
+    page_is_new is False they're added to the page's existing history.
+
+    Revisions with the same content (by sha1) as one already processed,
+    such as reverts, reuse its processed HTML instead of being parsed again.
+    Only the SHA1_CACHE_SIZE most recently seen contents are kept.
+
+    If there's a transform pool, revisions are transformed there while
+    the next ones are fetched, and saved here in order.
+    """
+    from pages.models import Page, slugify
+
+    if revisions is None:
+        # Pages read from a dump come with their revision history.
+        revisions = getattr(mw_p, 'revisions', None)
+    if revisions is None:
+        revisions = iter_page_revisions(mw_p.title)
+    # Drop the revisions we've been told not to import before any of them
+    # are parsed.
+    revisions = history.thin(revisions, history_policies)
+    # Revisions saved before an interrupted import.
+    done_revids = set()
+    if journal is not None:
+        done_revids = journal.done_revisions(mw_p.title)
+    # sha1 of revision content -> its (pending) transform, least recently
+    # used first.
+    results_by_sha1 = collections.OrderedDict()
+    # (version, revid, transform, first use of transform), oldest last.
+    pending = collections.deque()
+    rev_num = 0
+    for revision, is_oldest in _mark_last(revisions):
+        rev_num += 1
+        revid = revision.get('revid', None)
+        if revid in done_revids:
+            continue
+        if is_oldest and page_is_new:
+            history_type = 0  # Added
         else:
             history_type = 1  # Updated
 
@@ -1210,90 +2113,294 @@ def create_page_revisions(p, mw_p, parsed_page):
         if history_comment:
             history_comment = history_comment[:200]
 
-        username = revision.get('user', None)
-        user = User.objects.filter(username=username)
-        if user:
-            user = user[0]
-            history_user_id = user.id
-        else:
-            history_user_id = None
+        history_user_id = get_user_id(revision.get('user', None))
         history_user_ip = None  # MW offers no way to get this via API
 
         timestamp = revision.get('timestamp', None)
         history_date = date_parse(timestamp)
 
-        revid = revision.get('revid', None)
-        if rev_num == 1:  # latest revision is same as page
-            parsed = parsed_page
+        sha1 = revision.get('sha1', None)
+        first_use = False
+        if rev_num == 1:
+            # Latest revision is same as page, and it's been processed
+            # already.
+            result = _Transformed(p.content)
+        elif sha1 in results_by_sha1:
+            result = results_by_sha1.pop(sha1)
         else:
-            parsed = parse_revision(revid)
-        html = parsed['html']
-
-        # Create a dummy Page object to get the correct cleaning behavior
-        dummy_p = Page(name=p.name, content=html)
-        dummy_p.content = process_html(dummy_p.content, pagename=p.name,
-                                       templates=parsed['templates'], mw_page_id=mw_p.pageid,
-                                       historic=True)
-        if not (dummy_p.content.strip()):
-            dummy_p.content = '<p></p>'  # Can't be blank
-        dummy_p.clean_fields()
-        html = dummy_p.content
+            result = _start_transform(parse_revision(revid), p.name,
+                                      mw_p.pageid, decisions)
+            first_use = True
+        # A Category page's content has the list of tagged pages added to
+        # it, which older revisions never had.
+        if sha1 and not (rev_num == 1 and
+                         mw_p.title.startswith('Category:')):
+            results_by_sha1.pop(sha1, None)
+            results_by_sha1[sha1] = result
+            if len(results_by_sha1) > SHA1_CACHE_SIZE:
+                results_by_sha1.popitem(last=False)
 
         p_h = Page.versions.model(
             id=p.id,
             name=p.name,
             slug=slugify(p.name),
-            content=html,
             history_comment=history_comment,
             history_date=history_date,
             history_type=history_type,
             history_user_id=history_user_id,
             history_user_ip=history_user_ip
         )
-        try:
-            p_h.save()
-        except IntegrityError:
-            connection.close()
-        print "Imported historical page %s" % p.name.encode('utf-8')
+        pending.append((p_h, revid, result, first_use))
+        if len(pending) > TRANSFORM_BACKLOG:
+            _save_revision(mw_p, *pending.popleft())
+    while pending:
+        _save_revision(mw_p, *pending.popleft())
+
+
+class MWPage(object):
+    """
+    A page on the MediaWiki site.
+
+    Attrs:
+        length: Size of the current revision, in bytes, if known.
+        lastrevid: Id of the current revision, if known.
+        num_revisions: Number of revisions, if known.
+    """
+    def __init__(self, title, pageid=None, namespace=None, length=None,
+                 lastrevid=None, num_revisions=None):
+        self.title = title
+        self.pageid = pageid
+        self.namespace = namespace
+        self.length = length
+        self.lastrevid = lastrevid
+        self.num_revisions = num_revisions
+
+    @classmethod
+    def from_api(cls, page_info):
+        """
+        Makes a MWPage from the page dictionaries the API and the mirror
+        store return.
+        """
+        return cls(page_info['title'], page_info.get('pageid'),
+                   page_info.get('ns'), page_info.get('length'),
+                   page_info.get('lastrevid'))
+
+    def __repr__(self):
+        return '<MWPage %r>' % self.title
+
+
+def _iter_namespace_pages(namespace, apfilterredir):
+    # prop=info gets us each page's length and latest revision, which the
+    # scheduler uses to guess how long the page will take to import.
+    for response in iter_query({
+        'action': 'query',
+        'generator': 'allpages',
+        'gaplimit': 500,
+        'gapnamespace': namespace,
+        'gapfilterredir': apfilterredir,
+        'prop': 'info',
+    }):
+        if 'query' not in response:
+            # Nothing in this namespace.
+            break
+        for page_info in response['query']['pages'].values():
+            yield MWPage.from_api(page_info)
 
 
 def get_page_list(apfilterredir='nonredirects'):
-    """ Returns a list of all pages in all namespaces. Exclude redirects by 
-    default.
+    """ Yields all pages in all namespaces. Exclude redirects by default.
+
+    Pages are yielded as they're listed, with all namespaces listed at
+    once, so work on the first pages can start right away.
     """
-    pages = []
-    for namespace in ['0', '1', '2', '3', '14', '15']:
-        request = api.APIRequest(site, {
-            'action': 'query',
-            'list': 'allpages',
-            'aplimit': 500,
-            'apnamespace': namespace,
-            'apfilterredir': apfilterredir,
-        })
-        response_list = request.query()['query']['allpages']
-        pages.extend(pagelist.listFromQuery(site, response_list))
-    return pages
+    if dump_path is not None:
+        return (mw_p for mw_p in iter_dump_pages(dump_path, IMPORT_NAMESPACES)
+                if bool(mw_p.redirect_target) == (apfilterredir == 'redirects'))
+
+    if mirror_store is not None and mirror_store.count():
+        page_infos = mirror_store.iter_pages(
+            namespaces=IMPORT_NAMESPACES,
+            redirects=(apfilterredir == 'redirects'))
+        return (MWPage.from_api(page_info) for page_info in page_infos)
+
+    return iter_concurrently(
+        lambda namespace: _iter_namespace_pages(namespace, apfilterredir),
+        IMPORT_NAMESPACES)
 
 
 def get_redirects():
-    """ Returns a list of all redirect pages.
+    """ Yields all redirect pages.
     """
     return get_page_list(apfilterredir='redirects')
 
 
+def _prefetch_image_infos(engine, image_titles):
+    with _image_info_lock:
+        titles = [t for t in image_titles if t not in _image_info_cache and
+                  t not in _image_infos_requested]
+        _image_infos_requested.update(titles)
+    for i in range(0, len(titles), IMAGEINFO_BATCH_SIZE):
+        batch = titles[i:i + IMAGEINFO_BATCH_SIZE]
+        fetch_api(engine, _image_infos_params(batch),
+                  lambda response, batch=batch:
+                      _prefetched_image_infos(engine, batch, response))
+
+
+def _prefetched_image_infos(engine, titles, response):
+    _store_image_info_batch(titles, response)
+    with _image_info_lock:
+        infos = [_image_info_cache.get(t) for t in titles]
+    for info in infos:
+        if info is not None and 'url' in info:
+            _prefetch_file(engine, info['url'])
+
+
+def _prefetch_file(engine, url):
+    """
+    Downloads an image file into the mirror store, for download() to find.
+    """
+    if url in _files_requested or mirror_store.has_file(url):
+        return
+    _files_requested.add(url)
+    engine.fetch('GET', url, lambda data: mirror_store.add_file(url, data))
+
+
+def _prefetch_rendering(engine, parsed, page_title):
+    _prefetch_image_infos(engine, parsed['images'])
+    for template in parsed['templates']:
+        fetch_api(engine, _render_template_params(template, page_title),
+                  lambda response: _prefetch_image_infos(
+                      engine, parse_result(response)['images']))
+
+
+def prefetch_page(engine, page_info):
+    """
+    Queues the API requests that importing the page will make, so that
+    their responses are waiting in the API cache when the import gets to
+    it.  Requests that depend on an earlier response are queued from its
+    callback.
+    """
+    title = page_info['title']
+    print "Mirroring %s" % title.encode('utf-8')
+
+    # Content we'll already have; see create_page_revisions().
+    seen_sha1s = set()
+    revisions = []
+
+    def _got_revisions(response):
+        revisions.extend(_revisions_in(response))
+        if _continue_params(response) is not None:
+            return  # Wait for the whole history.
+        for revision in history.thin(revisions, history_policies):
+            sha1 = revision.get('sha1')
+            seen = sha1 in seen_sha1s
+            if sha1:
+                seen_sha1s.add(sha1)
+            # The latest revision is the page itself.
+            if revision['revid'] == page_info['lastrevid'] or seen:
+                continue
+            # Older revisions reuse the current revision's templates and
+            # images, so only their HTML is needed.
+            fetch_api(engine, _parse_revision_params(revision['revid']),
+                      lambda response: None)
+
+    fetch_api(engine, _parse_page_params(title),
+              lambda response: _prefetch_rendering(
+                  engine, parse_result(response), title))
+    fetch_query(engine, _page_revisions_params(title), _got_revisions)
+
+
+def mirror_site(max_in_flight=100):
+    """
+    Copies the source wiki to local storage before anything is imported.
+
+    Page metadata is pulled into the mirror store with bulk generator
+    queries, replacing what an earlier mirror put there.  Then every
+    per-page API request the import will make is sent so the responses
+    are in the API cache, and the images the pages use are downloaded
+    into the mirror store.  These go through a FetchEngine, which keeps up
+    to max_in_flight requests going from this one thread.  The import that
+    follows then runs without waiting on the network, and its workers are
+    left to the page processing.
+    """
+    # Pages deleted or edited since an earlier mirror mustn't linger.
+    mirror_store.clear()
+    for namespace in IMPORT_NAMESPACES:
+        for response in iter_query({
+            'action': 'query',
+            'generator': 'allpages',
+            'gapnamespace': namespace,
+            'gaplimit': 50,
+            'prop': 'revisions|info|categories|templates|images',
+            'rvprop': 'ids|timestamp|size',
+            'cllimit': 'max',
+            'tllimit': 'max',
+            'imlimit': 'max',
+        }):
+            if 'query' in response:
+                mirror_store.add_pages(response['query']['pages'].values())
+        print "Mirrored page list for namespace %s (%d pages so far)" % (
+            namespace, mirror_store.count())
+
+    # Redirect targets are listed in bulk, so there's no per-page request
+    # to make for redirects.
+    get_redirect_targets()
+    print "Mirrored redirect targets"
+
+    pages = mirror_store.iter_pages(namespaces=IMPORT_NAMESPACES)
+    engine = FetchEngine(max_in_flight=max_in_flight,
+                         timeout=transport.timeout, maxlag=transport.maxlag)
+    engine.run(pages, lambda page_info: prefetch_page(engine, page_info))
+    print "Mirror network: %s" % engine.stats()
+
+
 def import_page(mw_p):
+    if journal is None:
+        _import_page(mw_p)
+        return
+    # A page we started on before the import was interrupted.
+    resuming = journal.page_status(mw_p.title) is not None
+    journal.start_page(mw_p.title)
+    try:
+        _import_page(mw_p, resuming=resuming)
+    except Exception as e:
+        journal.fail_page(mw_p.title, retry.describe_error(e))
+        raise
+    journal.finish_page(mw_p.title, imported_revisions.get(mw_p.title))
+
+
+def _import_page(mw_p, resuming=False):
+    """
+    Attrs:
+        mw_p: The MWPage to import.
+        resuming: True if an earlier, interrupted import started on this
+            page.  If it got as far as saving the page, the page is
+            reused and only its missing revisions are added.
+    """
     from pages.models import Page, slugify
     print "Importing %s" % mw_p.title.encode('utf-8')
     parsed = parse_page(mw_p.title)
     html = parsed['html']
     name = fix_pagename(mw_p.title)
 
-    if Page.objects.filter(slug=slugify(name)).exists():
+    existing = Page.objects.filter(slug=slugify(name))
+    if resuming and existing.filter(name=name).exists():
+        print "Resuming %s" % name.encode('utf-8')
+        p = existing.get(name=name)
+        decisions = _render_page(p, mw_p, parsed)
+        with watchdog.stage('db'):
+            p.save(track_changes=False)
+        create_page_revisions(p, mw_p, parsed, decisions)
+        process_page_categories(p, parsed['categories'])
+        imported_revisions[mw_p.title] = parsed['revid']
+        return
+
+    if existing.exists():
         print "Page %s already exists" % name.encode('utf-8')
         # Page already exists with this slug.  This is probably because
         # MediaWiki has case-sensitive pagenames.
         other_page = Page.objects.get(slug=slugify(name))
-        if len(html) > other_page.content:
+        if len(html) > len(other_page.content):
             print "Clearing out other page..", other_page.name.encode('utf-8')
             # *This* page has more content.  Let's use it instead.
             for other_page_version in other_page.versions.all():
@@ -1303,6 +2410,32 @@ def import_page(mw_p):
             # Other page has more content.
             return
 
+    p = Page(name=name)
+    decisions = _render_page(p, mw_p, parsed)
+    try:
+       with watchdog.stage('db'):
+           p.save(track_changes=False)
+    except IntegrityError:
+       connection.close()
+    try:
+       create_page_revisions(p, mw_p, parsed, decisions)
+    except KeyError:
+       # For some reason the response lacks a revisions key
+       # TODO: figure out why
+       pass
+    process_page_categories(p, parsed['categories'])
+    imported_revisions[mw_p.title] = parsed['revid']
+
+
+def _render_page(p, mw_p, parsed):
+    """
+    Sets the page's content from the parse of its current revision.
+
+    Returns:
+        The template and image decisions made, to be reused for the
+        page's older revisions.
+    """
+    html = parsed['html']
     if mw_p.title.startswith('Category:'):
         # include list of tagged pages
         include_html = (
@@ -1310,37 +2443,208 @@ def import_page(mw_p):
                  'class="plugin includetag includepage_showtitle">'
                  'List of pages tagged &quot;%(tag)s&quot;'
                 '</a>' % {
-                    'quoted_tag': urllib.quote(name),
-                    'tag': name,
+                    'quoted_tag': urllib.quote(p.name),
+                    'tag': p.name,
                     }
             )
         html += include_html
-    p = Page(name=name, content=html)
-    p.content = process_html(p.content, pagename=p.name,
-                             templates=parsed['templates'],
-                             mw_page_id=mw_p.pageid, historic=False)
+    # The template includes and images settled on here are reused for the
+    # page's older revisions.
+    decisions = {'templates': [], 'images': []}
+    with watchdog.stage('transform'):
+        p.content = process_html(html, pagename=p.name, parsed=parsed,
+                                 mw_page_id=mw_p.pageid, historic=False,
+                                 decisions=decisions)
 
     if not (p.content.strip()):
         p.content = '<p> </p>' # page content can't be blank
     p.clean_fields()
-    try:
-       p.save(track_changes=False)
-    except IntegrityError:
-       connection.close()
-    try:
-       create_page_revisions(p, mw_p, parsed)
-    except KeyError:
-       # For some reason the response lacks a revisions key
-       # TODO: figure out why
-       pass
-    process_page_categories(p, parsed['categories'])
+    return decisions
+
+
+def page_cost(mw_p):
+    """
+    Guesses how long a page will take to import.  Every revision gets
+    rendered and processed, so that's roughly the page's size times its
+    number of revisions, where we know them.
+    """
+    return (mw_p.length or 1) * (mw_p.num_revisions or 1)
+
+
+# Orders pages for import; see set_page_priority().
+page_priority = page_cost
+# Number of the costliest pages, by page_priority, to import before the
+# rest, which are imported in the order they're listed.  This covers the
+# few huge pages that would hold up the end of the import if they were
+# started late.
+NUM_COSTLIEST_PAGES = 1000
+
+
+def plan_slug_collisions(pages):
+    """
+    MediaWiki titles are case-sensitive but our slugs aren't, so several
+    pages (e.g. "Main street" and "Main Street") may end up wanting the
+    same slug.  Picks the longest page of each such group to import.
+
+    Pages whose length isn't known are all kept, and import_page() sorts
+    them out.
+
+    Returns:
+        Dictionary of title -> title of the page it lost to, for the pages
+        not to import.
+    """
+    from pages.models import slugify
+
+    # Only titles and lengths are kept, not the pages themselves.
+    by_slug = {}
+    for mw_p in pages:
+        by_slug.setdefault(slugify(fix_pagename(mw_p.title)), []).append(
+            (mw_p.title, mw_p.length))
+    losers = {}
+    for group in by_slug.itervalues():
+        if len(group) == 1 or any(length is None for title, length in group):
+            continue
+        # Longest first, and the same choice on every run.
+        group.sort(key=lambda (title, length): (-length, title))
+        for title, length in group[1:]:
+            losers[title] = group[0][0]
+    return losers
+
+
+def _planned_pages():
+    """
+    Yields the pages to import, the costliest first.  The pages are listed
+    twice, once to plan around slug collisions and pick out the costliest
+    pages, and once to import, so that they needn't all be held in memory.
+    """
+    costliest = []
+    pages = get_page_list()
+    if page_priority is not None:
+        pages = collect_heaviest(pages, page_priority, NUM_COSTLIEST_PAGES,
+                                 costliest)
+    losers = plan_slug_collisions(pages)
+    for title, winner in sorted(losers.iteritems()):
+        print "Skipping %s: it has the same slug as %s, which is longer" % (
+            title.encode('utf-8'), winner.encode('utf-8'))
+    costliest = [mw_p for mw_p in costliest if mw_p.title not in losers]
+    first = set(mw_p.title for mw_p in costliest)
+    return itertools.chain(
+        longest_first(costliest, page_priority),
+        (mw_p for mw_p in get_page_list()
+         if mw_p.title not in losers and mw_p.title not in first))
 
 
 def import_pages():
+    """
+    Returns:
+        List of the titles of the pages that failed to import.
+    """
     print "Getting master page list ..."
     get_robot_user() # so threads won't try to create one concurrently
-    pages = get_page_list()
-    process_concurrently(pages, import_page, num_workers=4, name='pages')
+    pages = _planned_pages()
+    if journal is not None:
+        done = journal.done_pages()
+        if done:
+            print "Skipping %d pages imported already" % len(done)
+            imported_revisions.update(done)
+            pages = (mw_p for mw_p in pages if mw_p.title not in done)
+    return process_concurrently(pages, import_page, num_workers=4,
+                                name='pages',
+                                controller=concurrency_controller,
+                                retries=page_retries,
+                                dead_letter=dead_letter_file,
+                                item_key=_page_title,
+                                deadlines=stage_deadlines,
+                                before_retry=_before_page_retry)
+
+
+def _page_title(mw_p):
+    return mw_p.title
+
+
+def _discard_page(title):
+    """
+    Deletes what an import of the page that failed may have left behind.
+    """
+    from pages.models import Page
+
+    for p in Page.objects.filter(name=fix_pagename(title)):
+        print "Clearing out", p
+        p.delete(track_changes=False)
+        for p_h in p.versions.all():
+            p_h.delete()
+
+
+def _before_page_retry(item):
+    """
+    Called before a page (a MWPage or an ImportJob) that failed is tried
+    again.  With a journal, import_page() picks up where it left off.
+    """
+    if journal is None:
+        # Without a journal we don't know how far it got, so start over.
+        # Otherwise the page it saved looks like another page with the
+        # same slug, and the rest of it is never imported.
+        _discard_page(_page_title(item))
+
+
+def _retry_page(mw_p):
+    _before_page_retry(mw_p)
+    import_page(mw_p)
+
+
+def retry_failed_pages():
+    """
+    Imports the pages listed in the dead-letter file again.  The file is
+    started afresh, so afterwards it lists just the pages that still
+    failed.
+    """
+    path = dead_letter_file.path
+    retrying = path + '.retrying'
+    # Pages left over from a retry that was interrupted.
+    titles = retry.DeadLetterFile(retrying).keys()
+    for title in retry.DeadLetterFile(path).keys():
+        if title not in titles:
+            titles.append(title)
+    if os.path.exists(path):
+        with open(retrying, 'a') as f:
+            f.write(open(path).read())
+        os.remove(path)
+    print "Retrying %d pages" % len(titles)
+    get_robot_user()
+    process_concurrently([MWPage(title) for title in titles], _retry_page,
+                         num_workers=4, name='pages',
+                         controller=concurrency_controller,
+                         retries=page_retries, dead_letter=dead_letter_file,
+                         item_key=_page_title, deadlines=stage_deadlines)
+    os.remove(retrying)
+
+
+def import_job(job):
+    """
+    Imports the page of an ImportJob claimed by this shard.
+    """
+    try:
+        import_page(MWPage(job.title, job.pageid, job.namespace, job.length))
+    except Exception as e:
+        shard.fail_job(job, retry.describe_error(e))
+        raise
+    shard.finish_job(job)
+
+
+def import_shard_pages():
+    print "Getting master page list ..."
+    # Every shard makes the same plan, so each page is imported once.
+    pages = _planned_pages()
+    print "Added %d pages for shard %d" % (shard.add_jobs(pages),
+                                           shard.number)
+    # Jobs are claimed only as workers become free, so that whatever this
+    # shard hasn't started on is left for others to take.
+    process_concurrently(shard.claim_jobs(), import_job, num_workers=4,
+                         name='pages', controller=concurrency_controller,
+                         backlog=1, retries=page_retries,
+                         dead_letter=dead_letter_file, item_key=_page_title,
+                         deadlines=stage_deadlines,
+                         before_retry=_before_page_retry)
 
 
 def process_page_categories(page, categories):
@@ -1356,7 +2660,7 @@ def process_page_categories(page, categories):
         except IntegrityError as e:
             pass
     if keys:
-        pagetagset = PageTagSet.objects.create(page=page)
+        pagetagset, created = PageTagSet.objects.get_or_create(page=page)
         pagetagset.tags = keys
 
 
@@ -1400,38 +2704,677 @@ def clear_out_existing_data():
             t_h.delete()
 
 
-def run():
-    global site, SCRIPT_PATH
+def load_sync_state(path):
+    """
+    Returns the state saved by the last import, or None if there wasn't
+    one.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_sync_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_path, path)
+
+
+def get_sync_point():
+    """
+    Returns the id and timestamp of the wiki's newest recent change.  An
+    incremental import picks up from there.
+
+    This goes straight to the wiki, never to the API cache.
+    """
+    response = transport.api_request(API_URL, {
+        'action': 'query',
+        'list': 'recentchanges',
+        'rcprop': 'ids|timestamp',
+        'rclimit': 1,
+    })
+    changes = response['query']['recentchanges']
+    if not changes:
+        return {'rcid': 0, 'revid': 0, 'timestamp': None}
+    return {'rcid': changes[0]['rcid'],
+            'revid': changes[0].get('revid', 0),
+            'timestamp': changes[0]['timestamp']}
+
+
+def iter_recent_changes(since):
+    """
+    Yields the recent changes made after the sync point, oldest first.
+    """
+    params = {
+        'action': 'query',
+        'list': 'recentchanges',
+        'rcdir': 'newer',
+        'rcprop': 'title|ids|timestamp|loginfo',
+        'rctype': 'edit|new|log',
+        'rcnamespace': '|'.join(IMPORT_NAMESPACES),
+        'rclimit': 500,
+    }
+    if since['timestamp'] is not None:
+        params['rcstart'] = since['timestamp']
+    # Otherwise there were no recent changes at the sync point, and the
+    # rcid check alone tells which changes came after it.
+    for response in iter_query(params):
+        for change in response['query']['recentchanges']:
+            if change['rcid'] > since['rcid']:
+                yield change
+
+
+def _move_target(change):
+    params = change.get('logparams', {})
+    if 'target_title' in params:
+        return params['target_title']
+    # Older MediaWikis.
+    return change.get('move', {}).get('new_title')
+
+
+def summarize_changes(changes):
+    """
+    Works out what needs doing to catch up with a list of recent changes,
+    oldest first.
+
+    Returns:
+        Tuple of (moves, deleted, changed).  moves is a list of (old title,
+        new title) in the order they happened.  deleted is the set of
+        titles that were deleted.  changed is the set of titles that need
+        (re-)importing; some of them may turn out to be redirects now.
+    """
+    moves = []
+    deleted = set()
+    changed = set()
+    for change in changes:
+        title = change['title']
+        if change['type'] in ('edit', 'new'):
+            changed.add(title)
+            deleted.discard(title)
+        elif change.get('logtype') == 'delete':
+            if change.get('logaction') == 'restore':
+                changed.add(title)
+                deleted.discard(title)
+            elif change.get('logaction') == 'delete':
+                deleted.add(title)
+                changed.discard(title)
+        elif change.get('logtype') == 'move':
+            new_title = _move_target(change)
+            if new_title:
+                moves.append((title, new_title))
+                # The old title is usually left as a redirect.
+                changed.add(title)
+                changed.add(new_title)
+                deleted.discard(new_title)
+    return moves, deleted, changed
+
+
+def _classify_titles(titles):
+    """
+    Looks up what the titles are now.
+
+    Returns:
+        Tuple of (pages, redirects, missing): a list of MWPages, a
+        dictionary mapping redirect titles to their targets, and a list
+        of titles that no longer exist.
+    """
+    titles = sorted(titles)
+    pages = []
+    redirects = {}
+    missing = []
+    for i in range(0, len(titles), 50):
+        batch = set(titles[i:i + 50])
+        response = query_api({
+            'action': 'query',
+            'titles': '|'.join(batch),
+            'prop': 'info',
+            'redirects': '',
+        })
+        query = response.get('query', {})
+        for redirect in query.get('redirects', []):
+            if redirect['from'] in batch:
+                redirects[redirect['from']] = redirect['to']
+        for page_info in query.get('pages', {}).values():
+            if page_info['title'] not in batch:
+                continue  # A redirect's target.
+            if 'missing' in page_info:
+                missing.append(page_info['title'])
+            elif str(page_info['ns']) in IMPORT_NAMESPACES:
+                pages.append(MWPage.from_api(page_info))
+    return pages, redirects, missing
+
+
+def _delete_redirect(title, robot, comment):
+    from pages.models import slugify
+    from redirects.models import Redirect
+
+    for r in Redirect.objects.filter(source=slugify(title)):
+        r.delete(user=robot, comment=comment)
+
+
+def _delete_page(title, robot, comment):
+    from pages.models import Page, slugify
+
+    for p in Page.objects.filter(slug=slugify(fix_pagename(title))):
+        print "Deleting %s" % p.name.encode('utf-8')
+        p.delete(user=robot, comment=comment)
+    imported_revisions.pop(title, None)
+
+
+def _move_page(old_title, new_title):
+    from pages.models import Page, slugify
+
+    new_name = fix_pagename(new_title)
+    try:
+        p = Page.objects.get(slug=slugify(fix_pagename(old_title)))
+    except Page.DoesNotExist:
+        return
+    if Page.objects.filter(slug=slugify(new_name)).exists():
+        return
+    print "Moving %s to %s" % (p.name.encode('utf-8'),
+                               new_name.encode('utf-8'))
+    p.rename_to(new_name)
+    if old_title in imported_revisions:
+        imported_revisions[new_title] = imported_revisions.pop(old_title)
+
+
+def _new_revisions(title, since_revid):
+    """
+    Returns the page's revisions, newest first, made after the last one
+    we imported: the one recorded in imported_revisions, or since_revid
+    if none is.
+    """
+    last_revid = imported_revisions.get(title, since_revid)
+    return itertools.takewhile(
+        lambda revision: revision['revid'] > last_revid,
+        iter_page_revisions(title))
+
+
+def update_page(mw_p, since_revid):
+    """
+    Brings an imported page up to date, adding the revisions made since
+    since_revid to its history.  Pages we don't have yet are imported.
+    """
+    from pages.models import Page, slugify
+
+    name = fix_pagename(mw_p.title)
+    _delete_redirect(mw_p.title, get_robot_user(),
+                     "Automated edit. No longer a redirect on the MediaWiki "
+                     "site.")
+    try:
+        p = Page.objects.get(slug=slugify(name))
+    except Page.DoesNotExist:
+        import_page(mw_p)
+        return
+
+    print "Updating %s" % mw_p.title.encode('utf-8')
+    new_revisions = _new_revisions(mw_p.title, since_revid)
+    parsed = parse_page(mw_p.title)
+    decisions = _render_page(p, mw_p, parsed)
+    with watchdog.stage('db'):
+        p.save(track_changes=False)
+    create_page_revisions(p, mw_p, parsed, decisions,
+                          revisions=new_revisions, page_is_new=False)
+    process_page_categories(p, parsed['categories'])
+    imported_revisions[mw_p.title] = parsed['revid']
+
+
+def import_changes(since):
+    """
+    Catches up with the changes made on the wiki after the sync point of
+    an earlier import, and retries the pages that failed in it.
+
+    Returns:
+        List of the titles of the pages that failed to import.
+    """
+    from pages.models import slugify
+
+    oldest = query_api({'action': 'query', 'list': 'recentchanges',
+                        'rcprop': 'timestamp', 'rcdir': 'newer',
+                        'rclimit': 1})['query']['recentchanges']
+    if oldest and since['timestamp'] and (
+            oldest[0]['timestamp'] > since['timestamp']):
+        print ("*** Warning *** The wiki's recent changes only go back to "
+               "%s, so changes made before then have been missed.  Run a "
+               "full import to pick them up." % oldest[0]['timestamp'])
+
+    moves, deleted, changed = summarize_changes(iter_recent_changes(since))
+    retried = set(since.get('failed', [])) - deleted
+    changed.update(retried)
+    print "%d moves, %d deletions, %d changed pages" % (
+        len(moves), len(deleted), len(changed))
+    robot = get_robot_user()
+
+    deleted_comment = "Automated edit. Deleted on the MediaWiki site."
+    with transaction.commit_on_success():
+        for old_title, new_title in moves:
+            _move_page(old_title, new_title)
+        for title in deleted:
+            _delete_page(title, robot, deleted_comment)
+            _delete_redirect(title, robot, deleted_comment)
+
+    pages, redirects, missing = _classify_titles(changed)
+    with transaction.commit_on_success():
+        for title in missing:
+            _delete_page(title, robot, deleted_comment)
+            _delete_redirect(title, robot, deleted_comment)
+        for title in redirects:
+            # Pages that have become redirects, and redirects that point
+            # somewhere else now, are replaced below.
+            comment = "Automated edit. Redirect changed on the MediaWiki site."
+            _delete_page(title, robot, comment)
+            _delete_redirect(title, robot, comment)
+
+    def update(mw_p):
+        if mw_p.title in retried and mw_p.title not in imported_revisions:
+            # Its import failed, and may have left part of it behind.
+            _discard_page(mw_p.title)
+        update_page(mw_p, since['revid'])
+
+    failed = process_concurrently(
+        pages, update, name='changed pages',
+        controller=concurrency_controller,
+        retries=page_retries, dead_letter=dead_letter_file,
+        item_key=_page_title, deadlines=stage_deadlines)
+
+    resolved, looped = resolve_redirects(redirects)
+    redirects = []
+    for from_pagename, to_pagename in sorted(resolved.iteritems()):
+        to_pagename = fix_pagename(to_pagename)
+        if slugify(from_pagename) != slugify(to_pagename):
+            redirects.append((from_pagename, to_pagename))
+    with transaction.commit_on_success():
+        _import_redirect_batch(redirects, robot)
+    return failed
 
-    url = raw_input("Enter the address of a MediaWiki site (ex: http://arborwiki.org/): ")
-    site = wiki.Wiki(guess_api_endpoint(url))
-    SCRIPT_PATH = guess_script_path(url)
-    sitename = site.siteinfo.get('sitename', None)
-    if not sitename:
-        print "Unable to connect to API. Please check the address."
-        sys.exit(1)
-    print "Ready to import %s" % sitename
 
-    yes_no = raw_input("This import will clear out any existing data in this "
-                       "LocalWiki instance. Continue import? (yes/no) ")
-    if yes_no.lower() != "yes":
-        sys.exit()
+def _stage_finished(name):
+    return journal is not None and journal.stage_finished(name)
+
+
+def _finish_stage(name):
+    if journal is not None:
+        journal.finish_stage(name)
+
+
+def _journal_failures():
+    if journal is None:
+        return []
+    return journal.failures()
+
+
+def _save_sync_state(path, sync_point, failed):
+    """
+    Saves the state for the next import.  The pages that failed are
+    listed in it so that the next import retries them, even if they
+    haven't changed on the wiki since.
+    """
+    if failed:
+        print "%d pages failed; the next import will retry them" % (
+            len(failed))
+    save_sync_state(path, dict(sync_point, api_url=API_URL,
+                               pages=imported_revisions,
+                               failed=sorted(set(failed))))
+
+
+def _confirm_and_clear(interactive):
+    if interactive:
+        yes_no = raw_input("This import will clear out any existing data "
+                           "in this LocalWiki instance. Continue import? "
+                           "(yes/no) ")
+        if yes_no.lower() != "yes":
+            sys.exit()
 
     print "Clearing out existing data..."
     with transaction.commit_on_success():
         clear_out_existing_data()
-    start = time.time()
-    print "Importing users..."
-    with transaction.commit_on_success():
-        import_users()
-    print "Importing pages..."
-    import_pages()
+
+
+def run_shard(interactive=True):
+    """
+    Imports this process's share of the pages in a sharded import.  Shard
+    0 also prepares the import beforehand, and adds redirects and map
+    data once every shard is done.
+    """
+    if shard.is_coordinator:
+        if shard.in_progress():
+            print "Resuming the sharded import in progress"
+        else:
+            _confirm_and_clear(interactive)
+        print "Importing users..."
+        with transaction.commit_on_success():
+            import_users()
+        get_robot_user()
+    try:
+        shard.start()
+    except ValueError as e:
+        print e
+        sys.exit(1)
+    print "Importing pages for shard %d of %d..." % (shard.number,
+                                                     shard.num_shards)
+    import_shard_pages()
+    shard.finish()
+    if not shard.is_coordinator:
+        print "Shard %d is done.  Shard 0 will finish the import." % (
+            shard.number)
+        return
+
+    shard.wait_for_shards()
     print "Importing redirects..."
     import_redirects()
     if _maps_installed:
         print "Processing map data..."
         process_mapdata()
-    print "Import completed in %.2f minutes" % ((time.time() - start) / 60.0)
+    failures = shard.failures()
+    if failures:
+        # Kept so that the shards retry them when they're run again.
+        print "%d pages failed to import; run the shards again to retry them" % (
+            len(failures))
+    else:
+        shard.reset()
+
+
+def _print_stats(start, num_pages=None):
+    elapsed = time.time() - start
+    print "Import completed in %.2f minutes" % (elapsed / 60.0)
+    if num_pages is None:
+        from pages.models import Page
+        num_pages = Page.objects.count()
+    print "Throughput: %d pages, %.1f pages per minute" % (
+        num_pages, num_pages / (elapsed / 60.0))
+    if api_cache is not None:
+        print "API cache: %d hits, %d misses" % (api_cache.hits,
+                                                 api_cache.misses)
+    print "Network: %s" % transport.stats()
+    print "Duplicate calls avoided: %d API, %d image info, %d template page" % (
+        _api_calls.saved, _image_info_calls.saved, _template_page_calls.saved)
+    if recorder is not None:
+        print "Recorded %d responses to %s" % (recorder.count(),
+                                               recorder.path)
+
+
+def _report_failures():
+    if dead_letter_file is not None and dead_letter_file.count:
+        print ("%d pages couldn't be imported.  They're listed in %s; "
+               "retry them with --retry-failed." % (dead_letter_file.count,
+                                                    dead_letter_file.path))
+
+
+def _close_transform_pool(terminate=False):
+    if transform_pool is None:
+        return
+    if terminate:
+        transform_pool.terminate()
+    else:
+        transform_pool.close()
+    transform_pool.join()
+    set_transform_pool(None)
+
+
+def _import_site(state, sync_state, resuming, interactive=True, journal=None,
+                 shard=None, mirror=False, mirror_requests=100,
+                 retry_failed=False):
+    """
+    Runs the import once run() has set everything up.  The arguments are
+    run()'s.
+    """
+    try:
+        siteinfo = query_api({'action': 'query', 'meta': 'siteinfo'})
+        sitename = siteinfo['query']['general'].get('sitename', None)
+    except Exception:
+        sitename = None
+    if not sitename:
+        print "Unable to connect to API. Please check the address."
+        sys.exit(1)
+    print "Ready to import %s" % sitename
+    if state:
+        # Taken before we start so that nothing changed during the import
+        # is missed next time.
+        sync_point = get_sync_point()
+
+    if sync_state is not None:
+        start = time.time()
+        print "Importing changes since %s..." % sync_state['timestamp']
+        with transaction.commit_on_success():
+            import_users()
+        failed = import_changes(sync_state)
+        if _maps_installed:
+            process_mapdata()
+        _save_sync_state(state, sync_point, failed)
+        print "Incremental import completed in %.2f minutes" % (
+            (time.time() - start) / 60.0)
+        _report_failures()
+        return
+
+    if retry_failed:
+        start = time.time()
+        retry_failed_pages()
+        # Redirects to these pages couldn't be made without them.
+        print "Importing redirects..."
+        import_redirects()
+        if _maps_installed:
+            print "Processing map data..."
+            process_mapdata()
+        _print_stats(start, num_pages=len(imported_revisions))
+        _report_failures()
+        return
+
+    if shard is not None:
+        start = time.time()
+        run_shard(interactive)
+        # Just the pages this shard imported.
+        _print_stats(start, num_pages=len(imported_revisions))
+        _report_failures()
+        return
+
+    if resuming:
+        print "Resuming the import recorded in %s" % journal
+    else:
+        _confirm_and_clear(interactive)
+    start = time.time()
+    if mirror and not _stage_finished('mirror'):
+        print "Mirroring site..."
+        mirror_site(max_in_flight=mirror_requests)
+        print "Mirror completed in %.2f minutes" % (
+            (time.time() - start) / 60.0)
+        _finish_stage('mirror')
+    if not _stage_finished('users'):
+        print "Importing users..."
+        with transaction.commit_on_success():
+            import_users()
+        _finish_stage('users')
+    failed = []
+    if not _stage_finished('pages'):
+        print "Importing pages..."
+        failed = import_pages()
+        failures = _journal_failures()
+        if failures:
+            # Left unfinished so that they're retried next time.
+            print "%d pages failed to import; run again to retry them" % (
+                len(failures))
+        else:
+            _finish_stage('pages')
+    if not _stage_finished('redirects'):
+        print "Importing redirects..."
+        import_redirects()
+        if _stage_finished('pages'):
+            # Otherwise redirects to the pages still to be retried are
+            # added next time.
+            _finish_stage('redirects')
+    if _maps_installed:
+        print "Processing map data..."
+        process_mapdata()
+    if state:
+        _save_sync_state(state, sync_point, failed)
+    _print_stats(start)
+    _report_failures()
+
+
+def run(cache=None, cache_ttl=None, cache_max_size=None, mirror=False,
+        mirror_requests=100, dump=None, timeout=60, workers=4, min_workers=1,
+        max_workers=16, target_latency=2.0, maxlag=5, record=None, url=None,
+        interactive=True, history_policy=None, state=None, journal=None,
+        shard=None, num_shards=None, processes=0, retries=3, failed=None,
+        retry_failed=False, deadlines=None):
+    """
+    Attrs:
+        cache: Path to a file in which to cache API responses.  Re-running
+            an import with the same cache file won't re-fetch anything
+            that was fetched before.
+        cache_ttl: Maximum age, in seconds, of cached responses.
+        cache_max_size: Maximum size, in bytes, of the cache file contents.
+        mirror: If True, copy everything we need from the wiki into the
+            cache file before importing.  Requires cache.
+        mirror_requests: Number of requests to keep in flight while
+            mirroring.
+        dump: Path to an XML dump of the wiki (optionally .gz or .bz2
+            compressed).  Page lists, revision histories and redirects
+            are read from the dump instead of the API; only page rendering
+            goes to the API.
+        timeout: Seconds to wait on the wiki before giving up on a request.
+        workers: Number of pages to import at once to begin with.  This is
+            raised or lowered as the import goes, depending on how quickly
+            and reliably the wiki responds.
+        min_workers, max_workers: Bounds on the number of pages imported at
+            once.
+        target_latency: API response time, in seconds, to aim for.
+        maxlag: Ask the wiki to refuse our requests while its database
+            replication lag is over this many seconds.
+        record: Path to a RecordingArchive file.  Every API response and
+            file fetched during the import is saved in it, to be served
+            later by a ReplayServer.
+        url: Address of the MediaWiki site.  Asked for if not given.
+        interactive: If False, don't ask before clearing out existing data.
+        history_policy: Which old revisions to import, e.g. "last:50" or
+            "since:2010-01-01,per-author:3600".  See history.py.  All
+            revisions are imported if not given.
+        state: Path to a file in which to remember how far the import got.
+            If the file exists, only the changes made on the wiki since
+            the import that wrote it, and the pages that failed in it, are
+            imported, and existing data is kept.
+        journal: Path to an ImportJournal file recording which stages,
+            pages and revisions have been imported.  If an import with
+            the same journal was interrupted, it's picked up where it left
+            off instead of starting over.
+        shard, num_shards: Import only this shard's share of the pages,
+            and take pages from other shards once it's done, in an import
+            split between num_shards processes.  See sharding.py.
+        processes: Number of processes to transform the HTML of old
+            revisions in, so that it can use more than one CPU.  If 0,
+            it's done in the importer's own threads.
+        retries: Times to retry a page that fails with a transient error,
+            such as the wiki or the database being unavailable.
+        failed: Path to a file in which to list the pages that couldn't
+            be imported.
+        retry_failed: If True, import just the pages listed in the failed
+            file, keeping existing data.
+        deadlines: How long pages may take over each stage of their
+            import before they're given up on as stuck and retried, e.g.
+            "api:300,db:60".  See watchdog.py.
+    """
+    global API_URL, SCRIPT_PATH
+
+    if mirror and not cache:
+        print "Mirroring requires a cache file to mirror into."
+        sys.exit(1)
+    if retry_failed and not failed:
+        print "Give the file listing the failed pages to retry."
+        sys.exit(1)
+    if retry_failed and shard is not None:
+        print "Failed pages of a sharded import are retried by the shards."
+        sys.exit(1)
+    if num_shards is not None and shard is None:
+        print "Give each process of a sharded import its shard number."
+        sys.exit(1)
+    if shard is not None:
+        if dump or mirror or state:
+            print ("Sharded imports can't be combined with --dump, --mirror "
+                   "or --state.")
+            sys.exit(1)
+        try:
+            set_shard(Shard(shard, num_shards or 1))
+        except ValueError as e:
+            print e
+            sys.exit(1)
+    if history_policy:
+        try:
+            set_history_policies(history.parse_policies(history_policy))
+        except ValueError as e:
+            print e
+            sys.exit(1)
+    if deadlines:
+        try:
+            set_stage_deadlines(watchdog.parse_deadlines(deadlines))
+        except ValueError as e:
+            print e
+            sys.exit(1)
+
+    if url is None:
+        url = raw_input("Enter the address of a MediaWiki site (ex: http://arborwiki.org/): ")
+    API_URL = guess_api_endpoint(url)
+    SCRIPT_PATH = guess_script_path(url)
+    sync_state = load_sync_state(state) if state else None
+    if sync_state is not None:
+        if sync_state['api_url'] != API_URL:
+            print "%s is the state of an import from %s, not %s." % (
+                state, sync_state['api_url'], API_URL)
+            sys.exit(1)
+        if cache or mirror:
+            # Cached responses describe the wiki as it was.
+            print "Not using the API cache for an incremental import."
+            cache = mirror = None
+        imported_revisions.update(sync_state.get('pages', {}))
+    resuming = False
+    if journal:
+        import_journal = ImportJournal(journal)
+        origin = import_journal.origin()
+        if origin and origin != API_URL:
+            print "%s is the journal of an import from %s, not %s." % (
+                journal, origin, API_URL)
+            sys.exit(1)
+        import_journal.set_origin(API_URL)
+        resuming = not import_journal.is_empty()
+        set_journal(import_journal)
+    controller = ConcurrencyController(min_workers=min_workers,
+                                       max_workers=max_workers,
+                                       initial_workers=workers,
+                                       target_latency=target_latency)
+    set_concurrency_controller(controller)
+    set_transport(HTTPTransport(timeout=timeout, maxlag=maxlag,
+                                controller=controller))
+    if cache:
+        set_api_cache(APICache(cache, prefix=guess_api_endpoint(url),
+                               ttl=cache_ttl, max_size=cache_max_size))
+    if mirror:
+        set_mirror_store(MirrorStore(cache))
+    if dump:
+        set_dump_path(dump)
+    if record:
+        archive = RecordingArchive(record)
+        archive.set_origin(API_URL)
+        set_recorder(archive)
+    set_page_retries(retries)
+    if failed:
+        set_dead_letter_file(retry.DeadLetterFile(failed))
+    if processes:
+        # Forked before we start any threads, and without the database
+        # connection, which the transform processes don't use.
+        connection.close()
+        set_transform_pool(multiprocessing.Pool(
+            processes, initializer=_init_transform_worker))
+    try:
+        _import_site(state, sync_state, resuming, interactive=interactive,
+                     journal=journal, shard=shard, mirror=mirror,
+                     mirror_requests=mirror_requests,
+                     retry_failed=retry_failed)
+    except BaseException:
+        # e.g. Ctrl-C.  The transform processes are stopped rather than
+        # left to finish.
+        _close_transform_pool(terminate=True)
+        raise
+    _close_transform_pool()
 
 if __name__ == '__main__':
     try:
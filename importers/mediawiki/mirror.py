@@ -0,0 +1,173 @@
+"""
+A local store of page metadata pulled from a MediaWiki site.
+
+The mirror phase of the import fills this in with a handful of bulk
+generator queries, so that the transform phase can look up a page's
+categories, templates and images without going back to the wiki.  The
+image files the pages use are kept here too.
+"""
+import json
+import sqlite3
+import threading
+import zlib
+
+
+LIST_PROPS = ['categories', 'templates', 'images']
+
+
+class MirrorStore(object):
+    """
+    Attrs:
+        path: Path to the SQLite file to keep the metadata in.  This can be
+            the same file as the API cache.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS mirror_pages ('
+                         'title TEXT PRIMARY KEY, '
+                         'pageid INTEGER, '
+                         'ns INTEGER, '
+                         'redirect INTEGER NOT NULL DEFAULT 0, '
+                         'length INTEGER, '
+                         'lastrevid INTEGER, '
+                         'data BLOB)')
+            conn.execute('CREATE TABLE IF NOT EXISTS mirror_files ('
+                         'url TEXT PRIMARY KEY, '
+                         'data BLOB)')
+
+    def _load_data(self, blob):
+        if blob is None:
+            return dict((prop, []) for prop in LIST_PROPS)
+        return json.loads(zlib.decompress(blob))
+
+    def add_pages(self, pages):
+        """
+        Stores the 'pages' part of a query response.  A page's categories,
+        templates and images may be spread over several continued
+        responses, so they're merged with what we already have.
+        """
+        conn = self._connection()
+        with conn:
+            for page_info in pages:
+                if 'missing' in page_info or 'pageid' not in page_info:
+                    continue
+                row = conn.execute('SELECT data FROM mirror_pages '
+                                   'WHERE title = ?',
+                                   (page_info['title'],)).fetchone()
+                data = self._load_data(row and row[0])
+                for prop in LIST_PROPS:
+                    for item in page_info.get(prop, []):
+                        if item['title'] not in data[prop]:
+                            data[prop].append(item['title'])
+                blob = sqlite3.Binary(zlib.compress(json.dumps(data)))
+                if row is None:
+                    conn.execute('INSERT INTO mirror_pages (title, pageid, '
+                                 'ns, redirect, length, lastrevid, data) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (page_info['title'], page_info['pageid'],
+                                  page_info['ns'],
+                                  int('redirect' in page_info),
+                                  page_info.get('length'),
+                                  page_info.get('lastrevid'), blob))
+                else:
+                    # Continued responses may leave out the info.
+                    conn.execute('UPDATE mirror_pages SET pageid = ?, ns = ?, '
+                                 'redirect = ?, '
+                                 'length = COALESCE(?, length), '
+                                 'lastrevid = COALESCE(?, lastrevid), '
+                                 'data = ? WHERE title = ?',
+                                 (page_info['pageid'], page_info['ns'],
+                                  int('redirect' in page_info),
+                                  page_info.get('length'),
+                                  page_info.get('lastrevid'), blob,
+                                  page_info['title']))
+
+    def get(self, title):
+        """
+        Returns a dictionary of the page's metadata, or None if the page
+        isn't in the store.
+        """
+        row = self._connection().execute(
+            'SELECT title, pageid, ns, redirect, length, lastrevid, data '
+            'FROM mirror_pages WHERE title = ?', (title,)).fetchone()
+        if row is None:
+            return None
+        return self._row_to_dict(row)
+
+    def _row_to_dict(self, row):
+        d = {
+            'title': row[0],
+            'pageid': row[1],
+            'ns': row[2],
+            'redirect': bool(row[3]),
+            'length': row[4],
+            'lastrevid': row[5],
+        }
+        d.update(self._load_data(row[6]))
+        return d
+
+    def iter_pages(self, namespaces=None, redirects=False):
+        """
+        Yields the metadata of every stored page, in title order.
+        """
+        query = ('SELECT title, pageid, ns, redirect, length, lastrevid, '
+                 'data FROM mirror_pages WHERE redirect = ?')
+        args = [int(redirects)]
+        if namespaces is not None:
+            query += ' AND ns IN (%s)' % ', '.join(['?'] * len(namespaces))
+            args.extend([int(ns) for ns in namespaces])
+        query += ' ORDER BY title'
+        # Use a separate connection so callers can keep using the store
+        # while we iterate.
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            for row in conn.execute(query, args):
+                yield self._row_to_dict(row)
+        finally:
+            conn.close()
+
+    def count(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM mirror_pages').fetchone()[0]
+
+    def add_file(self, url, data):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO mirror_files (url, data) '
+                         'VALUES (?, ?)', (url, sqlite3.Binary(data)))
+
+    def get_file(self, url):
+        """
+        Returns the contents of the file downloaded from url, or None if
+        it isn't in the store.
+        """
+        row = self._connection().execute(
+            'SELECT data FROM mirror_files WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def has_file(self, url):
+        row = self._connection().execute(
+            'SELECT 1 FROM mirror_files WHERE url = ?', (url,)).fetchone()
+        return row is not None
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM mirror_pages')
+            conn.execute('DELETE FROM mirror_files')
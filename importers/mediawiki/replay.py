@@ -0,0 +1,216 @@
+"""
+Record and replay the importer's traffic with a MediaWiki site.
+
+A RecordingArchive captures every API response and downloaded file from
+a real import.  A ReplayServer then serves that archive over HTTP, as a
+stand-in for the wiki, so imports can be benchmarked offline and
+repeatably.  The server can add latency and fail a share of requests to
+see how the importer copes with a slow or struggling wiki.
+"""
+import BaseHTTPServer
+import gzip
+import json
+import random
+import sqlite3
+import SocketServer
+import threading
+import time
+import zlib
+from cStringIO import StringIO
+from urlparse import urlsplit, parse_qs
+
+from cache import request_key
+
+
+def _file_key(url):
+    split = urlsplit(url)
+    path = split.path
+    if split.query:
+        path += '?' + split.query
+    return path
+
+
+class RecordingArchive(object):
+    """
+    Attrs:
+        path: Path to the SQLite archive file.  Created if it doesn't exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._create_tables()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _create_tables(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS recorded ('
+                         'kind TEXT NOT NULL, '
+                         'key TEXT NOT NULL, '
+                         'body BLOB NOT NULL, '
+                         'PRIMARY KEY (kind, key))')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                         'name TEXT PRIMARY KEY, '
+                         'value TEXT)')
+
+    def _put(self, kind, key, data):
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO recorded (kind, key, body) '
+                         'VALUES (?, ?, ?)',
+                         (kind, key, sqlite3.Binary(zlib.compress(data))))
+
+    def _get(self, kind, key):
+        row = self._connection().execute(
+            'SELECT body FROM recorded WHERE kind = ? AND key = ?',
+            (kind, key)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0])
+
+    def set_origin(self, api_url):
+        """
+        Remembers the API endpoint the archive was recorded from.
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO meta (name, value) '
+                         'VALUES (?, ?)', ('api_url', api_url))
+
+    def origin(self):
+        row = self._connection().execute(
+            'SELECT value FROM meta WHERE name = ?', ('api_url',)).fetchone()
+        return row and row[0]
+
+    def record_api(self, params, response):
+        self._put('api', request_key(params), json.dumps(response))
+
+    def record_file(self, url, data):
+        self._put('file', _file_key(url), data)
+
+    def get_api(self, params):
+        """
+        Returns the recorded response, as JSON text, or None.
+        """
+        return self._get('api', request_key(params))
+
+    def get_file(self, url):
+        return self._get('file', _file_key(url))
+
+    def count(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM recorded').fetchone()[0]
+
+
+class ReplayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def do_GET(self):
+        self._handle(self.path.split('?', 1)[-1] if '?' in self.path else '')
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        self._handle(self.rfile.read(length))
+
+    def _handle(self, query):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and server.random.random() < server.error_rate:
+            self._send(503, 'text/plain', 'Injected error',
+                       {'Retry-After': '1'})
+            return
+
+        if urlsplit(self.path).path.endswith('api.php'):
+            params = dict((k, v[0]) for k, v in
+                          parse_qs(query, keep_blank_values=True).iteritems())
+            body = server.archive.get_api(params)
+            if body is None:
+                body = json.dumps({'error': {
+                    'code': 'notrecorded',
+                    'info': 'This request is not in the archive'}})
+            self._send(200, 'application/json; charset=utf-8',
+                       server.rewrite(body))
+            return
+
+        body = server.archive.get_file(self.path)
+        if body is None:
+            self._send(404, 'text/plain', 'Not in the archive')
+            return
+        self._send(200, 'application/octet-stream', body)
+
+    def _send(self, status, content_type, body, headers=None):
+        if 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Serves a RecordingArchive as if it were the wiki it was recorded from.
+
+    Links to the original site in the recorded responses are rewritten to
+    point at this server, so images are downloaded from it too.
+
+    Attrs:
+        archive: The RecordingArchive to serve.
+        address: (host, port) to listen on.
+        latency: Seconds to wait before answering each request.
+        error_rate: Fraction of requests to answer with a 503.
+        seed: Seed for picking which requests fail, for repeatable runs.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, archive, address=('127.0.0.1', 8000), latency=0,
+                 error_rate=0, seed=None, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplayHandler)
+        self.archive = archive
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.verbose = verbose
+        self.origin = urlsplit(archive.origin() or '')
+
+    @property
+    def netloc(self):
+        host, port = self.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    @property
+    def api_url(self):
+        """
+        The address to give the importer.
+        """
+        return 'http://%s%s' % (self.netloc, self.origin.path or '/api.php')
+
+    def rewrite(self, body):
+        if not self.origin.netloc:
+            return body
+        body = body.replace('https://' + self.origin.netloc,
+                            'http://' + self.origin.netloc)
+        return body.replace('//' + self.origin.netloc, '//' + self.netloc)
@@ -0,0 +1,115 @@
+"""
+Retrying work that fails, and keeping a list of the work that couldn't be
+done.
+
+Errors are transient (the wiki or the database struggling, or the
+network dropping) or permanent (anything else, such as a page we can't
+make sense of).  Work that fails with a transient error is retried after
+an exponentially growing, randomized delay, so that workers that failed
+together don't all retry together.  Work that fails for good is written
+to a dead-letter file, one JSON object per line, from which it can be
+retried later.
+"""
+import httplib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+
+from fetch import FetchTimeout
+from transport import APIError, HTTPError, _is_retryable
+from watchdog import Stuck
+
+
+# API error codes for requests that may well work if tried again.
+TRANSIENT_API_ERRORS = set(['maxlag', 'readonly', 'ratelimited',
+                            'internal_api_error_DBConnectionError',
+                            'internal_api_error_DBQueryError'])
+
+
+def is_database_error(error):
+    """
+    Returns True if error means we lost our connection to the database.
+    The database drivers' exception classes are told apart by name, so
+    this works whichever one is in use.
+    """
+    name = error.__class__.__name__
+    if name in ('OperationalError', 'InterfaceError'):
+        return True
+    return name == 'DatabaseError' and 'connection' in str(error).lower()
+
+
+def is_transient(error):
+    if isinstance(error, HTTPError):
+        return _is_retryable(error.status)
+    if isinstance(error, APIError):
+        return error.code in TRANSIENT_API_ERRORS
+    if isinstance(error, (socket.error, httplib.HTTPException, FetchTimeout,
+                          Stuck)):
+        return True
+    return is_database_error(error)
+
+
+def describe_error(error):
+    """
+    Returns a one-line description of error, e.g. "KeyError: 'revisions'".
+    """
+    description = ''.join(traceback.format_exception_only(
+        type(error), error)).strip()
+    return description.decode('utf-8', 'replace')
+
+
+def backoff(attempt, base=2, cap=300):
+    """
+    Returns how many seconds to wait before retry number attempt + 1: a
+    random time up to base * 2 ** attempt seconds, but at most cap.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class DeadLetterFile(object):
+    """
+    Attrs:
+        path: Path to the file.  Entries are added to the end of it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self, key, error, attempts, transient):
+        """
+        Attrs:
+            key: Names the work item, e.g. a page title.
+            error: Description of the last error.
+            attempts: Number of times the item was tried.
+            transient: Whether the last error was a transient one.
+        """
+        entry = json.dumps({'key': key, 'error': error, 'attempts': attempts,
+                            'transient': transient, 'time': time.time()})
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(entry + '\n')
+            self.count += 1
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def keys(self):
+        """
+        Returns the keys in the file, without repeats, in the order they
+        were added.
+        """
+        seen = set()
+        keys = []
+        for entry in self.entries():
+            if entry['key'] not in seen:
+                seen.add(entry['key'])
+                keys.append(entry['key'])
+        return keys
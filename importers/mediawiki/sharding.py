@@ -0,0 +1,286 @@
+"""
+Splitting an import between several processes, on one machine or on
+several that share the LocalWiki database.
+
+Each page belongs to one shard, picked by hashing its title.  The pages
+are kept as ImportJobs in the database, so a shard that runs out of its
+own pages takes pending pages from the others.  Shard 0 coordinates: it
+clears out existing data and imports users before the others start on
+pages, and adds redirects and map data once every shard is done.
+
+Running shards record a heartbeat.  Pages claimed by a shard whose
+heartbeat has stopped, e.g. because its machine went down, are put back
+for the other shards to take.
+"""
+import datetime
+import hashlib
+import threading
+import time
+
+from django.db import transaction
+
+
+def shard_of(title, num_shards):
+    """
+    Returns the shard a page belongs to.  Unlike hash(), this is the same
+    on every machine.
+    """
+    digest = hashlib.md5(title.encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+class Shard(object):
+    """
+    Attrs:
+        number: This shard's number, from 0 to num_shards - 1.
+        num_shards: Number of shards taking part in the import.
+        poll_interval: Seconds to wait between checks on the other shards.
+        heartbeat_interval: Seconds between this shard's heartbeats.
+        stale_after: Seconds after which a shard with no heartbeat is
+            taken to have stopped, and the pages it claimed longer ago
+            are given to other shards.
+    """
+    def __init__(self, number, num_shards, poll_interval=5,
+                 heartbeat_interval=60, stale_after=600):
+        if not 0 <= number < num_shards:
+            raise ValueError('Shard %d is not between 0 and %d' % (
+                number, num_shards - 1))
+        self.number = number
+        self.num_shards = num_shards
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self._stopped = threading.Event()
+
+    @property
+    def is_coordinator(self):
+        return self.number == 0
+
+    def owns(self, title):
+        return shard_of(title, self.num_shards) == self.number
+
+    def in_progress(self):
+        """
+        Returns True if a sharded import was started and hasn't finished.
+        """
+        from importers.models import ImportShard
+        return ImportShard.objects.exists()
+
+    def _wait(self, ready, message):
+        waiting = False
+        while not ready():
+            if not waiting:
+                print message
+                waiting = True
+            time.sleep(self.poll_interval)
+
+    def start(self):
+        """
+        Registers this shard.  Shards other than 0 wait for shard 0 to be
+        started, so that they don't start on pages before existing data
+        has been cleared out.
+
+        Pages this shard was working on when it was last stopped, and
+        pages it failed to import, are tried again.
+        """
+        from importers.models import ImportShard, ImportJob
+
+        if not self.is_coordinator:
+            self._wait(lambda: ImportShard.objects.filter(number=0).exists(),
+                       "Waiting for shard 0 to start...")
+        other = ImportShard.objects.exclude(num_shards=self.num_shards)
+        if other.exists():
+            raise ValueError('The import in progress has %d shards, not %d' % (
+                other[0].num_shards, self.num_shards))
+        shard, created = ImportShard.objects.get_or_create(
+            number=self.number, defaults={'num_shards': self.num_shards})
+        shard.status = ImportShard.LISTING
+        shard.save()
+        ImportJob.objects.filter(
+            claimed_by=self.number,
+            status__in=[ImportJob.CLAIMED, ImportJob.FAILED],
+        ).update(status=ImportJob.PENDING, claimed_by=None, error='',
+                 updated=datetime.datetime.now())
+        self._stopped.clear()
+        t = threading.Thread(target=self._beat)
+        t.daemon = True
+        t.start()
+
+    def _beat(self):
+        from django.db import connection
+        from importers.models import ImportShard
+
+        while not self._stopped.is_set():
+            ImportShard.objects.filter(number=self.number).update(
+                updated=datetime.datetime.now())
+            self._stopped.wait(self.heartbeat_interval)
+        connection.close()
+
+    def _set_status(self, status):
+        from importers.models import ImportShard
+        # update() doesn't set auto_now fields.
+        ImportShard.objects.filter(number=self.number).update(
+            status=status, updated=datetime.datetime.now())
+
+    def add_jobs(self, pages):
+        """
+        Adds a job for each of this shard's pages among the given MWPages,
+        unless it was added before.
+
+        Returns:
+            The number of jobs added.
+        """
+        from importers.models import ImportShard, ImportJob
+
+        existing = set(ImportJob.objects.filter(
+            shard=self.number).values_list('title', flat=True))
+        added = 0
+        with transaction.commit_on_success():
+            for mw_p in pages:
+                if mw_p.title in existing or not self.owns(mw_p.title):
+                    continue
+                ImportJob(title=mw_p.title, pageid=mw_p.pageid,
+                          namespace=mw_p.namespace, length=mw_p.length or 0,
+                          shard=self.number).save()
+                existing.add(mw_p.title)
+                added += 1
+        self._set_status(ImportShard.IMPORTING)
+        return added
+
+    def _all_listed(self):
+        from importers.models import ImportShard
+        return ImportShard.objects.exclude(
+            status=ImportShard.LISTING).count() == self.num_shards
+
+    def _claim(self, jobs):
+        from importers.models import ImportJob
+
+        while True:
+            candidates = list(jobs.filter(
+                status=ImportJob.PENDING).order_by('-length')[:10])
+            if not candidates:
+                return None
+            for job in candidates:
+                # Only one shard's update matches if several try at once.
+                if ImportJob.objects.filter(
+                        pk=job.pk, status=ImportJob.PENDING).update(
+                        status=ImportJob.CLAIMED, claimed_by=self.number,
+                        updated=datetime.datetime.now()):
+                    return job
+
+    def _reclaim_stale(self):
+        """
+        Puts back the pages claimed more than stale_after seconds ago by
+        shards that haven't had a heartbeat for as long.
+
+        Returns:
+            The number of pages put back.
+        """
+        from importers.models import ImportShard, ImportJob
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(
+            seconds=self.stale_after)
+        stopped = list(ImportShard.objects.filter(updated__lt=cutoff).exclude(
+            number=self.number).values_list('number', flat=True))
+        if not stopped:
+            return 0
+        reclaimed = ImportJob.objects.filter(
+            status=ImportJob.CLAIMED, claimed_by__in=stopped,
+            updated__lt=cutoff,
+        ).update(status=ImportJob.PENDING, claimed_by=None,
+                 updated=datetime.datetime.now())
+        if reclaimed:
+            print "Shard %d put back %d pages claimed by stopped shards" % (
+                self.number, reclaimed)
+        return reclaimed
+
+    def _claimed_elsewhere(self):
+        from importers.models import ImportJob
+        return ImportJob.objects.filter(status=ImportJob.CLAIMED).exclude(
+            claimed_by=self.number).exists()
+
+    def claim_jobs(self):
+        """
+        Yields ImportJobs as they're claimed, costliest first: this shard's
+        own, then those of other shards.  Stops once there's nothing left
+        to claim, every shard has added its jobs, and no other shard is
+        working on a page it might stop before finishing.
+        """
+        from importers.models import ImportJob
+
+        mine = ImportJob.objects.filter(shard=self.number)
+        others = ImportJob.objects.exclude(shard=self.number)
+        while True:
+            # Checked first so that jobs added meanwhile aren't missed.
+            all_listed = self._all_listed()
+            job = self._claim(mine)
+            if job is None:
+                self._reclaim_stale()
+                job = self._claim(others)
+                if job is not None:
+                    print "Shard %d taking %s from shard %d" % (
+                        self.number, job.title.encode('utf-8'), job.shard)
+            if job is not None:
+                yield job
+            elif all_listed and not self._claimed_elsewhere():
+                return
+            else:
+                time.sleep(self.poll_interval)
+
+    def finish_job(self, job):
+        from importers.models import ImportJob
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.DONE, updated=datetime.datetime.now())
+
+    def fail_job(self, job, error):
+        from importers.models import ImportJob
+        ImportJob.objects.filter(pk=job.pk).update(
+            status=ImportJob.FAILED, error=error,
+            updated=datetime.datetime.now())
+
+    def finish(self):
+        from importers.models import ImportShard
+        self._stopped.set()
+        self._set_status(ImportShard.FINISHED)
+
+    def wait_for_shards(self):
+        from importers.models import ImportShard
+        self._wait(lambda: ImportShard.objects.filter(
+                       status=ImportShard.FINISHED).count() == self.num_shards,
+                   "Waiting for the other shards to finish...")
+
+    def failures(self):
+        """
+        Returns (title, error) for each page that failed to import.
+        """
+        from importers.models import ImportJob
+        return list(ImportJob.objects.filter(
+            status=ImportJob.FAILED).values_list('title', 'error'))
+
+    def add_mapdata(self, item):
+        from importers.models import ImportMapData
+        ImportMapData.objects.get_or_create(
+            pagename=item['pagename'], lat=item['lat'], lon=item['lon'])
+
+    def mapdata(self):
+        """
+        Returns the map data found by every shard that hasn't been added to
+        its page yet.
+        """
+        from importers.models import ImportMapData
+        return list(ImportMapData.objects.filter(added=False).values(
+            'pagename', 'lat', 'lon'))
+
+    def finish_mapdata(self, item):
+        from importers.models import ImportMapData
+        ImportMapData.objects.filter(**item).update(added=True)
+
+    def reset(self):
+        """
+        Forgets the import once it's complete.
+        """
+        from importers.models import ImportShard, ImportJob, ImportMapData
+        with transaction.commit_on_success():
+            ImportMapData.objects.all().delete()
+            ImportJob.objects.all().delete()
+            ImportShard.objects.all().delete()
@@ -1,5 +1,11 @@
+import BaseHTTPServer
+import contextlib
 import os
 import site
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from lxml import etree
 import html5lib
@@ -8,7 +14,21 @@ import sapling
 site.addsitedir(os.path.abspath(os.path.split(sapling.__file__)[0]))
 os.environ["DJANGO_SETTINGS_MODULE"] = "sapling.settings"
 
-from importers import mediawiki
+from importers.mediawiki import mediawiki
+from importers.mediawiki.cache import APICache
+from importers.mediawiki.concurrency import (SingleFlight,
+                                             ConcurrencyController)
+from importers.mediawiki.dump import iter_dump_pages
+from importers.mediawiki.fetch import (FetchEngine, FetchTimeout,
+                                       _ResponseParser)
+from importers.mediawiki import history
+from importers.mediawiki.journal import ImportJournal, DONE, FAILED
+from importers.mediawiki.mirror import MirrorStore
+from importers.mediawiki.replay import RecordingArchive, ReplayServer
+from importers.mediawiki.sharding import Shard, shard_of
+from importers.mediawiki import retry
+from importers.mediawiki import watchdog
+from importers.mediawiki.transport import APIError, HTTPError, HTTPTransport
 
 
 def _convert_to_string(l):
@@ -64,6 +84,33 @@ class TestHTMLNormalization(unittest.TestCase):
         expected_html = """<p>Some <em>text <strong>here</strong></em></p><p>and <em>then</em> <strong>some</strong> more</p>"""
         self.assertTrue(is_html_equal(mediawiki.process_html(html), expected_html))
 
+    def test_historic_reuses_template_includes(self):
+        include_html = mediawiki._include_html('Infobox')
+        decisions = {'templates': [('<p>Info</p>', include_html)],
+                     'images': []}
+        html = """<p>Info</p><p>Old text</p>"""
+        expected_html = include_html + """<p>Old text</p>"""
+        self.assertTrue(is_html_equal(
+            mediawiki.process_html(html, pagename='Ann Arbor', historic=True,
+                                   decisions=decisions),
+            expected_html))
+
+    def test_transform_returns_mapdata(self):
+        # As in a transform process, which sends map data back.  Not
+        # _init_transform_worker(), which would ignore Ctrl-C from here on.
+        mediawiki._transform_mapdata = []
+        try:
+            html = ('<p>Old text</p>&lt;googlemap lat="42.28" lon="-83.74"&gt;'
+                    '\n&lt;/googlemap&gt;')
+            html, mapdata = mediawiki.transform_revision(
+                html, 'Ann Arbor', None, {'templates': [], 'images': []})
+        finally:
+            mediawiki._transform_mapdata = None
+        self.assertTrue(is_html_equal(html, '<p>Old text</p>'))
+        self.assertEqual(mapdata, [{'pagename': 'Ann Arbor', 'lat': '42.28',
+                                    'lon': '-83.74'}])
+        self.assertEqual(mediawiki.mapdata_objects_to_create, [])
+
     def test_remove_headline_labels(self):
         html = """<h2><span class="mw-headline" id="Water"> Water </span></h2>"""
         expected_html = """<h2>Water</h2>"""
@@ -150,6 +197,1108 @@ class TestHTMLNormalization(unittest.TestCase):
         expected_html = '<p><span class="plugin embed">&lt;iframe width="320" height="245" src="http://www.archive.org/embed/ssfGNSTRIK1"/&gt;</span></p>'
         self.assertEqual(mediawiki.process_html(html, "Test fix embeds"), expected_html)
 
+class TestAPICache(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_key_is_normalized(self):
+        cache = APICache(self.path)
+        cache.set({'action': 'query', 'aulimit': 500}, {'query': [u'caf\xe9']})
+        self.assertEqual(cache.get({'aulimit': '500', 'action': 'query'}),
+                         {'query': [u'caf\xe9']})
+        self.assertEqual(cache.get({'action': 'query', 'aulimit': 50}), None)
+
+    def test_prefix(self):
+        APICache(self.path, prefix='http://a/api.php').set(
+            {'action': 'parse'}, {'parse': 1})
+        cache = APICache(self.path, prefix='http://b/api.php')
+        self.assertEqual(cache.get({'action': 'parse'}), None)
+
+    def test_ttl(self):
+        cache = APICache(self.path, ttl=60)
+        cache.set({'action': 'parse'}, {'parse': 1})
+        self.assertEqual(cache.get({'action': 'parse'}), {'parse': 1})
+        cache.ttl = -1
+        self.assertEqual(cache.get({'action': 'parse'}), None)
+
+    def test_eviction(self):
+        cache = APICache(self.path, max_size=2000)
+        for i in range(50):
+            cache.set({'oldid': i}, {'text': os.urandom(100).encode('hex')})
+            time.sleep(0.001)
+        cache.evict()
+        self.assertTrue(cache.size() <= 2000)
+        self.assertEqual(cache.get({'oldid': 0}), None)
+        self.assertNotEqual(cache.get({'oldid': 49}), None)
+
+
+class TestDumpReader(unittest.TestCase):
+    dump = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.8/" version="0.8">
+  <siteinfo>
+    <sitename>ArborWiki</sitename>
+    <namespaces>
+      <namespace key="0" case="first-letter" />
+      <namespace key="1" case="first-letter">Talk</namespace>
+      <namespace key="14" case="first-letter">Category</namespace>
+    </namespaces>
+  </siteinfo>
+  <page>
+    <title>Ann Arbor</title>
+    <ns>0</ns>
+    <id>3</id>
+    <revision>
+      <id>10</id>
+      <timestamp>2010-01-01T00:00:00Z</timestamp>
+      <contributor><username>Bob</username><id>2</id></contributor>
+      <comment>first</comment>
+      <text xml:space="preserve" bytes="5">hello</text>
+    </revision>
+    <revision>
+      <id>11</id>
+      <parentid>10</parentid>
+      <timestamp>2010-01-02T00:00:00Z</timestamp>
+      <contributor><ip>127.0.0.1</ip></contributor>
+      <text xml:space="preserve">hi [[Category:Cities]] [[category:Small_towns|x]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>AA</title>
+    <ns>0</ns>
+    <id>4</id>
+    <redirect title="Ann Arbor" />
+    <revision>
+      <id>12</id>
+      <timestamp>2010-01-01T00:00:00Z</timestamp>
+      <contributor><username>Bob</username></contributor>
+      <text xml:space="preserve">#REDIRECT [[Ann Arbor]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>Talk:AA</title>
+    <id>5</id>
+    <revision>
+      <id>13</id>
+      <timestamp>2010-01-01T00:00:00Z</timestamp>
+      <contributor><username>Bob</username></contributor>
+      <text xml:space="preserve">#redirect [[Ann_Arbor]]</text>
+    </revision>
+  </page>
+</mediawiki>"""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.xml')
+        os.write(fd, self.dump)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_pages(self):
+        pages = list(iter_dump_pages(self.path))
+        self.assertEqual([p.title for p in pages],
+                         ['Ann Arbor', 'AA', 'Talk:AA'])
+        ann_arbor = pages[0]
+        self.assertEqual(ann_arbor.pageid, 3)
+        self.assertEqual(ann_arbor.redirect_target, None)
+        self.assertEqual(ann_arbor.categories, ['Cities', 'Small towns'])
+        # Newest first, like the API.
+        self.assertEqual([r['revid'] for r in ann_arbor.revisions], [11, 10])
+        self.assertEqual(ann_arbor.revisions[0]['user'], '127.0.0.1')
+        self.assertEqual(ann_arbor.revisions[1]['comment'], 'first')
+        self.assertEqual(ann_arbor.num_revisions, 2)
+        self.assertEqual(ann_arbor.length, len(
+            'hi [[Category:Cities]] [[category:Small_towns|x]]'))
+
+    def test_redirects(self):
+        pages = list(iter_dump_pages(self.path))
+        self.assertEqual(pages[1].redirect_target, 'Ann Arbor')
+        # Old-style dumps have no <redirect> or <ns>.
+        self.assertEqual(pages[2].redirect_target, 'Ann Arbor')
+        self.assertEqual(pages[2].namespace, 1)
+
+    def test_namespace_filter(self):
+        pages = list(iter_dump_pages(self.path, namespaces=['1']))
+        self.assertEqual([p.title for p in pages], ['Talk:AA'])
+
+
+class TestMirrorStore(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.store = MirrorStore(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_merges_continued_props(self):
+        self.store.add_pages([{'title': u'Oak', 'pageid': 1, 'ns': 0,
+                               'length': 10, 'lastrevid': 5,
+                               'categories': [{'title': u'Category:Trees'}]}])
+        self.store.add_pages([{'title': u'Oak', 'pageid': 1, 'ns': 0,
+                               'categories': [{'title': u'Category:Parks'}],
+                               'images': [{'title': u'File:Oak.jpg'}]}])
+        page = self.store.get(u'Oak')
+        self.assertEqual(page['categories'],
+                         [u'Category:Trees', u'Category:Parks'])
+        self.assertEqual(page['images'], [u'File:Oak.jpg'])
+        self.assertEqual((page['length'], page['lastrevid']), (10, 5))
+
+    def test_updates_page_info(self):
+        self.store.add_pages([{'title': u'Oak', 'pageid': 1, 'ns': 0,
+                               'length': 10, 'lastrevid': 5}])
+        self.store.add_pages([{'title': u'Oak', 'pageid': 1, 'ns': 0,
+                               'redirect': '', 'length': 20,
+                               'lastrevid': 6}])
+        page = self.store.get(u'Oak')
+        self.assertTrue(page['redirect'])
+        self.assertEqual((page['length'], page['lastrevid']), (20, 6))
+        self.assertEqual(list(self.store.iter_pages(namespaces=['0'])), [])
+        self.assertEqual([p['title'] for p in self.store.iter_pages(
+            namespaces=['0'], redirects=True)], [u'Oak'])
+
+    def test_clear(self):
+        self.store.add_pages([{'title': u'Oak', 'pageid': 1, 'ns': 0},
+                              {'title': u'Gone', 'missing': ''}])
+        self.assertEqual(self.store.count(), 1)
+        self.store.clear()
+        self.assertEqual(self.store.count(), 0)
+        self.assertEqual(self.store.get(u'Oak'), None)
+
+
+class TestContinuation(unittest.TestCase):
+    def test_new_style(self):
+        self.assertEqual(mediawiki._continue_params(
+            {'continue': {'gapcontinue': 'B', 'continue': 'gapcontinue||'}}),
+            {'gapcontinue': 'B', 'continue': 'gapcontinue||'})
+        self.assertEqual(mediawiki._continue_params({'query': {}}), None)
+
+    def test_props_before_generator(self):
+        request = {'generator': 'allpages', 'prop': 'categories',
+                   'gapcontinue': 'B'}
+        response = {'query-continue': {
+            'allpages': {'gapcontinue': 'C'},
+            'categories': {'clcontinue': '12|Parks'}}}
+        # The generator stays at B until B's categories are all in.
+        self.assertEqual(mediawiki._continue_params(response, request),
+                         {'gapcontinue': 'B', 'clcontinue': '12|Parks'})
+        response = {'query-continue': {'allpages': {'gapcontinue': 'C'}}}
+        self.assertEqual(mediawiki._continue_params(response, request),
+                         {'gapcontinue': 'C'})
+
+    def test_list(self):
+        response = {'query-continue': {'allusers': {'aufrom': 'Cat'}}}
+        self.assertEqual(mediawiki._continue_params(
+            response, {'list': 'allusers'}), {'aufrom': 'Cat'})
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def slow_double(x):
+            calls.append(x)
+            time.sleep(0.1)
+            return x * 2
+
+        threads = [threading.Thread(
+                       target=lambda: results.append(
+                           flight.do('key', slow_double, 3)))
+                   for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [6] * 5)
+        self.assertEqual(calls, [3])
+        self.assertEqual(flight.saved, 4)
+
+    def test_exceptions_are_shared(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError("failed")
+        self.assertRaises(ValueError, flight.do, 'key', fail)
+        # Nothing is left in flight after a failure.
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+
+
+class TestConcurrencyController(unittest.TestCase):
+    def _controller(self):
+        return ConcurrencyController(min_workers=2, max_workers=5,
+                                     initial_workers=4, target_latency=1.0,
+                                     max_error_rate=0.1, window=10)
+
+    def _window(self, controller, latency, errors=0):
+        for i in range(controller.window):
+            controller.record(latency, error=i < errors)
+
+    def test_raised_while_fast(self):
+        controller = self._controller()
+        self._window(controller, 0.5)
+        self.assertEqual(controller.limit, 5)
+        # But never above max_workers.
+        self._window(controller, 0.5)
+        self.assertEqual(controller.limit, 5)
+
+    def test_kept_while_near_target(self):
+        controller = self._controller()
+        self._window(controller, 1.2)
+        self.assertEqual(controller.limit, 4)
+        # One error is within max_error_rate, but isn't good enough to
+        # raise the limit.
+        self._window(controller, 0.5, errors=1)
+        self.assertEqual(controller.limit, 4)
+
+    def test_halved_when_slow_or_failing(self):
+        controller = self._controller()
+        self._window(controller, 2.0)
+        self.assertEqual(controller.limit, 2)
+        controller.limit = 4
+        self._window(controller, 0.5, errors=2)
+        self.assertEqual(controller.limit, 2)
+        # But never below min_workers.
+        self._window(controller, 0.5, errors=10)
+        self.assertEqual(controller.limit, 2)
+
+    def test_adjusted_once_per_window(self):
+        controller = self._controller()
+        for i in range(controller.window - 1):
+            controller.record(5.0)
+        self.assertEqual(controller.limit, 4)
+        controller.record(5.0)
+        self.assertEqual(controller.limit, 2)
+
+
+class TestResponseParser(unittest.TestCase):
+    def test_content_length_in_pieces(self):
+        parser = _ResponseParser('GET')
+        response = ('HTTP/1.1 200 OK\r\nContent-Length: 11\r\n\r\n'
+                    'hello world')
+        for i in range(0, len(response), 7):
+            parser.feed(response[i:i + 7])
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.status, 200)
+        self.assertEqual(parser.data(), 'hello world')
+        self.assertTrue(parser.keep_alive())
+
+    def test_chunked(self):
+        parser = _ResponseParser('GET')
+        parser.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                    '5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n')
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.data(), 'hello world')
+
+    def test_body_until_close(self):
+        parser = _ResponseParser('GET')
+        parser.feed('HTTP/1.0 200 OK\r\n\r\nhello')
+        self.assertFalse(parser.done)
+        self.assertTrue(parser.eof())
+        self.assertEqual(parser.data(), 'hello')
+        self.assertFalse(parser.keep_alive())
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.archive = RecordingArchive(self.path)
+        self.archive.set_origin('https://wiki.example.org/w/api.php')
+        self.archive.record_api(
+            {'action': 'query', 'titles': u'Caf\xe9', 'continue': ''},
+            {'image': 'https://wiki.example.org/images/a.png'})
+        self.archive.record_file('https://wiki.example.org/images/a.png',
+                                 'PNG data')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _serve(self, **kwargs):
+        server = ReplayServer(self.archive, address=('127.0.0.1', 0),
+                              **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_replays_recorded_responses(self):
+        server = self._serve()
+        transport = HTTPTransport(timeout=5)
+        response = transport.api_request(
+            server.api_url,
+            {'action': 'query', 'titles': u'Caf\xe9', 'continue': ''})
+        image_url = 'http://%s/images/a.png' % server.netloc
+        self.assertEqual(response, {'image': image_url})
+        self.assertEqual(transport.download(image_url), 'PNG data')
+
+        self.assertRaises(APIError, transport.api_request, server.api_url,
+                          {'action': 'other'})
+
+    def test_only_api_requests_are_timed(self):
+        server = self._serve()
+        latencies = []
+
+        class Controller(object):
+            def record(self, latency, error=False):
+                latencies.append(latency)
+
+        transport = HTTPTransport(timeout=5, controller=Controller())
+        transport.download('http://%s/images/a.png' % server.netloc)
+        self.assertEqual(latencies, [])
+        transport.api_request(
+            server.api_url,
+            {'action': 'query', 'titles': u'Caf\xe9', 'continue': ''})
+        self.assertEqual(len(latencies), 1)
+
+    def test_injected_errors_are_retried(self):
+        server = self._serve(error_rate=0.5, seed=1)
+        transport = HTTPTransport(timeout=5, max_retries=20)
+        for i in range(3):
+            self.assertEqual(
+                transport.download('http://%s/images/a.png' % server.netloc),
+                'PNG data')
+        self.assertTrue(transport.retries > 0)
+
+
+class _RedirectingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/hop/'):
+            hops = int(self.path.split('/')[2])
+            self.send_response(302)
+            self.send_header('Location', '/hop/%d' % (hops + 1)
+                             if hops < 10 else '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', '4')
+            self.end_headers()
+            self.wfile.write('data')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRedirects(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _RedirectingHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def test_follows_redirects(self):
+        transport = HTTPTransport(timeout=5)
+        self.assertEqual(transport.download(self.url + '/hop/8'), 'data')
+
+    def test_too_many_redirects(self):
+        transport = HTTPTransport(timeout=5)
+        try:
+            transport.download(self.url + '/hop/0')
+        except HTTPError as e:
+            self.assertEqual(e.status, 302)
+        else:
+            self.fail('Redirects were followed forever')
+
+
+class _KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/moved':
+            self.send_response(301)
+            self.send_header('Location', '/file')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path == '/slow':
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.write('data')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchEngine(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                _KeepAliveHandler)
+        # e.g. a client that gave up on /slow.
+        self.server.handle_error = lambda request, address: None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def test_reuses_connections(self):
+        engine = FetchEngine(max_in_flight=1, timeout=5)
+        results = []
+        for i in range(3):
+            engine.fetch('GET', self.url + '/file', results.append)
+        engine.run()
+        self.assertEqual(results, ['data'] * 3)
+        self.assertEqual(engine.connections_opened, 1)
+        self.assertEqual(engine.connections_reused, 2)
+
+    def test_follows_redirects(self):
+        engine = FetchEngine(timeout=5)
+        results = []
+        engine.fetch('GET', self.url + '/moved', results.append)
+        engine.run()
+        self.assertEqual(results, ['data'])
+        self.assertEqual(engine.requests, 2)
+
+    def test_timeout(self):
+        engine = FetchEngine(timeout=0.2, max_retries=0)
+        results = []
+        errors = []
+        engine.fetch('GET', self.url + '/slow', results.append,
+                     errback=errors.append)
+        engine.run()
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0], FetchTimeout))
+
+    def test_mirrored_files(self):
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        mediawiki.set_mirror_store(MirrorStore(path))
+        self.addCleanup(mediawiki.set_mirror_store, None)
+        engine = FetchEngine(timeout=5)
+        mediawiki._prefetch_file(engine, self.url + '/file')
+        engine.run()
+        # Read from the mirror, not the network.
+        self.server.shutdown()
+        self.assertEqual(mediawiki.download(self.url + '/file'), 'data')
+
+
+class TestResolveRedirects(unittest.TestCase):
+    def test_chains_and_loops(self):
+        resolved, looped = mediawiki.resolve_redirects({
+            'A': 'B',
+            'B': 'C',
+            'C': 'Page',
+            'D': 'Page',
+            'Loop 1': 'Loop 2',
+            'Loop 2': 'Loop 1',
+            'Into loop': 'Loop 1',
+            'Self': 'Self',
+        })
+        self.assertEqual(resolved, {'A': 'Page', 'B': 'Page', 'C': 'Page',
+                                    'D': 'Page'})
+        self.assertEqual(looped, set(['Loop 1', 'Loop 2', 'Into loop',
+                                      'Self']))
+
+
+class TestImageTitles(unittest.TestCase):
+    def tearDown(self):
+        mediawiki._image_info_cache.clear()
+
+    def test_underscored_image_names(self):
+        parsed = mediawiki.parse_result({'parse': {
+            'images': ['Old_Town_Hall.jpg']}})
+        self.assertEqual(parsed['images'], [u'File:Old Town Hall.jpg'])
+
+        info = {'url': 'http://wiki.example.org/images/Old_Town_Hall.jpg'}
+        mediawiki._store_image_info_batch(
+            [u'File:Old Town Hall.jpg', u'File:Missing.jpg'],
+            {'query': {
+                'normalized': [{'from': u'File:Old Town Hall.jpg',
+                                'to': u'Datei:Old Town Hall.jpg'}],
+                'pages': {'1': {'title': u'Datei:Old Town Hall.jpg',
+                                'imageinfo': [info]}}}})
+        self.assertEqual(mediawiki.get_image_info(u'File:Old Town Hall.jpg'),
+                         info)
+        self.assertRaises(KeyError, mediawiki.get_image_info,
+                          u'File:Missing.jpg')
+
+
+class TestLongestFirst(unittest.TestCase):
+    def test_order(self):
+        ordered = mediawiki.longest_first(range(10), lambda i: i,
+                                          small_share=3)
+        self.assertEqual(ordered, [9, 8, 0, 7, 6, 1, 5, 4, 2, 3])
+
+    def test_no_small_share(self):
+        ordered = mediawiki.longest_first([3, 1, 2], lambda i: i,
+                                          small_share=0)
+        self.assertEqual(ordered, [3, 2, 1])
+
+    def test_collect_heaviest(self):
+        heaviest = []
+        items = mediawiki.collect_heaviest(iter([1, 9, 3, 7, 7, 2]),
+                                           lambda i: i, 3, heaviest)
+        self.assertEqual(list(items), [1, 9, 3, 7, 7, 2])
+        self.assertEqual(heaviest, [9, 7, 7])
+
+    def test_costliest_pages_first(self):
+        pages = [mediawiki.MWPage(title, length=length) for title, length in
+                 [(u'Apple', 10), (u'Birch', 20), (u'Cedar', 30),
+                  (u'Zelkova', 5000), (u'ZELKOVA', 10)]]
+        get_page_list = mediawiki.get_page_list
+        num_costliest = mediawiki.NUM_COSTLIEST_PAGES
+        mediawiki.get_page_list = lambda: iter(pages)
+        mediawiki.NUM_COSTLIEST_PAGES = 2
+        try:
+            titles = [mw_p.title for mw_p in mediawiki._planned_pages()]
+        finally:
+            mediawiki.get_page_list = get_page_list
+            mediawiki.NUM_COSTLIEST_PAGES = num_costliest
+        # Zelkova is listed last, but started first.  ZELKOVA loses its
+        # slug to it.
+        self.assertEqual(titles, [u'Zelkova', u'Cedar', u'Apple', u'Birch'])
+
+
+class TestHistoryPolicies(unittest.TestCase):
+    # Newest first.
+    revisions = [
+        {'revid': 5, 'user': 'Ann', 'size': 120,
+         'timestamp': '2012-01-05T12:00:00Z'},
+        {'revid': 4, 'user': 'Ann', 'size': 100,
+         'timestamp': '2012-01-05T11:00:00Z'},
+        {'revid': 3, 'user': 'Bob', 'size': 99,
+         'timestamp': '2012-01-03T00:00:00Z'},
+        {'revid': 2, 'user': 'Ann', 'size': 10,
+         'timestamp': '2012-01-02T00:00:00Z'},
+        {'revid': 1, 'user': 'Bob', 'size': 5,
+         'timestamp': '2012-01-01T00:00:00Z'},
+    ]
+
+    def _thin(self, spec):
+        revisions = [dict(r) for r in self.revisions]
+        kept = history.thin(iter(revisions), history.parse_policies(spec))
+        return [r['revid'] for r in kept]
+
+    def test_last(self):
+        self.assertEqual(self._thin('last:2'), [5, 4])
+        # The page itself is always kept.
+        self.assertEqual(self._thin('last:0'), [5])
+
+    def test_since(self):
+        self.assertEqual(self._thin('since:2012-01-03'), [5, 4, 3])
+        self.assertEqual(self._thin('since:2013-01-01'), [5])
+
+    def test_per_author(self):
+        self.assertEqual(self._thin('per-author:86400'), [5, 3, 2, 1])
+
+    def test_size_delta(self):
+        self.assertEqual(self._thin('size-delta:10'), [5, 3])
+
+    def test_combined(self):
+        self.assertEqual(self._thin('since:2012-01-02,size-delta:10'),
+                         [5, 3])
+
+    def test_size_delta_after_other_policies(self):
+        # Revision 3 is compared with revision 2, which since drops, not
+        # with nothing.
+        self.assertEqual(self._thin('since:2012-01-03,size-delta:95'), [5])
+        self.assertEqual(self._thin('size-delta:95,since:2012-01-03'), [5])
+
+    def test_order_given_doesnt_matter(self):
+        # Per-author applied first would keep revision 1 too.
+        self.assertEqual(self._thin('last:4,per-author:172800'), [5, 3, 2])
+        self.assertEqual(self._thin('per-author:172800,last:4'), [5, 3, 2])
+
+    def test_bad_spec(self):
+        self.assertRaises(ValueError, history.parse_policies, 'first:3')
+        self.assertRaises(ValueError, history.parse_policies, 'last')
+
+
+class TestRevertedRevisions(unittest.TestCase):
+    patched = ['parse_revision', 'transform_revision', 'get_user_id',
+               '_save_revision']
+
+    def setUp(self):
+        self.originals = dict((name, getattr(mediawiki, name))
+                              for name in self.patched)
+        self.parsed = []
+        self.transformed = []
+        self.saved = {}
+
+        def parse_revision(revid):
+            self.parsed.append(revid)
+            return {'html': '<p>revision %s</p>' % revid}
+
+        def transform_revision(html, pagename, mw_page_id, decisions,
+                               parsed=None):
+            self.transformed.append(html)
+            return html, []
+
+        def save_revision(mw_p, p_h, revid, result, first_use):
+            self.saved[revid] = result.get()[0]
+
+        mediawiki.parse_revision = parse_revision
+        mediawiki.transform_revision = transform_revision
+        mediawiki.get_user_id = lambda username: None
+        mediawiki._save_revision = save_revision
+
+    def tearDown(self):
+        for name, value in self.originals.items():
+            setattr(mediawiki, name, value)
+
+    def _import(self, revisions, timestamp=None):
+        if timestamp:
+            for revision in revisions:
+                revision['timestamp'] = timestamp
+
+        class Page(object):
+            id = 1
+            name = u'Oak'
+            content = '<p>current</p>'
+        mw_p = mediawiki.MWPage(u'Oak', pageid=1)
+        mediawiki.create_page_revisions(Page(), mw_p, None,
+                                        revisions=iter(revisions))
+
+    def test_revert_reuses_transform(self):
+        # Newest first: revision 2 was vandalism, reverted by revision 3.
+        self._import([
+            {'revid': 4, 'sha1': 'd', 'timestamp': '2012-01-04T00:00:00Z'},
+            {'revid': 3, 'sha1': 'a', 'timestamp': '2012-01-03T00:00:00Z'},
+            {'revid': 2, 'sha1': 'b', 'timestamp': '2012-01-02T00:00:00Z'},
+            {'revid': 1, 'sha1': 'a', 'timestamp': '2012-01-01T00:00:00Z'},
+        ])
+        self.assertEqual(self.parsed, [3, 2])
+        self.assertEqual(len(self.transformed), 2)
+        self.assertEqual(self.saved[1], self.saved[3])
+        self.assertEqual(self.saved[1], '<p>revision 3</p>')
+
+    def test_cache_is_bounded(self):
+        size = mediawiki.SHA1_CACHE_SIZE
+        mediawiki.SHA1_CACHE_SIZE = 2
+        try:
+            self._import([
+                {'revid': 5, 'sha1': 'e'},
+                {'revid': 4, 'sha1': 'a'},
+                {'revid': 3, 'sha1': 'b'},
+                {'revid': 2, 'sha1': 'c'},
+                {'revid': 1, 'sha1': 'a'},
+            ], timestamp='2012-01-01T00:00:00Z')
+        finally:
+            mediawiki.SHA1_CACHE_SIZE = size
+        # 'a' was pushed out by 'b' and 'c', so revision 1 is parsed again.
+        self.assertEqual(self.parsed, [4, 3, 2, 1])
+
+
+class TestSummarizeChanges(unittest.TestCase):
+    def test_summary(self):
+        changes = [
+            {'type': 'edit', 'title': 'Edited'},
+            {'type': 'new', 'title': 'Created then deleted'},
+            {'type': 'log', 'logtype': 'delete', 'logaction': 'delete',
+             'title': 'Created then deleted'},
+            {'type': 'log', 'logtype': 'delete', 'logaction': 'delete',
+             'title': 'Deleted then restored'},
+            {'type': 'log', 'logtype': 'delete', 'logaction': 'restore',
+             'title': 'Deleted then restored'},
+            {'type': 'log', 'logtype': 'move', 'logaction': 'move',
+             'title': 'Old name', 'logparams': {'target_title': 'New name'}},
+            {'type': 'log', 'logtype': 'move', 'logaction': 'move',
+             'title': 'Older', 'move': {'new_title': 'Newer'}},
+        ]
+        moves, deleted, changed = mediawiki.summarize_changes(changes)
+        self.assertEqual(moves, [('Old name', 'New name'),
+                                 ('Older', 'Newer')])
+        self.assertEqual(deleted, set(['Created then deleted']))
+        self.assertEqual(changed, set(['Edited', 'Deleted then restored',
+                                       'Old name', 'New name', 'Older',
+                                       'Newer']))
+
+
+class TestUpdates(unittest.TestCase):
+    def setUp(self):
+        self.query_api = mediawiki.query_api
+        self.iter_page_revisions = mediawiki.iter_page_revisions
+        self.imported_revisions = dict(mediawiki.imported_revisions)
+
+    def tearDown(self):
+        mediawiki.query_api = self.query_api
+        mediawiki.iter_page_revisions = self.iter_page_revisions
+        mediawiki.imported_revisions.clear()
+        mediawiki.imported_revisions.update(self.imported_revisions)
+
+    def test_new_revisions(self):
+        fetched = []
+
+        def iter_page_revisions(title):
+            for revid in [9, 8, 7, 6, 5]:
+                fetched.append(revid)
+                yield {'revid': revid}
+
+        mediawiki.iter_page_revisions = iter_page_revisions
+        mediawiki.imported_revisions[u'Oak'] = 7
+        revisions = mediawiki._new_revisions(u'Oak', 5)
+        self.assertEqual([r['revid'] for r in revisions], [9, 8])
+        # Older revisions aren't fetched.
+        self.assertEqual(fetched, [9, 8, 7])
+        # Pages we have no record of go back to the sync point.
+        revisions = mediawiki._new_revisions(u'Elm', 5)
+        self.assertEqual([r['revid'] for r in revisions], [9, 8, 7, 6])
+
+    def test_classify_titles(self):
+        def query_api(params):
+            self.assertEqual(sorted(params['titles'].split('|')),
+                             [u'Ash', u'Elm', u'Oak', u'Old Oak',
+                              u'User talk:Bob', u'Willow'])
+            return {'query': {
+                'redirects': [{'from': u'Old Oak', 'to': u'Oak'}],
+                'pages': {
+                    '1': {'title': u'Oak', 'pageid': 1, 'ns': 0,
+                          'length': 100, 'lastrevid': 9},
+                    '2': {'title': u'Elm', 'pageid': 2, 'ns': 0},
+                    '-1': {'title': u'Ash', 'ns': 0, 'missing': ''},
+                    '3': {'title': u'Willow', 'pageid': 3, 'ns': 6},
+                    '4': {'title': u'User talk:Bob', 'pageid': 4, 'ns': 3},
+                },
+            }}
+
+        mediawiki.query_api = query_api
+        pages, redirects, missing = mediawiki._classify_titles(
+            set([u'Oak', u'Old Oak', u'Elm', u'Ash', u'Willow',
+                 u'User talk:Bob']))
+        # Oak is only here as its own title, not as Old Oak's target, and
+        # Willow isn't in a namespace we import.
+        self.assertEqual(sorted(p.title for p in pages),
+                         [u'Elm', u'Oak', u'User talk:Bob'])
+        oak = [p for p in pages if p.title == u'Oak'][0]
+        self.assertEqual((oak.pageid, oak.length, oak.lastrevid), (1, 100, 9))
+        self.assertEqual(redirects, {u'Old Oak': u'Oak'})
+        self.assertEqual(missing, [u'Ash'])
+
+
+class TestImportJournal(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_resume(self):
+        journal = ImportJournal(self.path)
+        self.assertTrue(journal.is_empty())
+        journal.finish_stage('users')
+        journal.start_page(u'Caf\xe9')
+        journal.finish_revision(u'Caf\xe9', 10)
+        journal.finish_page(u'Caf\xe9', 12)
+        journal.start_page('Broken')
+        journal.fail_page('Broken', 'KeyError: \xe2\x98\x83')
+        journal.start_page('Broken')
+        journal.start_page('Unfinished')
+
+        # As if the import had been restarted.
+        journal = ImportJournal(self.path)
+        self.assertFalse(journal.is_empty())
+        self.assertTrue(journal.stage_finished('users'))
+        self.assertFalse(journal.stage_finished('pages'))
+        self.assertEqual(journal.done_pages(), {u'Caf\xe9': 12})
+        self.assertEqual(journal.done_revisions(u'Caf\xe9'), set([10]))
+        self.assertEqual(journal.page_status('Unfinished'), 'started')
+        self.assertEqual(journal.page_status('Missing'), None)
+        self.assertEqual(journal.counts(), {DONE: 1, 'started': 2})
+        journal.fail_page('Broken', 'Still broken')
+        self.assertEqual(journal.failures(), [('Broken', 2, 'Still broken')])
+        self.assertEqual(journal.counts()[FAILED], 1)
+
+    def test_mapdata(self):
+        journal = ImportJournal(self.path)
+        item = {'pagename': u'Park', 'lat': '1.5', 'lon': '2.5'}
+        journal.add_mapdata(item)
+        journal.add_mapdata(dict(item))
+        journal.add_mapdata({'pagename': u'Lake', 'lat': '3', 'lon': '4'})
+        self.assertEqual(len(journal.mapdata()), 2)
+        journal.finish_mapdata(item)
+        self.assertEqual(journal.mapdata(),
+                         [{'pagename': u'Lake', 'lat': '3', 'lon': '4'}])
+
+
+class TestRetries(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        os.remove(self.path)
+        self.backoff = retry.backoff
+        retry.backoff = lambda attempt: 0.01
+
+    def tearDown(self):
+        retry.backoff = self.backoff
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_is_transient(self):
+        self.assertTrue(retry.is_transient(HTTPError('u', 503, 'Busy')))
+        self.assertFalse(retry.is_transient(HTTPError('u', 404, 'Gone')))
+        self.assertTrue(retry.is_transient(APIError('maxlag', 'Lagged')))
+        self.assertFalse(retry.is_transient(APIError('missingtitle', '')))
+        self.assertTrue(retry.is_transient(socket.timeout('timed out')))
+        self.assertFalse(retry.is_transient(KeyError('revisions')))
+
+    def test_retries_and_dead_letters(self):
+        attempts = {}
+        lock = threading.Lock()
+
+        def work(item):
+            with lock:
+                attempts[item] = attempts.get(item, 0) + 1
+            if item == 'flaky' and attempts[item] < 3:
+                raise socket.error('Connection reset')
+            if item == 'down':
+                raise HTTPError('u', 503, 'Service Unavailable')
+            if item == 'broken':
+                raise KeyError('revisions')
+
+        dead_letter = retry.DeadLetterFile(self.path)
+        failed = mediawiki.process_concurrently(
+            ['ok', 'flaky', 'down', 'broken'], work, num_workers=2,
+            retries=2, dead_letter=dead_letter, item_key=lambda item: item)
+        self.assertEqual(sorted(failed), ['broken', 'down'])
+        self.assertEqual(attempts, {'ok': 1, 'flaky': 3, 'down': 3,
+                                    'broken': 1})
+        self.assertEqual(sorted(dead_letter.keys()), ['broken', 'down'])
+        entries = dict((e['key'], e) for e in dead_letter.entries())
+        self.assertEqual(entries['down']['attempts'], 3)
+        self.assertTrue(entries['down']['transient'])
+        self.assertFalse(entries['broken']['transient'])
+        self.assertEqual(entries['broken']['error'], "KeyError: 'revisions'")
+
+    def test_cleaned_up_before_retry(self):
+        # Like import_page(), which skips pages that are already there.
+        saved = {}
+        attempts = []
+
+        def work(title):
+            attempts.append(title)
+            if title in saved:
+                return
+            saved[title] = 'page'
+            if len(attempts) == 1:
+                raise socket.error('Connection reset')
+            saved[title] = 'page with history'
+
+        mediawiki.process_concurrently(
+            ['Page'], work, retries=1,
+            before_retry=lambda title: saved.pop(title, None))
+        self.assertEqual(attempts, ['Page', 'Page'])
+        self.assertEqual(saved, {'Page': 'page with history'})
+
+
+class TestSlugCollisions(unittest.TestCase):
+    def test_longest_wins(self):
+        pages = [mediawiki.MWPage(u'Main street', length=10),
+                 mediawiki.MWPage(u'Main Street', length=500),
+                 mediawiki.MWPage(u'MAIN STREET', length=20),
+                 mediawiki.MWPage(u'Talk:Main Street', length=5),
+                 mediawiki.MWPage(u'Oak', length=None),
+                 mediawiki.MWPage(u'OAK', length=None)]
+        losers = mediawiki.plan_slug_collisions(iter(pages))
+        self.assertEqual(losers, {u'Main street': u'Main Street',
+                                  u'MAIN STREET': u'Main Street'})
+
+
+class TestWatchdog(unittest.TestCase):
+    def test_stuck_item_is_retried(self):
+        release = threading.Event()
+        attempts = []
+
+        def work(item):
+            attempts.append(item)
+            if item == 'hangs' and attempts.count(item) == 1:
+                with watchdog.stage('api'):
+                    release.wait(10)
+
+        backoff = retry.backoff
+        retry.backoff = lambda attempt: 0.01
+        try:
+            start = time.time()
+            mediawiki.process_concurrently(
+                ['hangs', 'ok'], work, num_workers=1, retries=1,
+                deadlines={'api': 0.2})
+        finally:
+            retry.backoff = backoff
+            release.set()
+        # A new worker took over from the stuck one, and tried it again.
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(sorted(attempts), ['hangs', 'hangs', 'ok'])
+
+    def test_abandoned_thread_stops(self):
+        release = threading.Event()
+        stopped = threading.Event()
+        saved = []
+
+        def work(item):
+            if saved:
+                saved.append('retry')
+                return
+            try:
+                with watchdog.stage('api'):
+                    saved.append('first attempt')
+                    release.wait(10)
+                with watchdog.stage('db'):
+                    saved.append('stuck thread')
+            finally:
+                stopped.set()
+
+        backoff = retry.backoff
+        retry.backoff = lambda attempt: 0.01
+        try:
+            mediawiki.process_concurrently(['page'], work, retries=1,
+                                           deadlines={'api': 0.2})
+        finally:
+            retry.backoff = backoff
+            release.set()
+        self.assertTrue(stopped.wait(5))
+        self.assertEqual(saved, ['first attempt', 'retry'])
+
+    def test_only_innermost_stage_counts(self):
+        stuck = []
+        dog = watchdog.Watchdog({'transform': 0.2, 'download': 10},
+                                lambda *args: stuck.append(args))
+        dog.begin('page')
+        with watchdog.stage('transform'):
+            for i in range(3):
+                with watchdog.stage('download'):
+                    time.sleep(0.1)
+                    dog.check()
+            # Only the transform's own time counts, not the downloads'.
+            dog.check()
+        self.assertEqual(stuck, [])
+        self.assertTrue(dog.end())
+
+    def test_parse_deadlines(self):
+        deadlines = watchdog.parse_deadlines('api:30, db:5')
+        self.assertEqual(deadlines['api'], 30)
+        self.assertEqual(deadlines['db'], 5)
+        self.assertEqual(deadlines['transform'],
+                         watchdog.DEADLINES['transform'])
+        self.assertRaises(ValueError, watchdog.parse_deadlines, 'network:5')
+
+
+class TestSharding(unittest.TestCase):
+    def test_shard_of(self):
+        titles = [u'Page %d' % i for i in range(400)] + [u'Caf\xe9']
+        shards = [shard_of(title, 4) for title in titles]
+        # The same title always goes to the same shard...
+        self.assertEqual(shards, [shard_of(title, 4) for title in titles])
+        self.assertEqual(shard_of(u'Main Page', 4), 3)
+        # ...and the titles are spread over all of them.
+        for number in range(4):
+            self.assertTrue(shards.count(number) > 50)
+        self.assertTrue(Shard(3, 4).owns(titles[shards.index(3)]))
+
+    def test_bad_shard(self):
+        self.assertRaises(ValueError, Shard, 4, 4)
+        self.assertRaises(ValueError, Shard, -1, 4)
+
+
+
+class _FakeTransaction(object):
+    """
+    Stands in for django.db.transaction, keeping track of what was saved.
+    """
+    def __init__(self):
+        self.batch = []
+        self.committed = []
+        self.rolled_back = []
+        # Ids get_user_id() gave for each batch's users as it committed.
+        self.ids_at_commit = []
+
+    @contextlib.contextmanager
+    def commit_on_success(self):
+        self.batch = []
+        yield
+        self.ids_at_commit.append(
+            [mediawiki.get_user_id(u.username) for u in self.batch])
+        self.committed.extend(self.batch)
+
+    def savepoint(self):
+        return len(self.batch)
+
+    def savepoint_rollback(self, sid):
+        self.rolled_back.extend(self.batch[sid:])
+        del self.batch[sid:]
+
+    def savepoint_commit(self, sid):
+        pass
+
+
+class TestImportUsers(unittest.TestCase):
+    def setUp(self):
+        from django.contrib.auth import models as auth_models
+
+        self.auth_models = auth_models
+        self.originals = (auth_models.User, mediawiki.iter_query,
+                          mediawiki.transaction, mediawiki._user_ids)
+        self.transaction = _FakeTransaction()
+        transaction = self.transaction
+
+        class User(object):
+            # Like the database, which takes names that only differ in
+            # case for the same name.
+            existing = {u'bob': 1}
+
+            class objects(object):
+                @staticmethod
+                def values_list(*fields):
+                    return [(u'Bob', 1)]
+
+            def __init__(self, username, email):
+                self.username = username
+                self.id = None
+
+            def save(self):
+                transaction.batch.append(self)
+                if self.username.lower() in User.existing:
+                    raise mediawiki.IntegrityError('Duplicate username')
+                self.id = len(User.existing) + 1
+                User.existing[self.username.lower()] = self.id
+
+        def iter_query(params):
+            yield {'query': {'allusers': [
+                {'name': u'Bob'}, {'name': u'A' * 30 + u'nn'},
+                {'name': u'Cat'}]}}
+            yield {'query': {'allusers': [
+                {'name': u'A' * 30 + u'lice'}, {'name': u'BOB'},
+                {'name': u'Dan'}]}}
+
+        auth_models.User = User
+        mediawiki.iter_query = iter_query
+        mediawiki.transaction = self.transaction
+        mediawiki._user_ids = None
+
+    def tearDown(self):
+        (self.auth_models.User, mediawiki.iter_query, mediawiki.transaction,
+         mediawiki._user_ids) = self.originals
+
+    def test_import_users(self):
+        mediawiki.import_users()
+        # Each user is saved once, the truncated name the first time only.
+        self.assertEqual([u.username for u in self.transaction.committed],
+                         [u'A' * 30, u'Cat', u'Dan'])
+        # BOB is taken by Bob, so it's rolled back to its savepoint and
+        # the rest of its batch is kept.
+        self.assertEqual([u.username for u in self.transaction.rolled_back],
+                         [u'BOB'])
+        # Ids are only recorded once their batch has committed.
+        self.assertEqual(self.transaction.ids_at_commit,
+                         [[None, None], [None]])
+        self.assertEqual(mediawiki.get_user_id(u'A' * 30), 2)
+        self.assertEqual(mediawiki.get_user_id(u'Cat'), 3)
+        self.assertEqual(mediawiki.get_user_id(u'Dan'), 4)
+        self.assertEqual(mediawiki.get_user_id(u'Bob'), 1)
+        self.assertEqual(mediawiki.get_user_id(u'BOB'), None)
+
 def run():
     unittest.main()
 
@@ -0,0 +1,283 @@
+"""
+HTTP transport for talking to the MediaWiki site.
+
+Each worker thread keeps its own persistent (keep-alive) connection to
+each host it talks to, responses are requested gzip-compressed, and
+every request has a timeout.  The transport keeps counts of what went
+over the wire so the import can report them.
+
+API requests are sent with maxlag, and requests the server turns away
+(maxlag errors, 429 and 5xx responses) are retried after the delay the
+server asks for in Retry-After.
+"""
+import httplib
+import json
+import socket
+import threading
+import time
+import urllib
+import zlib
+from urlparse import urljoin, urlsplit
+
+
+USER_AGENT = 'LocalWiki MediaWiki importer'
+# Redirects are followed, e.g. from http to https, up to this many times.
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class HTTPError(Exception):
+    def __init__(self, url, status, reason, headers=None):
+        Exception.__init__(self, '%s %s fetching %s' % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.headers = headers or {}
+
+
+class APIError(Exception):
+    def __init__(self, code, info):
+        Exception.__init__(self, '%s: %s' % (code, info))
+        self.code = code
+        self.info = info
+
+
+def _encode_params(params):
+    encoded = {}
+    for k, v in params.iteritems():
+        if isinstance(v, unicode):
+            v = v.encode('utf-8')
+        encoded[k] = v
+    return urllib.urlencode(encoded)
+
+
+def _retry_after(headers, attempt):
+    """
+    Returns how many seconds to wait before retrying, preferring what the
+    server asked for.
+    """
+    try:
+        return max(int(headers.get('retry-after')), 1)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 60)
+
+
+def _is_retryable(status):
+    return status == 429 or status >= 500
+
+
+def _redirect(method, url, body, status, headers):
+    """
+    Returns the (method, url, body) to request to follow a redirect
+    response, or None if it doesn't say where to go.  The method and body
+    are kept, as API requests are POSTs, except after a 303.
+    """
+    location = headers.get('location')
+    if not location:
+        return None
+    if status == 303:
+        method, body = 'GET', None
+    return method, urljoin(url, location), body
+
+
+class HTTPTransport(object):
+    """
+    Attrs:
+        timeout: Seconds to wait on connecting or on any read.
+        maxlag: Sent with every API request.  The server refuses requests
+            while its database replication lag is above this many seconds.
+        max_retries: Times to retry a request the server turned away.
+        controller: Optional ConcurrencyController that's told how long
+            each request took and whether the server was struggling.
+    """
+    def __init__(self, timeout=60, maxlag=None, max_retries=5,
+                 controller=None):
+        self.timeout = timeout
+        self.maxlag = maxlag
+        self.max_retries = max_retries
+        self.controller = controller
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0  # Compressed, as they came over the wire.
+        self.bytes_decoded = 0
+        self.retries = 0
+
+    def _count(self, **counts):
+        with self._stats_lock:
+            for name, value in counts.iteritems():
+                setattr(self, name, getattr(self, name) + value)
+
+    def _connections(self):
+        conns = getattr(self._local, 'connections', None)
+        if conns is None:
+            conns = self._local.connections = {}
+        return conns
+
+    def _get_connection(self, scheme, netloc):
+        conns = self._connections()
+        conn = conns.get((scheme, netloc))
+        if conn is not None:
+            return conn, True
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        conns[(scheme, netloc)] = conn
+        self._count(connections_opened=1)
+        return conn, False
+
+    def _drop_connection(self, scheme, netloc):
+        conn = self._connections().pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """
+        Closes the calling thread's connections.
+        """
+        for key in self._connections().keys():
+            self._drop_connection(*key)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Sends a request, reusing this thread's connection to the host if
+        there is one, and follows any redirects.
+
+        Returns:
+            Tuple of (status, response headers, decoded response body).
+        """
+        for redirects in range(MAX_REDIRECTS + 1):
+            status, reason, response_headers, data = self._request_once(
+                method, url, body, headers)
+            if status not in REDIRECT_STATUSES:
+                break
+            redirect = _redirect(method, url, body, status, response_headers)
+            if redirect is None:
+                break
+            method, url, body = redirect
+
+        if status >= 300:
+            raise HTTPError(url, status, reason, response_headers)
+        return status, response_headers, data
+
+    def _request_once(self, method, url, body, headers):
+        split = urlsplit(url)
+        path = split.path or '/'
+        if split.query:
+            path += '?' + split.query
+        all_headers = {
+            'User-Agent': USER_AGENT,
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        }
+        all_headers.update(headers or {})
+
+        # A kept-alive connection may have been closed by the server since
+        # we last used it, so we try once more on a fresh connection.
+        for attempt in range(2):
+            conn, reused = self._get_connection(split.scheme, split.netloc)
+            try:
+                conn.request(method, path, body, all_headers)
+                response = conn.getresponse()
+                raw = response.read()
+            except (httplib.HTTPException, socket.error):
+                self._drop_connection(split.scheme, split.netloc)
+                if reused and attempt == 0:
+                    continue
+                raise
+            break
+
+        if reused:
+            self._count(connections_reused=1)
+        response_headers = dict(response.getheaders())
+        if response.getheader('connection', '').lower() == 'close':
+            self._drop_connection(split.scheme, split.netloc)
+
+        data = raw
+        if response.getheader('content-encoding', '').lower() == 'gzip':
+            data = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+        self._count(requests=1, bytes_sent=len(body or ''),
+                    bytes_received=len(raw), bytes_decoded=len(data))
+        return response.status, response.reason, response_headers, data
+
+    def _back_off(self, headers, attempt):
+        wait = _retry_after(headers, attempt)
+        self._count(retries=1)
+        if self.controller is not None:
+            self.controller.pause(wait)
+        time.sleep(wait)
+
+    def _record(self, start, is_api, error):
+        # Only API requests are timed: a long image download says nothing
+        # about whether the API is struggling.
+        if self.controller is not None and is_api:
+            self.controller.record(time.time() - start, error=error)
+
+    def _send(self, method, url, body=None, headers=None, is_api=False):
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                status, response_headers, data = self.request(
+                    method, url, body, headers)
+            except HTTPError as e:
+                self._record(start, is_api, error=_is_retryable(e.status))
+                if (not _is_retryable(e.status) or
+                        attempt >= self.max_retries):
+                    raise
+                self._back_off(e.headers, attempt)
+                attempt += 1
+                continue
+            except (httplib.HTTPException, socket.error):
+                self._record(start, is_api, error=True)
+                raise
+
+            if is_api:
+                response = json.loads(data)
+                error = response.get('error')
+                if error and error.get('code') == 'maxlag':
+                    # The server is lagged.  It asks us to wait.
+                    self._record(start, is_api, error=True)
+                    if attempt >= self.max_retries:
+                        raise APIError(error.get('code'), error.get('info'))
+                    self._back_off(response_headers, attempt)
+                    attempt += 1
+                    continue
+                self._record(start, is_api, error=False)
+                if error:
+                    raise APIError(error.get('code'), error.get('info'))
+                return response
+
+            self._record(start, is_api, error=False)
+            return data
+
+    def api_request(self, api_url, params):
+        """
+        POSTs a request to the MediaWiki API and returns the decoded JSON
+        response.  Raises APIError if the API reports an error.
+        """
+        params = dict(params)
+        params['format'] = 'json'
+        if self.maxlag is not None:
+            params['maxlag'] = self.maxlag
+        return self._send(
+            'POST', api_url, _encode_params(params),
+            {'Content-Type': 'application/x-www-form-urlencoded'},
+            is_api=True)
+
+    def download(self, url):
+        """
+        Returns the contents of the file at url.
+        """
+        return self._send('GET', url)
+
+    def stats(self):
+        return ("%d HTTP requests, %d connections opened, %d reused, "
+                "%d bytes received (%d uncompressed), %d bytes sent, "
+                "%d retries" % (
+                    self.requests, self.connections_opened,
+                    self.connections_reused, self.bytes_received,
+                    self.bytes_decoded, self.bytes_sent, self.retries))
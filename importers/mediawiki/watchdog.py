@@ -0,0 +1,172 @@
+"""
+Noticing work that's stuck.
+
+Work is split into stages, such as an API call or a database write, and
+each stage has a deadline.  Code marks the stage it's in with
+
+    with watchdog.stage('api'):
+        ...
+
+and a Watchdog checks on the threads it watches every so often.  When a
+thread has been in a stage for longer than the stage's deadline, it
+prints the thread's stack and gives up on the thread's item, so that the
+item can be tried again by another thread.  Only the innermost stage a
+thread is in counts: a stage's clock stops while a stage inside it runs.
+
+Python can't stop the stuck thread, but it raises Abandoned at the next
+stage it enters or leaves, so that it doesn't go on working on the item
+alongside the thread that took it over.
+
+Deadlines are given on the command line as a comma-separated list of
+stage:seconds pairs, e.g. "api:300,db:60".
+"""
+import sys
+import thread
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+
+# Stage -> seconds it may take.  API calls and downloads are retried by
+# the transport, so their deadlines allow for a few retries.
+DEADLINES = {
+    'api': 900,
+    'download': 900,
+    'transform': 600,
+    'db': 300,
+}
+
+# Thread id -> stack of [stage, time started] for the stages it's in.
+# The time an outer stage started is moved on by the time spent in the
+# stages inside it.
+_stages = {}
+# Ids of the threads whose items have been given up on.
+_abandoned = set()
+
+
+class Abandoned(Exception):
+    pass
+
+
+@contextmanager
+def stage(name):
+    ident = thread.get_ident()
+    if ident in _abandoned:
+        raise Abandoned(name)
+    stack = _stages.setdefault(ident, [])
+    entered = time.time()
+    stack.append([name, entered])
+    try:
+        yield
+    finally:
+        stack.pop()
+        if stack:
+            stack[-1][1] += time.time() - entered
+    if ident in _abandoned:
+        raise Abandoned(name)
+
+
+def parse_deadlines(spec):
+    """
+    Turns a list like "api:300,db:60" into a dictionary of deadlines, with
+    the defaults for stages it doesn't give.  Raises ValueError if it
+    can't.
+    """
+    deadlines = dict(DEADLINES)
+    for part in spec.split(','):
+        name, sep, seconds = part.strip().partition(':')
+        if name not in DEADLINES or not sep:
+            raise ValueError('Unknown deadline %r.  Use one of: %s' % (
+                part, ', '.join('%s:SECONDS' % n for n in sorted(DEADLINES))))
+        deadlines[name] = float(seconds)
+    return deadlines
+
+
+class Stuck(Exception):
+    def __init__(self, stage, seconds):
+        Exception.__init__(self, 'Stuck in %s for %d seconds' % (stage,
+                                                                 seconds))
+        self.stage = stage
+        self.seconds = seconds
+
+
+class Watchdog(object):
+    """
+    Attrs:
+        deadlines: Stage -> seconds it may take.
+        on_stuck: Called with (item, attempt, Stuck exception) for each
+            item given up on, from the watchdog's own thread.
+        interval: Seconds between checks.  By default, every 10 seconds or
+            twice within the shortest deadline, whichever is more often.
+    """
+    def __init__(self, deadlines, on_stuck, interval=None):
+        self.deadlines = deadlines
+        self.on_stuck = on_stuck
+        if interval is None:
+            interval = min([10] + [d / 2.0 for d in deadlines.values()])
+        self.interval = interval
+        self._lock = threading.Lock()
+        # Thread id -> [item, attempt, given up on]
+        self._work = {}
+        self._stopped = threading.Event()
+
+    def begin(self, item, attempt=0):
+        """
+        Called by a worker thread when it starts on an item.
+        """
+        with self._lock:
+            self._work[thread.get_ident()] = [item, attempt, False]
+
+    def end(self):
+        """
+        Called by a worker thread when it's done with its item.
+
+        Returns:
+            False if the watchdog gave up on the item meanwhile.
+        """
+        ident = thread.get_ident()
+        with self._lock:
+            _abandoned.discard(ident)
+            return not self._work.pop(ident)[2]
+
+    def _overdue(self, ident, now):
+        try:
+            name, started = _stages.get(ident, [])[-1]
+        except IndexError:
+            return None
+        deadline = self.deadlines.get(name)
+        if deadline is not None and now - started > deadline:
+            return name, now - started
+        return None
+
+    def check(self):
+        now = time.time()
+        stuck = []
+        with self._lock:
+            for ident, work in self._work.iteritems():
+                overdue = not work[2] and self._overdue(ident, now)
+                if overdue:
+                    work[2] = True
+                    _abandoned.add(ident)
+                    stuck.append((ident, work[0], work[1], overdue))
+        frames = sys._current_frames()
+        for ident, item, attempt, (name, seconds) in stuck:
+            print "*** Warning *** %r stuck in %s for %d seconds:" % (
+                item, name, seconds)
+            if ident in frames:
+                print ''.join(traceback.format_stack(frames[ident]))
+            self.on_stuck(item, attempt, Stuck(name, seconds))
+        return len(stuck)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self._stopped.set()
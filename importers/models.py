@@ -0,0 +1,67 @@
+from django.db import models
+
+
+class ImportShard(models.Model):
+    """
+    One of the processes taking part in a sharded MediaWiki import.
+    """
+    LISTING = 'listing'
+    IMPORTING = 'importing'
+    FINISHED = 'finished'
+    STATUS_CHOICES = (
+        (LISTING, 'Listing pages'),
+        (IMPORTING, 'Importing pages'),
+        (FINISHED, 'Finished'),
+    )
+
+    number = models.IntegerField(unique=True)
+    num_shards = models.IntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=LISTING)
+    # The shard's heartbeat, while it's running.
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ImportJob(models.Model):
+    """
+    A page to be imported by a sharded MediaWiki import.  Each page belongs
+    to one shard, but any shard that runs out of its own pages may take it.
+    """
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (CLAIMED, 'Claimed'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    # Titles can be longer than a CharField allows in every database.
+    # Shard.add_jobs() adds each title once.
+    title = models.TextField()
+    pageid = models.IntegerField(null=True)
+    namespace = models.IntegerField(null=True)
+    # Size of the page, for importing the costliest pages first.
+    length = models.IntegerField(default=0)
+    shard = models.IntegerField(db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    claimed_by = models.IntegerField(null=True)
+    error = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class ImportMapData(models.Model):
+    """
+    A map point found by one of the shards, added to its page once every
+    shard is done.
+    """
+    pagename = models.CharField(max_length=255)
+    lat = models.CharField(max_length=32)
+    lon = models.CharField(max_length=32)
+    added = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('pagename', 'lat', 'lon')